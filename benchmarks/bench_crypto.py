@@ -0,0 +1,108 @@
+"""
+Benchmark comparing Fernet with the AEAD cipher suites.
+Reports encrypt/decrypt throughput and the wire size of a token inside a JSON frame,
+plus per-item versus bulk (decrypt_many) decryption of a history-sized batch.
+
+Usage:
+    python -m benchmarks.bench_crypto [--sizes 32 256 4096] [--count 5000] [--json]
+"""
+
+import argparse
+import json
+import time
+from typing import Any, Dict, List
+from cryptography.fernet import Fernet
+from src.common.crypto_utils import (
+    CryptoManager, KeyRing, SUITE_FERNET, SUITE_AES_GCM, SUITE_CHACHA20
+)
+
+
+def make_manager(suite: str) -> CryptoManager:
+    """Creates a client-side CryptoManager for the given suite."""
+    if suite == SUITE_FERNET:
+        return CryptoManager(key=Fernet.generate_key())
+    return CryptoManager(key=KeyRing.generate(suite).to_bytes())
+
+
+def bench_suite(suite: str, size: int, count: int) -> Dict[str, Any]:
+    """Times `count` encrypt and decrypt calls for messages of `size` characters."""
+    manager = make_manager(suite)
+    message = "x" * size
+
+    start = time.perf_counter()
+    tokens = [manager.encrypt_message(message) for _ in range(count)]
+    enc_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for token in tokens:
+        manager.decrypt_message(token)
+    dec_time = time.perf_counter() - start
+
+    token = tokens[0]
+    wire = len(json.dumps({"text": token}).encode('utf-8')) - len('{"text": ""}')
+    return {
+        "suite": suite,
+        "size": size,
+        "count": count,
+        "encrypt_msgs_per_s": round(count / enc_time),
+        "decrypt_msgs_per_s": round(count / dec_time),
+        "encrypt_mb_per_s": round(size * count / enc_time / 1e6, 2),
+        "wire_bytes": wire,
+        "overhead_pct": round((wire - size) / size * 100, 1),
+    }
+
+
+def bench_bulk(suite: str, size: int, count: int) -> Dict[str, Any]:
+    """Compares a decrypt_message loop with decrypt_many, serial and threaded."""
+    manager = make_manager(suite)
+    tokens = [str(t) for t in manager.encrypt_many(["x" * size] * count)]
+    timings: Dict[str, Any] = {"suite": suite, "size": size, "count": count}
+
+    start = time.perf_counter()
+    for token in tokens:
+        manager.decrypt_message(token)
+    timings["loop_msgs_per_s"] = round(count / (time.perf_counter() - start))
+
+    for label, workers in (("bulk_msgs_per_s", 1), ("bulk_threaded_msgs_per_s", None)):
+        start = time.perf_counter()
+        manager.decrypt_many(tokens, workers=workers)
+        timings[label] = round(count / (time.perf_counter() - start))
+    return timings
+
+
+def main() -> None:
+    """Runs the benchmark and prints a table or JSON."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[32, 256, 4096])
+    parser.add_argument("--count", type=int, default=5000)
+    parser.add_argument("--json", action="store_true", help="print machine-readable output")
+    args = parser.parse_args()
+
+    results: List[Dict[str, Any]] = [
+        bench_suite(suite, size, args.count)
+        for size in args.sizes
+        for suite in (SUITE_FERNET, SUITE_AES_GCM, SUITE_CHACHA20)
+    ]
+
+    bulk = [bench_bulk(suite, size, args.count)
+            for size in args.sizes
+            for suite in (SUITE_FERNET, SUITE_AES_GCM)]
+
+    if args.json:
+        print(json.dumps({"suites": results, "bulk": bulk}, indent=2))
+        return
+
+    print(f"{'suite':<20}{'size':>7}{'enc/s':>10}{'dec/s':>10}{'MB/s':>8}{'wire':>8}{'ovh%':>8}")
+    for r in results:
+        print(f"{r['suite']:<20}{r['size']:>7}{r['encrypt_msgs_per_s']:>10}"
+              f"{r['decrypt_msgs_per_s']:>10}{r['encrypt_mb_per_s']:>8}"
+              f"{r['wire_bytes']:>8}{r['overhead_pct']:>8}")
+
+    print(f"\n{'suite':<20}{'size':>7}{'loop/s':>10}{'bulk/s':>10}{'threaded/s':>12}")
+    for r in bulk:
+        print(f"{r['suite']:<20}{r['size']:>7}{r['loop_msgs_per_s']:>10}"
+              f"{r['bulk_msgs_per_s']:>10}{r['bulk_threaded_msgs_per_s']:>12}")
+
+
+if __name__ == "__main__":
+    main()
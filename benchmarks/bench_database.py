@@ -0,0 +1,218 @@
+"""
+Micro-benchmarks for src.server.database.Database on synthetic data.
+
+Generates users, a friend graph, groups, public rooms and messages with a
+skewed (Zipf-like) distribution over senders and conversations, then times
+the hot Database methods at each requested scale.
+
+Usage:
+    python -m benchmarks.bench_database --scales 10000 100000 --users 1000 [--json]
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Tuple
+from src.server import database
+from src.server.database import Database
+from benchmarks.common import percentile, emit
+
+PASSWORD: str = "bench"
+
+
+def zipf_weights(n: int, s: float) -> List[float]:
+    """Returns Zipf weights 1/k^s for ranks 1..n."""
+    return [1.0 / (k ** s) for k in range(1, n + 1)]
+
+
+# pylint: disable=too-many-locals, too-many-arguments, too-many-positional-arguments
+def generate(db: Database, users: int, messages: int, friends: int,
+             groups: int, rooms: int, skew: float, seed: int) -> Dict[str, Any]:
+    """
+    Fills the database with a synthetic dataset using bulk inserts.
+
+    Returns:
+        Names useful for the timed queries (hot/cold users, groups, rooms).
+    """
+    rng = random.Random(seed)
+    names = [f"user{i}" for i in range(users)]
+    weights = zipf_weights(users, skew)
+    pwd_hash = db._hash_password(PASSWORD)  # pylint: disable=protected-access
+
+    friend_pairs = set()
+    for i, name in enumerate(names):
+        for other in rng.choices(range(users), weights=weights, k=friends):
+            if other != i:
+                friend_pairs.add((name, names[other]))
+                friend_pairs.add((names[other], name))
+
+    group_names = [f"#group{i}" for i in range(groups)]
+    members: Dict[str, List[str]] = {
+        g: sorted(set(rng.choices(names, weights=weights, k=rng.randint(3, 30))))
+        for g in group_names
+    }
+    room_names = [f"&room{i}" for i in range(rooms)]
+
+    # Conversations: DMs between friends, groups, rooms - picked with Zipf skew.
+    pairs = sorted(friend_pairs)
+    conv_weights = zipf_weights(len(pairs) + groups + rooms, skew)
+    targets: List[Tuple[str, str]] = pairs + [(m[0], g) for g, m in members.items()] + \
+        [(names[0], r) for r in room_names]
+    rng.shuffle(targets)
+    rows = []
+    for sender, receiver in rng.choices(targets, weights=conv_weights, k=messages):
+        if receiver.startswith("#"):
+            sender = rng.choice(members[receiver])
+        elif receiver.startswith("&"):
+            sender = rng.choices(names, weights=weights)[0]
+        rows.append((sender, receiver, "x" * rng.randint(40, 300)))
+
+    conn = db.get_connection()
+    try:
+        with conn:
+            insert_users(conn, names, pwd_hash)
+            conn.executemany("INSERT INTO friends (user_1, user_2) VALUES (?, ?)", pairs)
+            conn.executemany("INSERT INTO groups (group_name) VALUES (?)",
+                             [(g,) for g in group_names])
+            conn.executemany("INSERT INTO group_members (group_name, username) VALUES (?, ?)",
+                             [(g, u) for g, ms in members.items() for u in ms])
+            conn.executemany("INSERT INTO public_rooms (room_name, tags, creator) VALUES (?, ?, ?)",
+                             [(r, "bench tags", names[0]) for r in room_names])
+            conn.executemany(
+                "INSERT INTO friend_requests (sender, receiver) VALUES (?, ?)",
+                {(rng.choice(names), rng.choice(names)) for _ in range(users // 10)})
+            insert_messages(conn, rows)
+    finally:
+        conn.close()
+
+    dm_counts = Counter(tuple(sorted((s, r))) for s, r, _ in rows if r[0] not in "#&")
+    hot_pair = dm_counts.most_common(1)[0][0] if dm_counts else (names[0], names[1])
+    return {
+        "hot_user": names[0],
+        "cold_user": names[-1],
+        "hot_pair": hot_pair,
+        "cold_pair": (names[-1], names[-2]),
+        "hot_group": group_names[0] if groups else None,
+        "hot_room": room_names[0] if rooms else None,
+    }
+
+
+def insert_users(conn: sqlite3.Connection, names: List[str], pwd_hash: str) -> None:
+    """Bulk-inserts users that all share one password hash."""
+    conn.executemany("INSERT INTO users (username, password_hash) VALUES (?, ?)",
+                     [(n, pwd_hash) for n in names])
+
+
+def insert_messages(conn: sqlite3.Connection, rows: List[Tuple[str, str, str]]) -> None:
+    """Bulk-inserts (sender, receiver, content) rows, creating their conversations."""
+    ids = dict(conn.execute("SELECT username, id FROM users").fetchall())
+
+    def conversation(sender: str, receiver: str) -> Any:
+        if receiver[0] in "#&":
+            return receiver
+        return tuple(sorted((ids[sender], ids[receiver])))
+
+    keys = {conversation(s, r) for s, r, _ in rows}
+    conn.executemany("INSERT INTO conversations (name) VALUES (?)",
+                     [(k,) for k in keys if isinstance(k, str)])
+    conn.executemany("INSERT INTO conversations (user_lo, user_hi) VALUES (?, ?)",
+                     [k for k in keys if isinstance(k, tuple)])
+    conv_ids: Dict[Any, int] = {}
+    for cid, name, lo, hi in conn.execute("SELECT id, name, user_lo, user_hi FROM conversations"):
+        conv_ids[name if name else (lo, hi)] = cid
+    conn.executemany(
+        "INSERT INTO messages (conversation_id, sender_id, content) VALUES (?, ?, ?)",
+        [(conv_ids[conversation(s, r)], ids[s], c) for s, r, c in rows])
+
+
+def timed(func: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    """Runs `func` `repeat` times and returns mean/p50/p99 in milliseconds."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return {
+        "mean_ms": round(sum(samples) / len(samples), 3),
+        "p50_ms": round(percentile(samples, 50) or 0, 3),
+        "p99_ms": round(percentile(samples, 99) or 0, 3),
+    }
+
+
+def refresh_query_set(db: Database, user: str) -> None:
+    """The four queries _refresh_client_data issues per data_update."""
+    db.get_friends_list(user)
+    db.get_user_groups(user)
+    db.get_pending_requests(user)
+    db.get_public_rooms()
+
+
+def bench_scale(args: argparse.Namespace, messages: int) -> Dict[str, Any]:
+    """Builds a fresh dataset with `messages` rows and times each operation."""
+    with tempfile.TemporaryDirectory() as workdir:
+        database.DB_DIR = workdir
+        database.DB_PATH = os.path.join(workdir, "bench.db")
+        db = Database()
+        start = time.perf_counter()
+        ctx = generate(db, args.users, messages, args.friends, args.groups,
+                       args.rooms, args.skew, args.seed)
+        gen_time = time.perf_counter() - start
+        hot_a, hot_b = ctx["hot_pair"]
+        cold_a, cold_b = ctx["cold_pair"]
+        r = args.repeat
+
+        ops: Dict[str, Callable[[], Any]] = {
+            "check_login": lambda: db.check_login(ctx["hot_user"], PASSWORD),
+            "store_message": lambda: db.store_message(hot_a, hot_b, "x" * 120),
+            "get_friends_list": lambda: db.get_friends_list(ctx["hot_user"]),
+            "refresh_query_set": lambda: refresh_query_set(db, ctx["hot_user"]),
+            "history_dm_hot": lambda: db.get_chat_history(hot_a, hot_b),
+            "history_dm_cold": lambda: db.get_chat_history(cold_a, cold_b),
+        }
+        if ctx["hot_group"]:
+            ops["history_group"] = lambda: db.get_chat_history(hot_a, ctx["hot_group"])
+        if ctx["hot_room"]:
+            ops["history_room"] = lambda: db.get_chat_history(hot_a, ctx["hot_room"])
+
+        result: Dict[str, Any] = {
+            "messages": messages,
+            "users": args.users,
+            "generate_s": round(gen_time, 2),
+            "db_size_kb": os.path.getsize(database.DB_PATH) // 1024,
+        }
+        for name, func in ops.items():
+            result[name] = timed(func, r)
+        return result
+
+
+def add_common_args(parser: argparse.ArgumentParser) -> None:
+    """Adds the dataset, timing and output options shared with bench_message_log."""
+    parser.add_argument("--scales", type=int, nargs="+", default=[10_000, 100_000],
+                        help="message counts to benchmark")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print machine-readable output")
+    parser.add_argument("--output", help="also write JSON results to this file")
+
+
+def main() -> None:
+    """Parses arguments and runs every scale."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_common_args(parser)
+    parser.add_argument("--friends", type=int, default=10, help="friend edges drawn per user")
+    parser.add_argument("--rooms", type=int, default=20)
+    args = parser.parse_args()
+
+    emit([bench_scale(args, n) for n in args.scales], args.json, args.output)
+
+
+if __name__ == "__main__":
+    main()
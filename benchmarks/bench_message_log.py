@@ -0,0 +1,150 @@
+"""
+Compares the SQLite messages table with the append-only MessageLog.
+
+Builds the same Zipf-skewed message set in both engines, then times
+store_message and history reads through the Database interface: the latest
+page, a deep page, the full history of the hottest DM and a cold DM. For the
+log it also reports compaction and recovery (reopen) times.
+
+Usage:
+    python -m benchmarks.bench_message_log --scales 10000 100000 --users 1000 [--json]
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Tuple
+from src.server import database
+from src.server.database import Database
+from src.server.message_log import MessageLog
+from benchmarks.bench_database import (
+    PASSWORD, add_common_args, insert_messages, insert_users, timed, zipf_weights
+)
+from benchmarks.common import emit
+
+PAGE: int = 50
+
+
+def pair(a: str, b: str) -> Tuple[str, str]:
+    """Returns two usernames in sorted order."""
+    return (a, b) if a <= b else (b, a)
+
+
+def synthetic_messages(users: int, messages: int, groups: int, skew: float,
+                       seed: int) -> Tuple[List[str], List[Tuple[str, str, str]]]:
+    """Returns usernames and (sender, receiver, content) rows over DMs and groups."""
+    rng = random.Random(seed)
+    names = [f"user{i}" for i in range(users)]
+    weights = zipf_weights(users, skew)
+    pairs = {pair(*rng.choices(names, weights=weights, k=2)) for _ in range(users * 5)}
+    targets: List[Tuple[str, str]] = [p for p in pairs if p[0] != p[1]]
+    targets += [(names[0], f"#group{i}") for i in range(groups)]
+    rng.shuffle(targets)
+    picks = rng.choices(targets, weights=zipf_weights(len(targets), skew), k=messages)
+    rows = []
+    for a, b in picks:
+        if not b.startswith("#") and rng.random() < 0.5:
+            a, b = b, a
+        rows.append((a, b, "x" * rng.randint(40, 300)))
+    return names, rows
+
+
+def dir_size_kb(path: str) -> int:
+    """Total size of the files in a directory, in KiB."""
+    return sum(os.path.getsize(os.path.join(path, n)) for n in os.listdir(path)) // 1024
+
+
+def engine_ops(db: Database, hot: Tuple[str, str], cold: Tuple[str, str],
+               middle: int) -> Dict[str, Callable[[], Any]]:
+    """The operations timed for each engine."""
+    return {
+        "store_message": lambda: db.store_message(hot[0], hot[1], "x" * 120),
+        "history_latest_page": lambda: db.get_chat_history(hot[0], hot[1], limit=PAGE),
+        "history_deep_page": lambda: db.get_chat_history(hot[0], hot[1], limit=PAGE, before=middle),
+        "history_full_hot": lambda: db.get_chat_history(hot[0], hot[1]),
+        "history_full_cold": lambda: db.get_chat_history(cold[0], cold[1]),
+    }
+
+
+def load_sqlite(names: List[str], rows: List[Tuple[str, str, str]]) -> Tuple[Database, float]:
+    """Creates the SQLite database with users and messages; returns it and the message load time."""
+    db = Database()
+    pwd_hash = db._hash_password(PASSWORD)  # pylint: disable=protected-access
+    conn = db.get_connection()
+    try:
+        with conn:
+            insert_users(conn, names, pwd_hash)
+            start = time.perf_counter()
+            insert_messages(conn, rows)
+        return db, time.perf_counter() - start
+    finally:
+        conn.close()
+
+
+def load_log(log: MessageLog, rows: List[Tuple[str, str, str]]) -> float:
+    """Appends every row to the log; returns the time taken."""
+    start = time.perf_counter()
+    for sender, receiver, content in rows:
+        log.append(sender, receiver, content)
+    return time.perf_counter() - start
+
+
+def bench_scale(args: argparse.Namespace, messages: int) -> Dict[str, Any]:  # pylint: disable=too-many-locals
+    """Loads `messages` rows into both engines and times each operation."""
+    names, rows = synthetic_messages(args.users, messages, args.groups, args.skew, args.seed)
+    ranked = Counter(pair(s, r) for s, r, _ in rows if not r.startswith("#")).most_common()
+    hot, cold = ranked[0][0], ranked[-1][0]
+    segment_size = args.segment_mb * 1024 * 1024
+
+    with tempfile.TemporaryDirectory() as workdir:
+        database.DB_DIR = workdir
+        database.DB_PATH = os.path.join(workdir, "bench.db")
+        sqlite_db, sqlite_load = load_sqlite(names, rows)
+        log_dir = os.path.join(workdir, "log")
+        log = MessageLog(log_dir, segment_size=segment_size, sync=args.sync)
+        log_load = load_log(log, rows)
+        log_db = Database(log)
+
+        hot_ids = [m["id"] for m in sqlite_db.get_chat_history(*hot)]
+        result: Dict[str, Any] = {
+            "messages": messages,
+            "hot_dm_messages": len(hot_ids),
+            "sqlite_load_s": round(sqlite_load, 2),
+            "log_load_s": round(log_load, 2),
+        }
+        for name, db in (("sqlite", sqlite_db), ("log", log_db)):
+            for op, func in engine_ops(db, hot, cold, hot_ids[len(hot_ids) // 2]).items():
+                result[f"{name}_{op}"] = timed(func, args.repeat)
+        result["sqlite_size_kb"] = os.path.getsize(database.DB_PATH) // 1024
+        result["log_size_kb"] = dir_size_kb(log_dir)
+
+        start = time.perf_counter()
+        result["log_compacted_records"] = log.compact()
+        result["log_compact_s"] = round(time.perf_counter() - start, 3)
+        result["log_compacted_history_full_hot"] = timed(
+            lambda: log_db.get_chat_history(*hot), args.repeat)
+        log.close()
+        start = time.perf_counter()
+        MessageLog(log_dir, segment_size=segment_size).close()
+        result["log_recover_s"] = round(time.perf_counter() - start, 3)
+        return result
+
+
+def main() -> None:
+    """Parses arguments and runs every scale."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_common_args(parser)
+    parser.add_argument("--segment-mb", type=int, default=4, help="log segment size in MiB")
+    parser.add_argument("--sync", action="store_true",
+                        help="fsync every log append, as SQLite does on commit")
+    args = parser.parse_args()
+
+    emit([bench_scale(args, n) for n in args.scales], args.json, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Contention benchmark for the server's client registry.
+
+Writer threads log users in and out while reader threads look users up and
+iterate over all connections (a room broadcast). Three registries are compared:
+
+  dict    the former plain dict, unsynchronized (counts iteration errors)
+  locked  a dict guarded by one lock, copied under the lock for iteration
+  cow     ClientRegistry (copy-on-write, lock-free reads)
+
+Usage:
+    python -m benchmarks.bench_registry [--users 1000] [--writers 2] [--readers 8] [--json]
+"""
+
+import argparse
+import random
+import threading
+import time
+from typing import Any, Dict, List, Mapping, Tuple
+from src.server.registry import ClientRegistry
+from benchmarks.common import percentile, emit
+
+
+class DictRegistry:
+    """The unsynchronized dict the server used before ClientRegistry."""
+
+    def __init__(self) -> None:
+        self.clients: Dict[str, Tuple[object, ...]] = {}
+
+    def add(self, user: str, conn: object) -> None:
+        """Registers a connection."""
+        self.clients[user] = (conn,)
+
+    def remove(self, user: str, _conn: object) -> None:
+        """Unregisters a connection."""
+        self.clients.pop(user, None)
+
+    def sessions(self, user: str) -> Tuple[object, ...]:
+        """Looks a user up."""
+        return self.clients.get(user, ())
+
+    def snapshot(self) -> Mapping[str, Tuple[object, ...]]:
+        """Returns the live dict (not safe to iterate while writers run)."""
+        return self.clients
+
+
+class LockedRegistry(DictRegistry):
+    """A dict behind one lock; readers copy it under the lock to iterate."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.lock = threading.Lock()
+
+    def add(self, user: str, conn: object) -> None:
+        with self.lock:
+            self.clients[user] = (conn,)
+
+    def remove(self, user: str, _conn: object) -> None:
+        with self.lock:
+            self.clients.pop(user, None)
+
+    def sessions(self, user: str) -> Tuple[object, ...]:
+        with self.lock:
+            return self.clients.get(user, ())
+
+    def snapshot(self) -> Mapping[str, Tuple[object, ...]]:
+        with self.lock:
+            return dict(self.clients)
+
+
+def make_registry(kind: str) -> Any:
+    """Creates the registry under test."""
+    if kind == "cow":
+        return ClientRegistry()
+    return LockedRegistry() if kind == "locked" else DictRegistry()
+
+
+def bench_kind(kind: str, args: argparse.Namespace) -> Dict[str, Any]:  # pylint: disable=too-many-locals
+    """Runs writers and readers against one registry for args.duration seconds."""
+    registry = make_registry(kind)
+    users = [f"user{i}" for i in range(args.users)]
+    conns = {u: object() for u in users}
+    for u in users[: args.users // 2]:
+        registry.add(u, conns[u])
+
+    stop = threading.Event()
+    counts = {"writes": 0, "lookups": 0, "broadcasts": 0, "errors": 0}
+    counts_lock = threading.Lock()
+    broadcast_times: List[float] = []
+
+    def writer(seed: int) -> None:
+        rng = random.Random(seed)
+        done = 0
+        while not stop.is_set():
+            user = rng.choice(users)
+            if rng.random() < 0.5:
+                registry.add(user, conns[user])
+            else:
+                registry.remove(user, conns[user])
+            done += 1
+        with counts_lock:
+            counts["writes"] += done
+
+    def reader(seed: int) -> None:
+        rng = random.Random(seed)
+        lookups = broadcasts = errors = 0
+        times: List[float] = []
+        while not stop.is_set():
+            for _ in range(args.lookups):
+                registry.sessions(rng.choice(users))
+            lookups += args.lookups
+            start = time.perf_counter()
+            try:
+                for _user, _conn in registry.snapshot().items():
+                    pass
+            except RuntimeError:
+                errors += 1
+            times.append(time.perf_counter() - start)
+            broadcasts += 1
+        with counts_lock:
+            counts["lookups"] += lookups
+            counts["broadcasts"] += broadcasts
+            counts["errors"] += errors
+            broadcast_times.extend(times)
+
+    threads = ([threading.Thread(target=writer, args=(i,)) for i in range(args.writers)] +
+               [threading.Thread(target=reader, args=(100 + i,)) for i in range(args.readers)])
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    time.sleep(args.duration)
+    stop.set()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    p99 = percentile(broadcast_times, 99)
+    return {
+        "registry": kind,
+        "users": args.users,
+        "writers": args.writers,
+        "readers": args.readers,
+        "writes_per_s": round(counts["writes"] / elapsed),
+        "lookups_per_s": round(counts["lookups"] / elapsed),
+        "broadcasts_per_s": round(counts["broadcasts"] / elapsed),
+        "broadcast_p99_us": round(p99 * 1e6, 1) if p99 is not None else None,
+        "iteration_errors": counts["errors"],
+    }
+
+
+def main() -> None:
+    """Runs the benchmark for each registry and prints a table or JSON."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--kinds", nargs="+", default=["dict", "locked", "cow"],
+                        choices=["dict", "locked", "cow"])
+    parser.add_argument("--users", type=int, default=1000, help="distinct usernames")
+    parser.add_argument("--writers", type=int, default=2, help="login/logout threads")
+    parser.add_argument("--readers", type=int, default=8, help="lookup/broadcast threads")
+    parser.add_argument("--lookups", type=int, default=10, help="lookups per broadcast")
+    parser.add_argument("--duration", type=float, default=3.0, help="seconds per registry")
+    parser.add_argument("--json", action="store_true", help="print machine-readable output")
+    parser.add_argument("--output", help="also write JSON results to this file")
+    args = parser.parse_args()
+
+    emit([bench_kind(kind, args) for kind in args.kinds], args.json, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""
+Load-generation benchmark for ChatServer.
+
+Starts a real server in a subprocess on a loopback port with a temporary
+database and key ring, connects N simulated clients over the normal
+send_json/receive_json protocol and drives a configurable mix of direct,
+#group and &room messages. Reports delivery latency percentiles, throughput
+and server RSS / thread count.
+
+Usage:
+    python -m benchmarks.bench_server --clients 50 --messages 100 --mix dm=6,group=3,room=1
+    python -m benchmarks.bench_server --json --output bench_output.txt
+"""
+
+import argparse
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from src.common.protocol import send_json, receive_json
+from benchmarks.common import percentile, process_stats, emit
+
+HOST: str = "127.0.0.1"
+PASSWORD: str = "bench"
+
+
+def free_port() -> int:
+    """Asks the OS for an unused loopback port."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((HOST, 0))
+        return int(s.getsockname()[1])
+
+
+def serve(port: int, workdir: str) -> None:
+    """Runs a ChatServer with its database and keys inside `workdir` (subprocess entry)."""
+    # pylint: disable=import-outside-toplevel
+    from src.server import database
+    from src.common import crypto_utils
+    from src.server.server_main import ChatServer, ConnectionLimits
+
+    database.DB_DIR = workdir
+    database.DB_PATH = os.path.join(workdir, "data.db")
+    crypto_utils.KEY_FILE = os.path.join(workdir, "server.key")
+    crypto_utils.KEYRING_FILE = os.path.join(workdir, "server.keyring")
+    # Per-user rate limits would cap each simulated client; measure the server itself.
+    ChatServer(HOST, port, limits=ConnectionLimits(rates={})).start()
+
+
+def start_server(port: int, workdir: str) -> subprocess.Popen:  # type: ignore[type-arg]
+    """Launches the server subprocess and waits until it accepts connections."""
+    proc = subprocess.Popen(  # pylint: disable=consider-using-with
+        [sys.executable, "-m", "benchmarks.bench_server", "--serve", str(port), "--workdir", workdir],
+        stdout=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection((HOST, port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("Server did not start")
+
+
+class SimClient:
+    """One simulated user: a socket plus a reader thread recording delivery latency."""
+
+    def __init__(self, name: str, port: int) -> None:
+        self.name: str = name
+        self.sock: socket.socket = socket.create_connection((HOST, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.latencies: List[float] = []
+        self.received: int = 0
+        self.send_lock: threading.Lock = threading.Lock()
+        self.reader: Optional[threading.Thread] = None
+
+    def request(self, payload: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Sends a request and waits for its direct reply (used before the reader starts)."""
+        send_json(self.sock, payload)
+        return receive_json(self.sock)
+
+    def login(self) -> None:
+        """Registers and logs the user in, then starts the reader thread."""
+        self.request({"action": "register", "username": self.name, "password": PASSWORD})
+        resp = self.request({"action": "login", "username": self.name, "password": PASSWORD})
+        if not resp or resp.get("status") != "success":
+            raise RuntimeError(f"Login failed for {self.name}: {resp}")
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def send(self, payload: Dict[str, Any]) -> None:
+        """Sends one frame."""
+        with self.send_lock:
+            send_json(self.sock, payload)
+
+    def _read(self) -> None:
+        """Records latency for every incoming msg frame until the socket closes."""
+        while True:
+            data = receive_json(self.sock)
+            if data is None:
+                return
+            if data.get("action") == "msg":
+                sent_at = float(str(data.get("text", "0")).split("|", 1)[0])
+                self.latencies.append(time.perf_counter() - sent_at)
+                self.received += 1
+
+    def close(self) -> None:
+        """Closes the connection, which also ends the reader thread."""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def parse_mix(text: str) -> Dict[str, float]:
+    """Parses 'dm=6,group=3,room=1' into normalized weights."""
+    mix = {"dm": 0.0, "group": 0.0, "room": 0.0}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in mix:
+            raise ValueError(f"Unknown message kind: {kind}")
+        mix[kind] = float(weight)
+    total = sum(mix.values())
+    return {k: v / total for k, v in mix.items()}
+
+
+def setup_social(clients: List[SimClient], group_size: int, rooms: int) -> Tuple[List[str], List[str]]:
+    """Creates groups of `group_size` members and `rooms` public rooms."""
+    groups: List[str] = []
+    for i in range(0, len(clients), group_size):
+        name = f"#bench{i // group_size}"
+        members = clients[i:i + group_size]
+        members[0].send({"action": "create_group", "group_name": name})
+        time.sleep(0.01)
+        for m in members[1:]:
+            m.send({"action": "join_group", "group_name": name})
+        groups.append(name)
+    room_names = [f"&bench{i}" for i in range(rooms)]
+    for name in room_names:
+        clients[0].send({"action": "create_public_room", "room_name": name, "tags": "bench"})
+        time.sleep(0.1)
+        # Room messages only reach subscribers.
+        for c in clients[1:]:
+            c.send({"action": "join_room", "room_name": name})
+    return groups, room_names
+
+
+# pylint: disable=too-many-locals
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    """Runs one load test and returns the summary."""
+    rng = random.Random(args.seed)
+    mix = parse_mix(args.mix)
+    port = args.port or free_port()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        proc = start_server(port, workdir)
+        clients: List[SimClient] = []
+        try:
+            for i in range(args.clients):
+                c = SimClient(f"user{i}", port)
+                c.login()
+                clients.append(c)
+            groups, rooms = setup_social(clients, args.group_size, args.rooms)
+            member_group = {c.name: groups[i // args.group_size] for i, c in enumerate(clients)}
+            group_sizes = {g: list(member_group.values()).count(g) for g in groups}
+            time.sleep(0.5)
+            idle = process_stats(proc.pid)
+
+            expected = 0
+            interval = 1.0 / args.rate if args.rate else 0.0
+            start = time.perf_counter()
+            for n in range(args.messages * len(clients)):
+                sender = clients[n % len(clients)]
+                kind = rng.choices(list(mix), weights=list(mix.values()))[0]
+                if kind == "dm":
+                    # The server also delivers DMs addressed to the sender itself.
+                    to = rng.choice(clients).name
+                    expected += 1
+                elif kind == "group":
+                    to = member_group[sender.name]
+                    expected += group_sizes[to] - 1
+                else:
+                    to = rng.choice(rooms)
+                    expected += len(clients) - 1
+                sender.send({"action": "msg", "to": to, "text": f"{time.perf_counter()}|{'x' * args.size}"})
+                if interval:
+                    time.sleep(interval)
+            send_time = time.perf_counter() - start
+
+            deadline = time.time() + args.drain_timeout
+            while sum(c.received for c in clients) < expected and time.time() < deadline:
+                time.sleep(0.05)
+            total_time = time.perf_counter() - start
+            loaded = process_stats(proc.pid)
+        finally:
+            for c in clients:
+                c.close()
+            proc.kill()
+            proc.wait()
+
+    latencies = [lat for c in clients for lat in c.latencies]
+    delivered = len(latencies)
+    sent = args.messages * len(clients)
+    return {
+        "clients": len(clients),
+        "messages_sent": sent,
+        "deliveries_expected": expected,
+        "deliveries": delivered,
+        "send_rate_msgs_per_s": round(sent / send_time, 1),
+        "delivery_rate_per_s": round(delivered / total_time, 1),
+        "latency_p50_ms": _ms(percentile(latencies, 50)),
+        "latency_p99_ms": _ms(percentile(latencies, 99)),
+        "latency_max_ms": _ms(max(latencies) if latencies else None),
+        "server_rss_kb_idle": idle["rss_kb"],
+        "server_rss_kb_loaded": loaded["rss_kb"],
+        "server_threads": loaded["threads"],
+        "mix": args.mix,
+    }
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    """Converts seconds to rounded milliseconds."""
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def main() -> None:
+    """Parses arguments and runs the benchmark (or the server subprocess)."""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--messages", type=int, default=50, help="messages per client")
+    parser.add_argument("--mix", default="dm=6,group=3,room=1")
+    parser.add_argument("--group-size", type=int, default=5)
+    parser.add_argument("--rooms", type=int, default=2)
+    parser.add_argument("--size", type=int, default=64, help="payload padding in bytes")
+    parser.add_argument("--rate", type=float, default=0, help="total send rate cap (msgs/s)")
+    parser.add_argument("--drain-timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print machine-readable output")
+    parser.add_argument("--output", help="also write JSON results to this file")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.workdir)
+        return
+    emit(run(args), args.json, args.output)
+
+
+if __name__ == "__main__":
+    main()
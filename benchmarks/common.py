@@ -0,0 +1,46 @@
+"""
+Shared helpers for the benchmark modules: percentiles, process stats and output.
+"""
+
+import json
+from typing import Any, Dict, List, Optional, Sequence
+
+
+def percentile(values: Sequence[float], q: float) -> Optional[float]:
+    """Returns the q-th percentile (0-100) using nearest-rank, or None if empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def process_stats(pid: int) -> Dict[str, Optional[int]]:
+    """Returns RSS (KiB) and thread count of a process. Linux only; None elsewhere."""
+    stats: Dict[str, Optional[int]] = {"rss_kb": None, "threads": None}
+    try:
+        with open(f"/proc/{pid}/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    stats["rss_kb"] = int(line.split()[1])
+                elif line.startswith("Threads:"):
+                    stats["threads"] = int(line.split()[1])
+    except OSError:
+        pass
+    return stats
+
+
+def emit(results: Any, as_json: bool, output: Optional[str] = None) -> None:
+    """Prints results as JSON or a flat key/value listing and optionally saves JSON."""
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if as_json:
+        print(json.dumps(results, indent=2))
+        return
+    rows: List[Dict[str, Any]] = results if isinstance(results, list) else [results]
+    for row in rows:
+        width = max(len(k) for k in row)
+        for key, value in row.items():
+            print(f"{key:<{width}}  {value}")
+        print()
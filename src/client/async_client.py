@@ -0,0 +1,425 @@
+"""
+Asyncio client library.
+Offers the same operations as NetworkClient without threads, so one process
+can drive thousands of connections (bots, integration services). It uses the
+same frame codec, request ids and CryptoManager/E2EManager as the GUI client.
+"""
+
+import asyncio
+import itertools
+import time
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Set, Tuple, cast
+from src.common.protocol import (
+    HOST, PORT, COMPRESSION, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT,
+    async_receive_json, async_send_json
+)
+from src.common.crypto_utils import CryptoManager, E2EManager, E2E_PREFIX, KeyChanged
+from src.client.key_state import KeyStateMixin, load_device_id
+
+# pylint: disable=too-many-instance-attributes
+
+REQUEST_TIMEOUT: float = 10.0
+KEY_TIMEOUT: float = 5.0
+QUEUE_SIZE: int = 1000
+
+
+class RequestRejected(Exception):
+    """Raised when the server refuses a request (rate limit or overload)."""
+
+    def __init__(self, frame: Dict[str, Any]) -> None:
+        super().__init__(str(frame.get("msg", "Request rejected")))
+        self.reason: str = str(frame.get("reason", ""))
+        self.retry_after: float = float(frame.get("retry_after", 0))
+
+
+class AsyncNetworkClient(KeyStateMixin):
+    """
+    Asyncio counterpart of NetworkClient.
+
+    Every request method waits for the server's reply (or ack). Incoming
+    messages and data updates are exposed as async iterators:
+
+        async with AsyncNetworkClient() as client:
+            await client.connect("bot", "secret")
+            await client.send_message("alice", "hello")
+            async for msg in client.messages():
+                ...
+    """
+
+    def __init__(self, host: str = HOST, port: int = PORT, use_e2e: bool = True,  # pylint: disable=too-many-arguments
+                 queue_size: int = QUEUE_SIZE, *,
+                 heartbeat_interval: Optional[float] = HEARTBEAT_INTERVAL,
+                 heartbeat_timeout: float = HEARTBEAT_TIMEOUT) -> None:
+        """
+        Initializes the AsyncNetworkClient.
+
+        Args:
+            host: Server address.
+            port: Server port.
+            use_e2e: Whether to load an identity key and end-to-end encrypt DMs and groups.
+            queue_size: Decrypted messages and data updates buffered for messages()
+                and updates(). The reader never waits on them, so replies keep
+                resolving while the application lags: older data updates are
+                dropped (each is a full snapshot) and undecrypted message frames
+                wait in memory.
+            heartbeat_interval: Seconds of silence from the server before it is pinged
+                (None disables heartbeats).
+            heartbeat_timeout: Seconds of silence after which the connection is closed.
+        """
+        self.host: str = host
+        self.port: int = port
+        self.use_e2e: bool = use_e2e
+        self.username: str = ""
+        self.crypto: Optional[CryptoManager] = None
+        self.e2e: Optional[E2EManager] = None
+        self.no_e2e_peers: Set[str] = set()
+        self.untrusted_peers: Dict[str, str] = {}
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._tasks: List["asyncio.Task[None]"] = []
+        self._request_ids: Iterator[int] = itertools.count(1)
+        self._in_flight: Dict[int, "asyncio.Future[Dict[str, Any]]"] = {}
+        self._key_events: Dict[str, asyncio.Event] = {}
+        self.heartbeat_interval: Optional[float] = heartbeat_interval
+        self.heartbeat_timeout: float = heartbeat_timeout
+        self.last_received: float = time.monotonic()
+        # Raw msg frames in arrival order; decrypted by _process_messages. Unbounded:
+        # a reader waiting here could never deliver the key reply decryption awaits.
+        self._raw: "asyncio.Queue[Optional[Dict[str, Any]]]" = asyncio.Queue()
+        self._messages: "asyncio.Queue[Optional[Dict[str, Any]]]" = asyncio.Queue(queue_size)
+        self._updates: "asyncio.Queue[Optional[Dict[str, Any]]]" = asyncio.Queue(queue_size)
+
+    async def __aenter__(self) -> "AsyncNetworkClient":
+        return self
+
+    async def __aexit__(self, *exc: Any) -> None:
+        await self.close()
+
+    @property
+    def connected(self) -> bool:
+        """True while the connection is open."""
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self, username: str, password: str,
+                      is_register: bool = False, replace_key: bool = False) -> Tuple[bool, str]:
+        """
+        Connects, logs in (or registers) and starts the background reader.
+        A successful registration closes the connection, like NetworkClient.
+        `replace_key` registers this device's identity key even if the account
+        already has another one (see NetworkClient.connect).
+
+        Returns:
+            Tuple containing (Success Boolean, Message String).
+        """
+        clean = username.strip()
+        try:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+            if self.use_e2e:
+                self.e2e = E2EManager.load(clean)
+            self._tasks = [asyncio.create_task(self._read_loop()),
+                           asyncio.create_task(self._process_messages())]
+            payload: Dict[str, Any] = {
+                "action": "register" if is_register else "login",
+                "username": clean,
+                "password": password,
+                "compress": [COMPRESSION],
+                "device": load_device_id(clean),
+                "replace_key": replace_key
+            }
+            if self.e2e:
+                payload["public_key"] = self.e2e.public_key_string()
+            resp = await self.request(payload)
+        except (OSError, ConnectionError, asyncio.TimeoutError, RequestRejected) as e:
+            await self.close()
+            return False, str(e) or type(e).__name__
+
+        ok = resp.get("status") == "success"
+        if ok and self.e2e:
+            self.e2e.save()
+        if ok and not is_register:
+            self.username = clean
+            if self.heartbeat_interval:
+                self._tasks.append(asyncio.create_task(self._heartbeat()))
+        else:
+            await self.close()
+        return ok, str(resp.get("msg", "OK" if ok else "Error"))
+
+    async def close(self) -> None:
+        """Closes the connection and ends the message/update iterators."""
+        writer, self._writer = self._writer, None
+        if writer:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (OSError, ConnectionError):
+                pass
+        current = asyncio.current_task()
+        for task in self._tasks:
+            if task is not current:
+                task.cancel()
+        self._tasks = []
+        self._fail_in_flight()
+        if not self._messages.full():
+            self._messages.put_nowait(None)
+        self._push_update(None)
+
+    async def request(self, payload: Dict[str, Any],
+                      timeout: float = REQUEST_TIMEOUT) -> Dict[str, Any]:
+        """
+        Sends a request and waits for the frame that answers it.
+        Many requests may be awaited concurrently on one connection.
+
+        Raises:
+            ConnectionError: If the connection is closed before the reply.
+            asyncio.TimeoutError: If no reply arrives within `timeout` seconds.
+            RequestRejected: If the server answers with an error frame.
+        """
+        if not self._writer:
+            raise ConnectionError("Not connected")
+        req_id = next(self._request_ids)
+        future: "asyncio.Future[Dict[str, Any]]" = asyncio.get_running_loop().create_future()
+        self._in_flight[req_id] = future
+        try:
+            await async_send_json(self._writer, {**payload, "id": req_id})
+            reply = await asyncio.wait_for(future, timeout)
+        finally:
+            self._in_flight.pop(req_id, None)
+        if reply.get("action") == "error":
+            raise RequestRejected(reply)
+        return reply
+
+    async def refresh_data(self) -> Dict[str, Any]:
+        """Returns the data_update frame (friends, groups, requests, active users, rooms)."""
+        return await self.request({"action": "get_data"})
+
+    async def get_chat_history(self, target: str, limit: Optional[int] = None,
+                               before: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Returns the decrypted history of a chat, oldest first. Each message
+        carries its "id"; pass the oldest one as `before` to page back.
+
+        Args:
+            target: User, #group or &room.
+            limit: Only the newest `limit` messages; all of them if None.
+            before: Only messages older than this message id.
+        """
+        page = {"limit": limit, "before": before}
+        req = {"action": "get_history", "target": target,
+               **{k: v for k, v in page.items() if v is not None}}
+        resp = await self.request(req)
+        msgs = cast(List[Dict[str, Any]], resp.get("messages", []))
+        pairs = [(str(m.get("text", "")),
+                  self._key_name(str(m.get("sender", "")), str(m.get("to", ""))))
+                 for m in msgs]
+        for name in {k for t, k in pairs if t.startswith(E2E_PREFIX)}:
+            await self._ensure_key(name)
+        for m, text in zip(msgs, self._decrypt_batch(pairs)):
+            m["text"] = text
+        return msgs
+
+    async def send_friend_request(self, target: str) -> None:
+        """Sends a friend request to the target user."""
+        await self.request({"action": "send_friend_request", "target": target.strip()})
+
+    async def handle_request(self, sender: str, decision: str) -> None:
+        """Accepts or declines a friend request ('accept' or 'decline')."""
+        await self.request({"action": "handle_request", "sender": sender, "decision": decision})
+
+    async def create_group(self, name: str) -> str:
+        """Creates a private group and shares a fresh group key. Returns the #name."""
+        name = name.strip()
+        name = name if name.startswith("#") else "#" + name
+        await self.request({"action": "create_group", "group_name": name})
+        if self.e2e:
+            self.e2e.new_group_key(name)
+            await self.request({
+                "action": "share_group_key",
+                "group_name": name,
+                "keys": {self.username: self.e2e.wrap_group_key(name, self.username)}
+            })
+        return name
+
+    async def join_group(self, name: str) -> str:
+        """Joins a private group. Returns the #name."""
+        name = name.strip()
+        name = name if name.startswith("#") else "#" + name
+        if self.e2e:
+            self.e2e.forget_group(name)
+        await self.request({"action": "join_group", "group_name": name})
+        return name
+
+    async def create_public_room(self, name: str, tags: str) -> str:
+        """Creates a public room with tags. Returns the &name."""
+        name = name.strip()
+        name = name if name.startswith("&") else "&" + name
+        await self.request({"action": "create_public_room", "room_name": name, "tags": tags.strip()})
+        return name
+
+    async def join_room(self, name: str) -> str:
+        """Subscribes to a public room's messages. Returns the &name."""
+        name = name.strip()
+        name = name if name.startswith("&") else "&" + name
+        await self.request({"action": "join_room", "room_name": name})
+        return name
+
+    async def leave_room(self, name: str) -> None:
+        """Unsubscribes from a public room."""
+        name = name.strip()
+        name = name if name.startswith("&") else "&" + name
+        await self.request({"action": "leave_room", "room_name": name})
+
+    async def send_message(self, recipient: str, text: str) -> None:
+        """
+        Encrypts and sends a message. DMs and groups are end-to-end encrypted,
+        fetching the peer or group key first if needed; public rooms and peers
+        without a registered key use the server key.
+
+        Raises:
+            LookupError: If the group key could not be obtained in time.
+            KeyChanged: If the peer's identity key differs from the pinned one
+                (or was removed); trust_peer_key accepts the new key.
+        """
+        if not text:
+            return
+        use_e2e = not recipient.startswith("&") and bool(self.e2e) and await self._ensure_key(recipient)
+        if recipient in self.untrusted_peers:
+            raise KeyChanged(recipient, self.untrusted_peers[recipient])
+        if not use_e2e:
+            if recipient.startswith("#") and self.e2e:
+                raise LookupError(f"No key for {recipient}")
+            encrypted = self.crypto.encrypt_message(text) if self.crypto else text
+        else:
+            encrypted = self._e2e_encrypt(recipient, text)
+        await self.request({"action": "msg", "to": recipient, "text": encrypted})
+
+    async def messages(self) -> AsyncIterator[Dict[str, Any]]:
+        """Yields incoming messages (decrypted) until the connection closes."""
+        while True:
+            msg = await self._messages.get()
+            if msg is None:
+                return
+            yield msg
+
+    async def updates(self) -> AsyncIterator[Dict[str, Any]]:
+        """Yields data_update frames pushed by the server until the connection closes."""
+        while True:
+            data = await self._updates.get()
+            if data is None:
+                return
+            yield data
+
+    async def _ensure_key(self, name: str) -> bool:
+        """
+        Fetches a peer's public key or this user's wrapped group key if unknown.
+        Returns False if none is available (peer without E2E, or group key not shared yet).
+        """
+        if self._has_key(name):
+            return True
+        if name in self.no_e2e_peers or not self.e2e:
+            return False
+        if name.startswith("#"):
+            event = self._key_events.setdefault(name, asyncio.Event())
+            await self.request({"action": "get_group_key", "group_name": name})
+            if not self._has_key(name):
+                # Not stored yet: online members were asked to wrap it for us.
+                try:
+                    await asyncio.wait_for(event.wait(), KEY_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+        else:
+            await self.request({"action": "get_public_key", "target": name})
+        return self._has_key(name)
+
+    async def _read_loop(self) -> None:
+        """Reads frames, applies key/auth frames, resolves requests and queues pushes."""
+        try:
+            while self._reader:
+                data = await async_receive_json(self._reader)
+                if data is None:
+                    break
+                self.last_received = time.monotonic()
+                await self._dispatch(data)
+        finally:
+            self._fail_in_flight()
+            self._raw.put_nowait(None)
+            self._push_update(None)
+
+    async def _dispatch(self, data: Dict[str, Any]) -> None:
+        """
+        Handles one frame, then completes the request it answers. Never waits
+        on the application's queues, so a slow consumer cannot stall replies.
+        """
+        action = data.get("action")
+        if "status" in data:
+            self._apply_login(data)
+        elif action == "msg":
+            self._raw.put_nowait(data)
+        elif action == "offline_messages":
+            # Messages missed while this device was offline, oldest first.
+            for m in data.get("messages", []):
+                self._raw.put_nowait({"action": "msg", **m})
+        elif action == "data_update":
+            self.no_e2e_peers.clear()
+            if "id" not in data:
+                self._push_update(data)
+        elif action in ("public_key", "group_key", "group_key_needed"):
+            await self._handle_key_frame(data)
+        elif action == "ping" and self._writer:
+            await async_send_json(self._writer, {"action": "pong"})
+
+        future = self._in_flight.get(data.get("id", -1))
+        if future and not future.done():
+            future.set_result(data)
+
+    def _push_update(self, data: Optional[Dict[str, Any]]) -> None:
+        """Queues a data update, dropping the oldest one if updates() lags behind."""
+        if self._updates.full():
+            self._updates.get_nowait()
+        self._updates.put_nowait(data)
+
+    async def _heartbeat(self) -> None:
+        """Pings a quiet server and closes the connection if it stays silent too long."""
+        interval = self.heartbeat_interval or HEARTBEAT_INTERVAL
+        while self._writer:
+            await asyncio.sleep(interval / 3)
+            idle = time.monotonic() - self.last_received
+            if idle >= self.heartbeat_timeout:
+                await self.close()
+                return
+            if idle >= interval and self._writer:
+                try:
+                    await async_send_json(self._writer, {"action": "ping"})
+                except (OSError, ConnectionError):
+                    pass
+
+    async def _handle_key_frame(self, data: Dict[str, Any]) -> None:
+        """Processes public_key, group_key and group_key_needed frames."""
+        available, reply = self._apply_key_frame(data)
+        if reply and self._writer:
+            # Sent without an id: the reader must not wait on its own reply.
+            await async_send_json(self._writer, reply)
+        if available and available.startswith("#"):
+            self._key_events.setdefault(available, asyncio.Event()).set()
+
+    async def _process_messages(self) -> None:
+        """Decrypts incoming messages in order, fetching missing keys as needed."""
+        while True:
+            data = await self._raw.get()
+            if data is None:
+                await self._messages.put(None)
+                return
+            text = str(data.get("text", ""))
+            key_name = self._key_name(str(data.get("sender", "")), str(data.get("to", "")))
+            if text.startswith(E2E_PREFIX):
+                try:
+                    await self._ensure_key(key_name)
+                except (ConnectionError, asyncio.TimeoutError, RequestRejected):
+                    pass
+            data["text"] = self._decrypt_batch([(text, key_name)])[0]
+            await self._messages.put(data)
+
+    def _fail_in_flight(self) -> None:
+        """Fails every request still waiting when the connection ends."""
+        for future in self._in_flight.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Connection closed"))
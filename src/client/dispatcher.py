@@ -0,0 +1,103 @@
+"""
+Main-thread dispatcher for the GUI.
+Collects events posted by the network listener thread and applies them
+on the Tk main loop at a fixed frame rate, coalescing bursts.
+"""
+
+import queue
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+FRAME_INTERVAL_MS: int = 33
+
+Scheduler = Callable[[int, Callable[[], None]], Any]
+
+
+class UIDispatcher:
+    """
+    Thread-safe event queue drained on the GUI thread via `after()`.
+
+    Consecutive `msg` lines for the same conversation are merged into one
+    insert per frame and repeated `data_update` snapshots collapse into the
+    latest one. History responses are applied in arrival order.
+    """
+
+    def __init__(self,
+                 schedule: Scheduler,
+                 on_lines: Callable[[str, str], None],
+                 on_data: Callable[..., None],
+                 on_history: Callable[[str, List[Dict[str, Any]]], None],
+                 interval_ms: int = FRAME_INTERVAL_MS) -> None:
+        """
+        Initializes the UIDispatcher.
+
+        Args:
+            schedule: Tk-style `after(ms, func)` used to re-arm the drain loop.
+            on_lines: Main-thread handler receiving (conversation, text block).
+            on_data: Main-thread handler receiving the latest data snapshot.
+            on_history: Main-thread handler receiving (target, messages).
+            interval_ms: Delay between two drains.
+        """
+        self._schedule: Scheduler = schedule
+        self._on_lines: Callable[[str, str], None] = on_lines
+        self._on_data: Callable[..., None] = on_data
+        self._on_history: Callable[[str, List[Dict[str, Any]]], None] = on_history
+        self.interval_ms: int = interval_ms
+        self._events: "queue.SimpleQueue[Tuple[str, str, Any]]" = queue.SimpleQueue()
+        self.running: bool = False
+
+    def start(self) -> None:
+        """Arms the periodic drain loop."""
+        if not self.running:
+            self.running = True
+            self._schedule(self.interval_ms, self._tick)
+
+    def stop(self) -> None:
+        """Stops re-arming the drain loop after the next tick."""
+        self.running = False
+
+    def post_message(self, conversation: str, line: str) -> None:
+        """Queues a formatted chat line for a conversation. Safe from any thread."""
+        self._events.put(("msg", conversation, line))
+
+    def post_data(self, *snapshot: Any) -> None:
+        """Queues a data_update snapshot. Safe from any thread."""
+        self._events.put(("data", "", snapshot))
+
+    def post_history(self, target: str, messages: List[Dict[str, Any]]) -> None:
+        """Queues a history response. Safe from any thread."""
+        self._events.put(("history", target, messages))
+
+    def _tick(self) -> None:
+        """Drains pending events and re-arms the loop."""
+        try:
+            self.drain()
+        finally:
+            if self.running:
+                self._schedule(self.interval_ms, self._tick)
+
+    def drain(self) -> None:
+        """Applies every queued event on the calling (main) thread."""
+        pending: Dict[str, List[str]] = {}
+        latest_data: Optional[Tuple[Any, ...]] = None
+
+        while True:
+            try:
+                kind, key, payload = self._events.get_nowait()
+            except queue.Empty:
+                break
+
+            if kind == "msg":
+                pending.setdefault(key, []).append(payload)
+            elif kind == "data":
+                latest_data = payload
+            elif kind == "history":
+                # Lines received before the history belong in front of it.
+                if key in pending:
+                    self._on_lines(key, "".join(pending.pop(key)))
+                self._on_history(key, payload)
+
+        for conversation, lines in pending.items():
+            self._on_lines(conversation, "".join(lines))
+
+        if latest_data is not None:
+            self._on_data(*latest_data)
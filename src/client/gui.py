@@ -3,10 +3,14 @@ Main GUI module for the Secure Messenger client using CustomTkinter.
 """
 
 import os
-from typing import List, Dict, Any, Optional, Tuple
+from tkinter import messagebox
+from typing import List, Dict, Any, Optional, Set, Tuple
 from PIL import Image
 import customtkinter as ctk
-from src.client.network import NetworkClient
+from src.client.network import NetworkClient, HISTORY_PAGE_SIZE
+from src.client.dispatcher import UIDispatcher
+from src.client.widget_list import KeyedWidgetList, RowKind, Row
+from src.client.room_index import RoomIndex
 
 # --- COLORS ---
 COLOR_BG: str = "#1a1a1a"
@@ -18,10 +22,17 @@ COLOR_GREEN: str = "#2ecc71"
 COLOR_RED: str = "#e74c3c"
 MY_FONT: str = "Verdana"
 
+# --- PUBLIC ROOM FILTER ---
+FILTER_DEBOUNCE_MS: int = 150
+FILTER_MAX_RESULTS: int = 200
+FILTER_RENDER_CHUNK: int = 50
+# Chats prefetched per data update; keeps room in the get_history rate limit.
+PREFETCH_HISTORY_LIMIT: int = 5
+
 ctk.set_appearance_mode("Dark")
 ctk.set_default_color_theme("dark-blue")
 
-# pylint: disable=too-many-instance-attributes
+# pylint: disable=too-many-instance-attributes, too-many-public-methods
 
 
 class MessengerApp(ctk.CTk):  # type: ignore[misc]
@@ -36,12 +47,24 @@ class MessengerApp(ctk.CTk):  # type: ignore[misc]
         self.geometry("1100x700")
         self.configure(fg_color=COLOR_BG)
 
+        self.dispatcher: UIDispatcher = UIDispatcher(
+            self.after, self.append_msg, self.update_data, self.on_history_loaded
+        )
         self.client: NetworkClient = NetworkClient(
-            self.on_message, self.update_data, self.on_history_loaded
+            self.queue_message, self.dispatcher.post_data, self.dispatcher.post_history,
+            on_error_callback=self.queue_error
         )
         self.current_chat_target: Optional[str] = None
         self.chat_history: Dict[str, str] = {}
+        # Id of the oldest loaded message per chat, and chats with nothing older.
+        self.oldest_loaded: Dict[str, int] = {}
+        self.history_exhausted: Set[str] = set()
+        self.prefetched: Set[str] = set()
+        self.joined_rooms: Set[str] = set()
         self.all_public_rooms: List[Tuple[str, str]] = []
+        self.room_index: RoomIndex = RoomIndex()
+        self._filter_job: Optional[str] = None
+        self._render_generation: int = 0
 
         self.load_resources()
 
@@ -53,6 +76,8 @@ class MessengerApp(ctk.CTk):  # type: ignore[misc]
 
         self.build_login_screen()
         self.build_main_app_screen()
+        self.build_row_lists()
+        self.dispatcher.start()
 
     def load_resources(self) -> None:
         """Loads images and assets from the assets directory."""
@@ -157,7 +182,7 @@ class MessengerApp(ctk.CTk):  # type: ignore[misc]
 
         self.tag_search = ctk.CTkEntry(self.tab_public, placeholder_text="🔍 Filter by tag...")
         self.tag_search.pack(fill="x", padx=2, pady=5)
-        self.tag_search.bind("<KeyRelease>", lambda _e: self.filter_public_rooms())
+        self.tag_search.bind("<KeyRelease>", lambda _e: self.schedule_filter())
 
         self.public_list_scroll = ctk.CTkScrollableFrame(self.tab_public, fg_color="transparent")
         self.public_list_scroll.pack(fill="both", expand=True)
@@ -187,6 +212,10 @@ class MessengerApp(ctk.CTk):  # type: ignore[misc]
             self.right_panel, text="...", font=(MY_FONT, 24, "bold"), text_color="gray"
         )
         self.chat_header.pack(pady=20)
+        ctk.CTkButton(
+            self.right_panel, text="↑ Older messages", command=self.load_older_history,
+            height=25, fg_color="transparent", border_width=1
+        ).pack(padx=20, anchor="w")
         self.chat_box = ctk.CTkTextbox(
             self.right_panel, state="disabled", font=(MY_FONT, 14), fg_color="#222"
         )
@@ -200,6 +229,27 @@ class MessengerApp(ctk.CTk):  # type: ignore[misc]
             inp, text="SEND", width=100, command=self.send_msg, fg_color=COLOR_ACCENT
         ).pack(side="right", padx=5)
 
+    def build_row_lists(self) -> None:
+        """Sets up keyed row reconciliation for the side lists."""
+        self.chat_rows = KeyedWidgetList(self.my_chats_scroll, {
+            "invites_header": RowKind(self._make_label, self._update_label, {}),
+            "header": RowKind(self._make_label, self._update_label, {"pady": 5}),
+            "request": RowKind(self._make_request_row, self._update_request_row,
+                               {"fill": "x", "pady": 2}),
+            "group": RowKind(self._make_group_button, self._update_group_button,
+                             {"fill": "x", "pady": 2}),
+            "friend": RowKind(self._make_friend_button, self._update_friend_button,
+                              {"fill": "x", "pady": 2}),
+        })
+        self.public_rows = KeyedWidgetList(self.public_list_scroll, {
+            "room": RowKind(self._make_room_button, self._update_room_button,
+                            {"fill": "x", "pady": 2}),
+        })
+        self.online_rows = KeyedWidgetList(self.online_scroll, {
+            "user": RowKind(self._make_online_label, self._update_label,
+                            {"fill": "x", "padx": 10}),
+        })
+
     def login(self) -> None:
         """Handles login action."""
         u = self.user_entry.get().strip()
@@ -259,47 +309,101 @@ class MessengerApp(ctk.CTk):  # type: ignore[misc]
             self.pub_tags_ent.delete(0, "end")
 
     def select_chat(self, target: str) -> None:
-        """Selects a chat, displays cached history, and requests full history."""
+        """Selects a chat, displays cached history, and requests the newest page."""
         self.current_chat_target = target
         self.chat_header.configure(text=target, text_color=COLOR_ACCENT)
         self.chat_box.configure(state="normal")
         self.chat_box.delete("1.0", "end")
         self.chat_box.insert("end", self.chat_history.get(target, "Loading history...\n"))
         self.chat_box.configure(state="disabled")
-        self.client.get_chat_history(target)
+        if target.startswith("&") and target not in self.joined_rooms:
+            # Opening a public room subscribes to its messages.
+            self.joined_rooms.add(target)
+            self.client.join_room(target)
+        self.client.get_chat_history(target, HISTORY_PAGE_SIZE)
+
+    def load_older_history(self) -> None:
+        """Requests the page of messages before the oldest one shown."""
+        target = self.current_chat_target
+        if target and target in self.oldest_loaded and target not in self.history_exhausted:
+            self.client.get_chat_history(target, HISTORY_PAGE_SIZE, self.oldest_loaded[target])
 
     def on_history_loaded(self, target: str, messages: List[Dict[str, Any]]) -> None:
-        """Callback when history is received from server."""
+        """
+        Callback when history is received from server. A page older than
+        everything loaded is put in front; the newest page replaces the chat.
+        """
         history_text = ""
         for m in messages:
             s, t = m.get("sender"), m.get("text")
             history_text += f"[{s}]: {t}\n"
 
+        ids = [int(m["id"]) for m in messages if "id" in m]
+        oldest = self.oldest_loaded.get(target)
+        older_page = oldest is not None and (not ids or max(ids) < oldest)
+        if older_page:
+            history_text += self.chat_history.get(target, "")
+        if ids:
+            self.oldest_loaded[target] = min(ids)
+        if len(messages) < HISTORY_PAGE_SIZE:
+            self.history_exhausted.add(target)
+        elif not older_page:
+            self.history_exhausted.discard(target)
+
         self.chat_history[target] = history_text
         if self.current_chat_target == target:
             self.chat_box.configure(state="normal")
             self.chat_box.delete("1.0", "end")
             self.chat_box.insert("end", history_text)
-            self.chat_box.see("end")
+            self.chat_box.see("1.0" if older_page else "end")
             self.chat_box.configure(state="disabled")
 
     def send_msg(self) -> None:
         """Sends a message to the current target."""
         t = self.msg_entry.get()
         if t and self.current_chat_target:
+            if not self.confirm_key_change(self.current_chat_target):
+                return
             self.client.send_message(self.current_chat_target, t)
             self.append_msg(self.current_chat_target, f"Me: {t}\n")
             self.msg_entry.delete(0, "end")
 
-    def on_message(self, d: Dict[str, Any]) -> None:
-        """Callback when a real-time message is received."""
+    def confirm_key_change(self, target: str) -> bool:
+        """Asks before sending to a peer whose identity key changed or was removed."""
+        if target not in self.client.untrusted_peers:
+            return True
+        change = "changed" if self.client.untrusted_peers[target] else "was removed"
+        if messagebox.askyesno("Identity key changed",
+                               f"The encryption key of {target} {change}. This happens when "
+                               f"they use a new device, or when someone is intercepting the "
+                               f"chat.\n\nTrust the new key and send?"):
+            return self.client.trust_peer_key(target)
+        return False
+
+    def format_message(self, d: Dict[str, Any]) -> Tuple[str, str]:
+        """Returns the conversation a message belongs to and its display line."""
         s = str(d.get("sender", "Unknown"))
         to = str(d.get("to", ""))
         t = str(d.get("text", ""))
         context = to if to and (to.startswith("#") or to.startswith("&")) else s
         if s == self.client.username:
             context = to
-        self.append_msg(context, f"[{s}]: {t}\n")
+        return context, f"[{s}]: {t}\n"
+
+    def queue_message(self, d: Dict[str, Any]) -> None:
+        """Network-thread callback: hands a message to the main-thread dispatcher."""
+        self.dispatcher.post_message(*self.format_message(d))
+
+    def queue_error(self, request: Dict[str, Any], error: Dict[str, Any]) -> None:
+        """Network-thread callback: shows a refused request in its conversation."""
+        reason = str(error.get("msg") or error.get("reason") or "error")
+        if request.get("action") == "msg":
+            self.dispatcher.post_message(str(request.get("to", "")), f"[not sent: {reason}]\n")
+            return
+        conversation = str(request.get("target") or self.current_chat_target or "")
+        if conversation:
+            self.dispatcher.post_message(conversation, f"[{request.get('action', 'request')} "
+                                                       f"failed: {reason}]\n")
 
     def append_msg(self, c: str, t: str) -> None:
         """Appends a message to the chat view and history cache."""
@@ -316,59 +420,123 @@ class MessengerApp(ctk.CTk):  # type: ignore[misc]
     def update_data(self, fr: List[str], gr: List[str], req: List[str],
                     act: List[str], pub: List[Tuple[str, str]]) -> None:
         """Updates the UI lists based on server data."""
-        for w in self.my_chats_scroll.winfo_children():
-            w.destroy()
+        rows: List[Row] = []
         if req:
-            ctk.CTkLabel(self.my_chats_scroll, text="🔔 INVITES", text_color="#f1c40f").pack()
-            for r in req:
-                f = ctk.CTkFrame(self.my_chats_scroll, fg_color="#333")
-                f.pack(fill="x", pady=2)
-                ctk.CTkLabel(f, text=r).pack(side="left", padx=5)
-                ctk.CTkButton(
-                    f, text="✘", width=30, fg_color=COLOR_RED,
-                    command=lambda s=r: self.client.handle_request(s, "decline")
-                ).pack(side="right")
-                ctk.CTkButton(
-                    f, text="✔", width=30, fg_color=COLOR_GREEN,
-                    command=lambda s=r: self.client.handle_request(s, "accept")
-                ).pack(side="right")
+            rows.append(("invites_header", "", ("🔔 INVITES", "#f1c40f")))
+            rows.extend(("request", r, r) for r in req)
         if gr:
-            ctk.CTkLabel(self.my_chats_scroll, text="--- Groups ---").pack(pady=5)
-            for g in gr:
-                ctk.CTkButton(
-                    self.my_chats_scroll, text=f" {g}", fg_color="#444",
-                    anchor="w", command=lambda x=g: self.select_chat(x)
-                ).pack(fill="x", pady=2)
+            rows.append(("header", "groups", ("--- Groups ---", None)))
+            rows.extend(("group", g, g) for g in gr)
         if fr:
-            ctk.CTkLabel(self.my_chats_scroll, text="--- Friends ---").pack(pady=5)
-            for f in fr:
-                ctk.CTkButton(
-                    self.my_chats_scroll, text=f"  {f}", fg_color="transparent",
-                    border_width=1, anchor="w", command=lambda x=f: self.select_chat(x)
-                ).pack(fill="x", pady=2)
-
-        for w in self.online_scroll.winfo_children():
-            w.destroy()
-        for u in act:
-            c = COLOR_GREEN if u != self.client.username else "gray"
-            ctk.CTkLabel(
-                self.online_scroll, text=f"● {u}", text_color=c, anchor="w"
-            ).pack(fill="x", padx=10)
-
-        self.all_public_rooms = pub
+            rows.append(("header", "friends", ("--- Friends ---", None)))
+            rows.extend(("friend", f, f) for f in fr)
+        self.chat_rows.reconcile(rows)
+        self.prefetch_histories(gr + fr)
+
+        self.online_rows.reconcile([
+            ("user", u, (f"● {u}", COLOR_GREEN if u != self.client.username else "gray"))
+            for u in act
+        ])
+
+        self.set_public_rooms(pub)
+
+    def prefetch_histories(self, targets: List[str]) -> None:
+        """Loads a few not-yet-opened chats in parallel so opening them is instant."""
+        new = [t for t in targets if t not in self.chat_history and t not in self.prefetched]
+        if new:
+            batch = new[:PREFETCH_HISTORY_LIMIT]
+            self.prefetched.update(batch)
+            self.client.prefetch_histories(batch)
+
+    def set_public_rooms(self, pub: List[Tuple[str, str]]) -> None:
+        """Stores the room list, re-indexes it if it changed and refreshes the view."""
+        if pub != self.all_public_rooms:
+            self.all_public_rooms = pub
+            self.room_index.build(pub)
         self.filter_public_rooms()
 
+    def schedule_filter(self) -> None:
+        """Debounces filtering so it runs once typing pauses."""
+        if self._filter_job is not None:
+            self.after_cancel(self._filter_job)
+        self._filter_job = self.after(FILTER_DEBOUNCE_MS, self.filter_public_rooms)
+
     def filter_public_rooms(self) -> None:
         """Filters the public rooms list based on the search tag."""
-        q = self.tag_search.get().lower()
-        for w in self.public_list_scroll.winfo_children():
-            w.destroy()
-        for n, t in self.all_public_rooms:
-            if not q or (q in t.lower()):
-                ctk.CTkButton(
-                    self.public_list_scroll, text=f"{n}\n{t}", fg_color="#e67e22",
-                    anchor="w", command=lambda x=n: self.select_chat(x)
-                ).pack(fill="x", pady=2)
+        self._filter_job = None
+        matches = self.room_index.search(self.tag_search.get(), FILTER_MAX_RESULTS)
+        rows: List[Row] = [("room", n, (n, t)) for n, t in matches]
+        self._render_generation += 1
+        self._render_rooms(rows, FILTER_RENDER_CHUNK, self._render_generation)
+
+    def _render_rooms(self, rows: List[Row], count: int, generation: int) -> None:
+        """Shows the first `count` rows and schedules the next chunk."""
+        if generation != self._render_generation:
+            return
+        self.public_rows.reconcile(rows[:count])
+        if count < len(rows):
+            self.after(0, lambda: self._render_rooms(
+                rows, count + FILTER_RENDER_CHUNK, generation))
+
+    # --- ROW BUILDERS (used by KeyedWidgetList) ---
+
+    def _make_label(self, parent: Any) -> Any:
+        """Creates a plain list label."""
+        return ctk.CTkLabel(parent, text="")
+
+    def _make_online_label(self, parent: Any) -> Any:
+        """Creates a label for the online users list."""
+        return ctk.CTkLabel(parent, text="", anchor="w")
+
+    def _update_label(self, w: Any, data: Tuple[str, Optional[str]]) -> None:
+        """Sets the text and colour of a label row."""
+        text, color = data
+        if color:
+            w.configure(text=text, text_color=color)
+        else:
+            w.configure(text=text)
+
+    def _make_request_row(self, parent: Any) -> Any:
+        """Creates a friend request row with accept/decline buttons."""
+        f = ctk.CTkFrame(parent, fg_color="#333")
+        f.name_label = ctk.CTkLabel(f, text="")
+        f.name_label.pack(side="left", padx=5)
+        f.decline_btn = ctk.CTkButton(f, text="✘", width=30, fg_color=COLOR_RED)
+        f.decline_btn.pack(side="right")
+        f.accept_btn = ctk.CTkButton(f, text="✔", width=30, fg_color=COLOR_GREEN)
+        f.accept_btn.pack(side="right")
+        return f
+
+    def _update_request_row(self, f: Any, r: str) -> None:
+        """Binds a request row to the given sender."""
+        f.name_label.configure(text=r)
+        f.decline_btn.configure(command=lambda s=r: self.client.handle_request(s, "decline"))
+        f.accept_btn.configure(command=lambda s=r: self.client.handle_request(s, "accept"))
+
+    def _make_group_button(self, parent: Any) -> Any:
+        """Creates a group chat button."""
+        return ctk.CTkButton(parent, text="", fg_color="#444", anchor="w")
+
+    def _make_friend_button(self, parent: Any) -> Any:
+        """Creates a friend chat button."""
+        return ctk.CTkButton(parent, text="", fg_color="transparent", border_width=1, anchor="w")
+
+    def _update_group_button(self, b: Any, g: str) -> None:
+        """Binds a group button to its group chat."""
+        b.configure(text=f" {g}", command=lambda x=g: self.select_chat(x))
+
+    def _update_friend_button(self, b: Any, f: str) -> None:
+        """Binds a friend button to its direct chat."""
+        b.configure(text=f"  {f}", command=lambda x=f: self.select_chat(x))
+
+    def _make_room_button(self, parent: Any) -> Any:
+        """Creates a public room button."""
+        return ctk.CTkButton(parent, text="", fg_color="#e67e22", anchor="w")
+
+    def _update_room_button(self, b: Any, data: Tuple[str, str]) -> None:
+        """Binds a public room button to its room."""
+        n, t = data
+        b.configure(text=f"{n}\n{t}", command=lambda x=n: self.select_chat(x))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,172 @@
+"""
+Key handling shared by the threaded and asyncio clients: which key protects
+a message, decryption with E2E or server keys, and applying key frames.
+"""
+
+import os
+import uuid
+from typing import Any, Dict, List, Optional, Set, Tuple
+from src.common import crypto_utils
+from src.common.crypto_utils import (
+    CryptoManager, E2EManager, E2E_PREFIX, DECRYPTION_ERROR, KeyChanged
+)
+
+
+def load_device_id(username: str) -> str:
+    """
+    Returns this machine's device id for a user, creating it on first use.
+    The server keeps a per-device cursor so each device catches up on the
+    messages it missed while offline.
+    """
+    path = os.path.join(crypto_utils.IDENTITY_DIR, f"{username}.device")
+    if os.path.exists(path):
+        with open(path, encoding="ascii") as f:
+            device = f.read().strip()
+        if device:
+            return device
+    device = uuid.uuid4().hex
+    os.makedirs(crypto_utils.IDENTITY_DIR, exist_ok=True)
+    with open(path, "w", encoding="ascii") as f:
+        f.write(device)
+    return device
+
+
+class KeyStateMixin:  # pylint: disable=too-few-public-methods
+    """
+    Holds the server key, the E2E identity and peer/group keys of a client.
+    Subclasses do the I/O; these methods only read and update key state.
+    """
+
+    username: str
+    crypto: Optional[CryptoManager]
+    e2e: Optional[E2EManager]
+    # Peers without a registered public key (legacy clients) use the server key.
+    no_e2e_peers: Set[str]
+    # Pinned peers whose key the server now reports differently ("" if removed).
+    untrusted_peers: Dict[str, str]
+
+    def trust_peer_key(self, peer: str) -> bool:
+        """
+        Accepts the changed (or removed) key of a peer in untrusted_peers, after
+        the user has verified it. Returns False if the peer's key had not changed.
+        """
+        if peer not in self.untrusted_peers or not self.e2e:
+            return False
+        public_key = self.untrusted_peers.pop(peer)
+        self.e2e.replace_peer_key(peer, public_key)
+        if not public_key:
+            self.no_e2e_peers.add(peer)
+        return True
+
+    def _set_peer_key(self, peer: str, public_key: str) -> bool:
+        """Stores a peer key unless it differs from the pinned one. Returns success."""
+        if not self.e2e:
+            return False
+        try:
+            self.e2e.set_peer_key(peer, public_key)
+        except KeyChanged:
+            self.untrusted_peers[peer] = public_key
+            return False
+        self.untrusted_peers.pop(peer, None)
+        return True
+
+    def _has_key(self, name: str) -> bool:
+        """Checks whether the E2E key for a peer or #group is available."""
+        if not self.e2e:
+            return False
+        return self.e2e.has_group(name) if name.startswith("#") else self.e2e.has_peer(name)
+
+    def _key_name(self, sender: str, to: str) -> str:
+        """Returns the peer or group whose key protects a message."""
+        if to.startswith("#") or to.startswith("&"):
+            return to
+        return sender if sender != self.username else to
+
+    def _e2e_encrypt(self, recipient: str, text: str) -> str:
+        """Encrypts for a peer or group whose key is known."""
+        if not self.e2e:
+            return ""
+        if recipient.startswith("#"):
+            return self.e2e.encrypt_for_group(recipient, text)
+        return self.e2e.encrypt_for(recipient, text)
+
+    def _decrypt(self, text: str, key_name: str) -> str:
+        """Decrypts E2E tokens with the peer/group key and others with the server key."""
+        if text.startswith(E2E_PREFIX) and self.e2e:
+            if key_name.startswith("#"):
+                return self.e2e.decrypt_for_group(key_name, text)
+            return self.e2e.decrypt_from(key_name, text)
+        if self.crypto:
+            return self.crypto.decrypt_message(text)
+        return text
+
+    def _decrypt_batch(self, pairs: List[Tuple[str, str]]) -> List[str]:
+        """
+        Decrypts (text, key_name) pairs. Server-key tokens go through one bulk
+        call; E2E tokens use their cached per-peer/group cipher.
+        """
+        result = [""] * len(pairs)
+        server_idx: List[int] = []
+        for i, (text, key_name) in enumerate(pairs):
+            if text.startswith(E2E_PREFIX) and self.e2e:
+                result[i] = self._decrypt(text, key_name)
+            else:
+                server_idx.append(i)
+
+        if server_idx:
+            texts = [pairs[i][0] for i in server_idx]
+            plain = self.crypto.decrypt_many(texts) if self.crypto else list(texts)
+            for i, plain_text in zip(server_idx, plain):
+                result[i] = DECRYPTION_ERROR if plain_text is None else plain_text
+        return result
+
+    def _apply_login(self, data: Dict[str, Any]) -> None:
+        """Installs the server key from a successful login/register response."""
+        key = data.get("key")
+        if data.get("status") == "success" and key and isinstance(key, str):
+            self.crypto = CryptoManager(key.encode('utf-8'))
+
+    def _apply_key_frame(self, data: Dict[str, Any]) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        """
+        Applies a public_key, group_key or group_key_needed frame.
+
+        Returns:
+            Tuple of (peer/group whose key lookup completed, frame to send back).
+        """
+        if not self.e2e:
+            return None, None
+        action = data.get("action")
+        if action == "public_key":
+            target = str(data.get("target", ""))
+            if data.get("public_key"):
+                if self._set_peer_key(target, str(data["public_key"])):
+                    self.no_e2e_peers.discard(target)
+            elif self.e2e.is_pinned(target):
+                # A server cannot turn off E2E for a peer we already hold a key for.
+                self.e2e.set_peer_key(target, self.e2e.pinned_keys[target])
+                self.untrusted_peers[target] = ""
+            else:
+                self.no_e2e_peers.add(target)
+            return target, None
+
+        if action == "group_key":
+            group = str(data.get("group_name", ""))
+            wrapped_by = str(data.get("wrapped_by", ""))
+            if data.get("wrapped_by_key"):
+                # On a changed key the pinned one is kept, so a forged wrap fails to open.
+                self._set_peer_key(wrapped_by, str(data["wrapped_by_key"]))
+            if self.e2e.has_peer(wrapped_by) and self.e2e.unwrap_group_key(
+                    group, str(data.get("wrapped_key", "")), wrapped_by):
+                return group, None
+
+        elif action == "group_key_needed":
+            group = str(data.get("group_name", ""))
+            member = str(data.get("member", ""))
+            if (self.e2e.has_group(group) and data.get("public_key")
+                    and self._set_peer_key(member, str(data["public_key"]))):
+                return None, {
+                    "action": "share_group_key",
+                    "group_name": group,
+                    "keys": {member: self.e2e.wrap_group_key(group, member)}
+                }
+        return None, None
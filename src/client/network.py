@@ -4,24 +4,42 @@ Handles socket connections, authentication, encryption integration,
 and background listening threads for the chat application.
 """
 
+import itertools
 import socket
 import threading
-from typing import Callable, Tuple, Optional, Dict, Any, List, cast
-from src.common.protocol import HOST, PORT, send_json, receive_json
-from src.common.crypto_utils import CryptoManager
+import time
+from concurrent.futures import Future
+from typing import Callable, Iterable, Iterator, Tuple, Optional, Dict, Any, List, Set, cast
+from src.common.protocol import (
+    HOST, PORT, COMPRESSION, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT, send_json, receive_json
+)
+from src.common.crypto_utils import CryptoManager, E2EManager, E2E_PREFIX, KeyChanged
+from src.client.key_state import KeyStateMixin, load_device_id
 
+# pylint: disable=too-many-instance-attributes
 
-class NetworkClient:
+CONNECT_TIMEOUT: float = 10.0
+# Messages per history request; older pages are fetched with "before".
+HISTORY_PAGE_SIZE: int = 50
+
+ErrorCallback = Callable[[Dict[str, Any], Dict[str, Any]], None]
+
+
+class NetworkClient(KeyStateMixin):
     """
     Handles all network communications for the client.
     Manages connection, authentication, encryption, and background listening.
     """
 
-    def __init__(self,
+    def __init__(self,  # pylint: disable=too-many-arguments
                  on_msg_callback: Callable[[Dict[str, Any]], None],
                  on_data_callback: Callable[[List[str], List[str], List[str],
                                              List[str], List[Tuple[str, str]]], None],
-                 on_history_callback: Callable[[str, List[Dict[str, Any]]], None]) -> None:
+                 on_history_callback: Callable[[str, List[Dict[str, Any]]], None],
+                 heartbeat_interval: Optional[float] = HEARTBEAT_INTERVAL,
+                 heartbeat_timeout: float = HEARTBEAT_TIMEOUT,
+                 *,
+                 on_error_callback: Optional[ErrorCallback] = None) -> None:
         """
         Initializes the NetworkClient.
 
@@ -29,6 +47,11 @@ class NetworkClient:
             on_msg_callback: Callback for receiving real-time messages.
             on_data_callback: Callback for updating UI lists (friends, rooms, etc).
             on_history_callback: Callback for receiving chat history.
+            heartbeat_interval: Seconds of silence from the server before it is pinged
+                (None disables heartbeats).
+            heartbeat_timeout: Seconds of silence after which the connection is dropped.
+            on_error_callback: Callback receiving (request, error frame) when the server
+                refuses a request; the request is empty for unsolicited errors.
         """
         self.sock: Optional[socket.socket] = None
         self.username: str = ""
@@ -36,13 +59,41 @@ class NetworkClient:
         self.on_data: Callable[[List[str], List[str], List[str],
                                 List[str], List[Tuple[str, str]]], None] = on_data_callback
         self.on_history: Callable[[str, List[Dict[str, Any]]], None] = on_history_callback
+        self.on_error: Optional[ErrorCallback] = on_error_callback
         self.running: bool = False
         self.crypto: Optional[CryptoManager] = None
+        self.e2e: Optional[E2EManager] = None
+        # Outgoing plaintexts and incoming frames waiting for a peer/group key.
+        self.pending_out: Dict[str, List[str]] = {}
+        self.held_in: Dict[str, List[Dict[str, Any]]] = {}
+        # Peers without a registered public key (legacy clients) use the server key.
+        self.no_e2e_peers: Set[str] = set()
+        self.untrusted_peers: Dict[str, str] = {}
+        # In-flight requests by id; the response frame echoes the id.
+        self._request_ids: Iterator[int] = itertools.count(1)
+        self._in_flight: Dict[int, "Future[Dict[str, Any]]"] = {}
+        self._in_flight_requests: Dict[int, Dict[str, Any]] = {}
+        self._in_flight_lock: threading.Lock = threading.Lock()
+        # The GUI, listener and heartbeat threads all send on one socket.
+        self._send_lock: threading.Lock = threading.Lock()
+        self.heartbeat_interval: Optional[float] = heartbeat_interval
+        self.heartbeat_timeout: float = heartbeat_timeout
+        self.last_received: float = time.monotonic()
+        self._stopped: threading.Event = threading.Event()
 
     def connect(self, username: str, password: str,
-                is_register: bool = False) -> Tuple[bool, str]:
+                is_register: bool = False, replace_key: bool = False) -> Tuple[bool, str]:
         """
         Connects to the server, sends login/register request, and initializes crypto.
+        The reply is read by the listener thread and matched by request id.
+
+        Args:
+            username: Account name.
+            password: Account password.
+            is_register: Register the account instead of logging in.
+            replace_key: Register this device's identity key even if the account
+                already has another one. Devices holding the old key can no
+                longer read new end-to-end messages.
 
         Returns:
             Tuple containing (Success Boolean, Message String).
@@ -53,48 +104,132 @@ class NetworkClient:
 
             clean = username.strip()
             action = "register" if is_register else "login"
-            send_json(self.sock, {
+            e2e = E2EManager.load(clean)
+            self.e2e = e2e
+            reply = self.request({
                 "action": action,
                 "username": clean,
-                "password": password
+                "password": password,
+                "public_key": e2e.public_key_string(),
+                "compress": [COMPRESSION],
+                "device": load_device_id(clean),
+                "replace_key": replace_key
             })
+            self.running = True
+            self._stopped.clear()
+            self.last_received = time.monotonic()
+            threading.Thread(target=self.listen, daemon=True).start()
+            resp = reply.result(CONNECT_TIMEOUT)
 
-            resp = receive_json(self.sock)
+            ok = resp.get("status") == "success"
+            if ok:
+                e2e.save()
+            if ok and not is_register:
+                self.username = clean
+                self.refresh_data()
+                if self.heartbeat_interval:
+                    threading.Thread(target=self._heartbeat, daemon=True).start()
+            else:
+                self.close()
+            return ok, str(resp.get("msg", "OK" if ok else "Error"))
 
-            if resp and resp.get("status") == "success":
-                key = resp.get("key")
-                if key and isinstance(key, str):
-                    self.crypto = CryptoManager(key.encode('utf-8'))
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            self.close()
+            return False, str(e) or type(e).__name__
 
-                if not is_register:
-                    self.username = clean
-                    self.running = True
-                    threading.Thread(target=self.listen, daemon=True).start()
-                    self.refresh_data()
-                return True, str(resp.get("msg", "OK"))
+    def close(self) -> None:
+        """Stops the listener and closes the connection."""
+        self.running = False
+        self._stopped.set()
+        if self.sock:
+            self.sock.close()
 
-            if self.sock:
-                self.sock.close()
-            msg = str(resp.get("msg", "Error")) if resp else "Connection closed"
-            return False, msg
+    def request(self, payload: Dict[str, Any]) -> "Future[Dict[str, Any]]":
+        """
+        Sends a request tagged with a fresh id without waiting for the reply.
+        Any number of requests may be in flight at once.
 
-        except Exception as e:  # pylint: disable=broad-exception-caught
-            return False, str(e)
+        Args:
+            payload: The request frame; an "id" field is added.
+
+        Returns:
+            Future resolved with the response frame (after it has been decrypted
+            and passed to the usual callbacks) or failed if the connection drops.
+        """
+        future: "Future[Dict[str, Any]]" = Future()
+        if not self.sock:
+            future.set_exception(ConnectionError("Not connected"))
+            return future
+        req_id = next(self._request_ids)
+        with self._in_flight_lock:
+            self._in_flight[req_id] = future
+            self._in_flight_requests[req_id] = payload
+        self._send({**payload, "id": req_id})
+        return future
+
+    def _send(self, payload: Dict[str, Any]) -> None:
+        """Writes one frame; the lock keeps frames from different threads from interleaving."""
+        sock = self.sock
+        if sock:
+            with self._send_lock:
+                send_json(sock, payload)
+
+    def prefetch_histories(self, targets: Iterable[str],
+                           limit: int = HISTORY_PAGE_SIZE) -> Dict[str, "Future[Dict[str, Any]]"]:
+        """
+        Requests the newest page of several chats' history at once.
+        Each response is also delivered through the history callback.
+        """
+        if not (self.running and self.sock):
+            return {}
+        return {t: self.request({"action": "get_history", "target": t, "limit": limit})
+                for t in targets}
+
+    def _resolve(self, data: Dict[str, Any]) -> None:
+        """Completes the future waiting for this response frame, if any."""
+        req_id = data.get("id")
+        if req_id is None:
+            return
+        with self._in_flight_lock:
+            future = self._in_flight.pop(req_id, None)
+            self._in_flight_requests.pop(req_id, None)
+        if future and not future.done():
+            future.set_result(data)
+
+    def _fail_in_flight(self) -> None:
+        """Fails every request still waiting when the connection ends."""
+        with self._in_flight_lock:
+            futures, self._in_flight = list(self._in_flight.values()), {}
+            self._in_flight_requests.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(ConnectionError("Connection closed"))
 
     def refresh_data(self) -> None:
         """Requests updated data (friends, rooms, active users) from the server."""
         if self.running and self.sock:
-            send_json(self.sock, {"action": "get_data"})
+            self._send({"action": "get_data"})
 
-    def get_chat_history(self, target: str) -> None:
-        """Requests chat history for a specific target (user or group)."""
+    def get_chat_history(self, target: str, limit: Optional[int] = None,
+                         before: Optional[int] = None) -> None:
+        """
+        Requests chat history for a specific target (user or group).
+
+        Args:
+            target: User, #group or &room.
+            limit: Only the newest `limit` messages; all of them if None.
+            before: Only messages older than this message id, to page back.
+        """
         if self.running and self.sock:
-            send_json(self.sock, {"action": "get_history", "target": target})
+            page = {"limit": limit, "before": before}
+            req = {"action": "get_history", "target": target,
+                   **{k: v for k, v in page.items() if v is not None}}
+            self._send(req)
 
     def send_friend_request(self, t: str) -> None:
         """Sends a friend request to the target user."""
         if self.running and self.sock:
-            send_json(self.sock, {"action": "send_friend_request", "target": t.strip()})
+            self._send({"action": "send_friend_request", "target": t.strip()})
 
     def handle_request(self, s: str, d: str) -> None:
         """
@@ -105,38 +240,125 @@ class NetworkClient:
             d: Decision ('accept' or 'decline').
         """
         if self.running and self.sock:
-            send_json(self.sock, {"action": "handle_request", "sender": s, "decision": d})
+            self._send({"action": "handle_request", "sender": s, "decision": d})
 
     def create_group(self, n: str) -> None:
-        """Creates a private group."""
+        """Creates a private group; its key is generated once the server confirms it."""
         n = n.strip()
         n = "#" + n if not n.startswith("#") else n
         if self.running and self.sock:
-            send_json(self.sock, {"action": "create_group", "group_name": n})
+            reply = self.request({"action": "create_group", "group_name": n})
+            if self.e2e:
+                reply.add_done_callback(lambda f: self._share_new_group_key(n, f))
+
+    def _share_new_group_key(self, name: str, reply: "Future[Dict[str, Any]]") -> None:
+        """
+        Stores a fresh key for a group we just created. A refused create (the
+        name is taken) must not replace our wrapped key of the existing group.
+        """
+        if reply.exception() or reply.result().get("action") == "error":
+            return
+        if self.e2e and self.sock:
+            self.e2e.new_group_key(name)
+            self._send({
+                "action": "share_group_key",
+                "group_name": name,
+                "keys": {self.username: self.e2e.wrap_group_key(name, self.username)}
+            })
 
     def join_group(self, n: str) -> None:
         """Joins a private group."""
         n = n.strip()
         n = "#" + n if not n.startswith("#") else n
+        if self.e2e:
+            # A key generated locally for a name we failed to create is not the group's key.
+            self.e2e.forget_group(n)
         if self.running and self.sock:
-            send_json(self.sock, {"action": "join_group", "group_name": n})
+            self._send({"action": "join_group", "group_name": n})
 
     def create_public_room(self, n: str, t: str) -> None:
         """Creates a public room with tags."""
         n = n.strip()
         n = "&" + n if not n.startswith("&") else n
         if self.running and self.sock:
-            send_json(self.sock, {
+            self._send({
                 "action": "create_public_room",
                 "room_name": n,
                 "tags": t.strip()
             })
 
+    def join_room(self, n: str) -> None:
+        """Subscribes to a public room's messages."""
+        n = n.strip()
+        n = "&" + n if not n.startswith("&") else n
+        if self.running and self.sock:
+            self._send({"action": "join_room", "room_name": n})
+
+    def leave_room(self, n: str) -> None:
+        """Unsubscribes from a public room."""
+        n = n.strip()
+        n = "&" + n if not n.startswith("&") else n
+        if self.running and self.sock:
+            self._send({"action": "leave_room", "room_name": n})
+
     def send_message(self, recipient: str, text: str) -> None:
-        """Encrypts and sends a message to the recipient."""
-        if self.running and text and self.sock and self.crypto:
-            encrypted = self.crypto.encrypt_message(text)
-            send_json(self.sock, {"action": "msg", "to": recipient, "text": encrypted})
+        """
+        Encrypts and sends a message to the recipient.
+        Direct and group messages are end-to-end encrypted; if the peer or group
+        key is not known yet, the message is queued until it arrives. A refused
+        message is reported through the error callback, as is a message to a
+        peer whose identity key changed until trust_peer_key accepts it.
+        """
+        if not (self.running and text and self.sock):
+            return
+        if recipient in self.untrusted_peers:
+            if self.on_error:
+                self.on_error({"action": "msg", "to": recipient},
+                              {"action": "error", "reason": "key_changed",
+                               "msg": str(KeyChanged(recipient, self.untrusted_peers[recipient]))})
+            return
+        if recipient.startswith("&") or not self.e2e or recipient in self.no_e2e_peers:
+            if self.crypto:
+                encrypted = self.crypto.encrypt_message(text)
+                self.request({"action": "msg", "to": recipient, "text": encrypted})
+            return
+        if self._has_key(recipient):
+            self.request({"action": "msg", "to": recipient,
+                          "text": self._e2e_encrypt(recipient, text)})
+        else:
+            self.pending_out.setdefault(recipient, []).append(text)
+            self._request_key(recipient)
+
+    def _request_key(self, name: str) -> None:
+        """Asks the server for a peer's public key or our wrapped group key."""
+        if self.sock:
+            if name.startswith("#"):
+                self._send({"action": "get_group_key", "group_name": name})
+            else:
+                self._send({"action": "get_public_key", "target": name})
+
+    def _missing_key(self, texts: List[Tuple[str, str]]) -> Optional[str]:
+        """Returns the first key needed to decrypt (text, key_name) pairs that is unknown."""
+        for text, key_name in texts:
+            if (text.startswith(E2E_PREFIX) and not self._has_key(key_name)
+                    and key_name not in self.no_e2e_peers):
+                return key_name
+        return None
+
+    def _on_key_available(self, name: str) -> None:
+        """Flushes queued sends and re-dispatches held frames once a key arrives."""
+        for text in self.pending_out.pop(name, []):
+            self.send_message(name, text)
+        for data in self.held_in.pop(name, []):
+            self._dispatch(data)
+
+    def _handle_key_frame(self, data: Dict[str, Any]) -> None:
+        """Processes public_key, group_key and group_key_needed frames."""
+        available, reply = self._apply_key_frame(data)
+        if reply and self.sock:
+            self._send(reply)
+        if available:
+            self._on_key_available(available)
 
     def listen(self) -> None:
         """
@@ -147,35 +369,126 @@ class NetworkClient:
             data = receive_json(self.sock)
             if not data:
                 break
+            self.last_received = time.monotonic()
+            self._dispatch(data)
 
-            action = data.get("action")
+        self.close()
+        self._fail_in_flight()
 
-            if action == "msg":
-                if self.crypto:
-                    encrypted_text = str(data.get("text", ""))
-                    data["text"] = self.crypto.decrypt_message(encrypted_text)
-                    self.on_msg(data)
+    def _heartbeat(self) -> None:
+        """
+        Background loop: pings a quiet server and drops the connection if it
+        stays silent for heartbeat_timeout (half-open TCP connection).
+        """
+        interval = self.heartbeat_interval or HEARTBEAT_INTERVAL
+        while not self._stopped.wait(interval / 3):
+            sock = self.sock
+            if not (self.running and sock):
+                return
+            idle = time.monotonic() - self.last_received
+            if idle >= self.heartbeat_timeout:
+                # Wakes the listener blocked in recv; it then closes and fails requests.
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return
+            if idle >= interval:
+                self._send({"action": "ping"})
 
-            elif action == "data_update":
-                self.on_data(
-                    cast(List[str], data.get("friends", [])),
-                    cast(List[str], data.get("groups", [])),
-                    cast(List[str], data.get("requests", [])),
-                    cast(List[str], data.get("active_users", [])),
-                    cast(List[Tuple[str, str]], data.get("public_rooms", []))
-                )
+    def _hold(self, key_name: str, data: Dict[str, Any]) -> None:
+        """Parks a frame until the key it needs has been fetched."""
+        first = key_name not in self.held_in and key_name not in self.pending_out
+        self.held_in.setdefault(key_name, []).append(data)
+        if first:
+            self._request_key(key_name)
 
-            elif action == "history_response":
-                msgs = data.get("messages", [])
-                target = str(data.get("target", ""))
+    def _decrypt_messages(self, data: Dict[str, Any]) -> bool:
+        """
+        Decrypts the "messages" list of a frame in place.
+        Returns False if the frame was held back until a key arrives.
+        """
+        msgs = data.get("messages", [])
+        pairs = [(str(m.get("text", "")),
+                  self._key_name(str(m.get("sender", "")), str(m.get("to", ""))))
+                 for m in msgs]
+        missing = self._missing_key(pairs)
+        if missing:
+            self._hold(missing, data)
+            return False
+        for m, text in zip(msgs, self._decrypt_batch(pairs)):
+            m["text"] = text
+        return True
 
-                if self.crypto:
-                    for m in msgs:
-                        enc_text = str(m.get("text", ""))
-                        m["text"] = self.crypto.decrypt_message(enc_text)
+    def _dispatch(self, data: Dict[str, Any]) -> None:
+        """Handles one server frame and then completes the request it answers."""
+        if self._handle(data):
+            self._resolve(data)
 
-                self.on_history(target, msgs)
+    def _handle_msg(self, data: Dict[str, Any]) -> bool:
+        """Decrypts a live message; returns False if it waits for a key."""
+        if self.crypto or self.e2e:
+            encrypted_text = str(data.get("text", ""))
+            key_name = self._key_name(str(data.get("sender", "")), str(data.get("to", "")))
+            if self._missing_key([(encrypted_text, key_name)]):
+                self._hold(key_name, data)
+                return False
+            data["text"] = self._decrypt(encrypted_text, key_name)
+            self.on_msg(data)
+        return True
 
-        self.running = False
-        if self.sock:
-            self.sock.close()
+    def _report_error(self, data: Dict[str, Any]) -> None:
+        """
+        Passes a rate-limit or overload rejection to the error callback,
+        together with the request it refuses so the UI can tell what failed.
+        """
+        with self._in_flight_lock:
+            request = self._in_flight_requests.get(cast(int, data.get("id")), {})
+        if self.on_error:
+            self.on_error(request, data)
+
+    def _handle(self, data: Dict[str, Any]) -> bool:
+        """
+        Decrypts a single server frame and hands it to the matching callback.
+        Returns False if the frame was held back until a key arrives.
+        """
+        action = data.get("action")
+
+        if "status" in data:
+            self._apply_login(data)
+
+        elif action == "msg":
+            return self._handle_msg(data)
+
+        elif action == "data_update":
+            self.no_e2e_peers.clear()
+            self.on_data(
+                cast(List[str], data.get("friends", [])),
+                cast(List[str], data.get("groups", [])),
+                cast(List[str], data.get("requests", [])),
+                cast(List[str], data.get("active_users", [])),
+                cast(List[Tuple[str, str]], data.get("public_rooms", []))
+            )
+
+        elif action == "offline_messages":
+            # Messages this device missed while offline arrive like live ones.
+            if not self._decrypt_messages(data):
+                return False
+            for m in data.get("messages", []):
+                self.on_msg(m)
+
+        elif action == "history_response":
+            if not self._decrypt_messages(data):
+                return False
+            self.on_history(str(data.get("target", "")), data.get("messages", []))
+
+        elif action in ("public_key", "group_key", "group_key_needed"):
+            self._handle_key_frame(data)
+
+        elif action == "error":
+            self._report_error(data)
+
+        elif action == "ping" and self.sock:
+            self._send({"action": "pong"})
+
+        return True
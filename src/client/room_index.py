@@ -0,0 +1,65 @@
+"""
+Search index for public room tags.
+Built once per data_update so filtering never rescans every room.
+"""
+
+import heapq
+import re
+from typing import Dict, List, Sequence, Set, Tuple
+
+MAX_PREFIX_LEN: int = 8
+DEFAULT_LIMIT: int = 200
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Splits text into lowercase search tokens."""
+    return _TOKEN_RE.findall(text.lower())
+
+
+class RoomIndex:
+    """
+    Lowercase token and prefix index over (room_name, tags) pairs.
+    A room matches when every query token is a prefix of one of its tokens.
+    """
+
+    def __init__(self, rooms: Sequence[Tuple[str, str]] = ()) -> None:
+        self.rooms: List[Tuple[str, str]] = []
+        self.tokens: List[Set[str]] = []
+        self.prefixes: Dict[str, Set[int]] = {}
+        self.build(rooms)
+
+    def build(self, rooms: Sequence[Tuple[str, str]]) -> None:
+        """Rebuilds the index from the given rooms."""
+        self.rooms = [(str(n), str(t)) for n, t in rooms]
+        self.tokens = []
+        self.prefixes = {}
+        for i, (_, tags) in enumerate(self.rooms):
+            toks = set(tokenize(tags))
+            self.tokens.append(toks)
+            for tok in toks:
+                for end in range(1, min(len(tok), MAX_PREFIX_LEN) + 1):
+                    self.prefixes.setdefault(tok[:end], set()).add(i)
+
+    def _match(self, term: str) -> Set[int]:
+        """Returns indices of rooms having a token that starts with `term`."""
+        candidates = self.prefixes.get(term[:MAX_PREFIX_LEN], set())
+        if len(term) <= MAX_PREFIX_LEN:
+            return candidates
+        return {i for i in candidates if any(t.startswith(term) for t in self.tokens[i])}
+
+    def search(self, query: str, limit: int = DEFAULT_LIMIT) -> List[Tuple[str, str]]:
+        """Returns up to `limit` matching rooms in their original order."""
+        terms = tokenize(query)
+        if not terms:
+            return self.rooms[:limit]
+
+        # Intersect starting from the most selective term.
+        sets = sorted((self._match(term) for term in terms), key=len)
+        hits = set(sets[0])
+        for s in sets[1:]:
+            hits &= s
+            if not hits:
+                break
+        return [self.rooms[i] for i in heapq.nsmallest(limit, hits)]
@@ -0,0 +1,100 @@
+"""
+Keyed widget reconciliation for the GUI side lists.
+Creates, reuses or removes only the rows whose data changed and recycles
+hidden widgets through per-kind pools instead of destroying them.
+"""
+
+from typing import Any, Callable, Dict, List, NamedTuple, Sequence, Tuple
+
+MAX_POOL_SIZE: int = 256
+
+Row = Tuple[str, str, Any]
+
+
+class RowKind(NamedTuple):  # pylint: disable=too-few-public-methods
+    """Describes how to build, refresh and lay out one kind of row."""
+    create: Callable[[Any], Any]
+    update: Callable[[Any, Any], None]
+    pack: Dict[str, Any]
+
+
+class KeyedWidgetList:  # pylint: disable=too-few-public-methods
+    """
+    Keeps a scrollable container in sync with a list of (kind, key, data) rows.
+    Widgets are identified by (kind, key); unchanged rows are left untouched.
+    """
+
+    def __init__(self, parent: Any, kinds: Dict[str, RowKind],
+                 max_pool_size: int = MAX_POOL_SIZE) -> None:
+        """
+        Initializes the KeyedWidgetList.
+
+        Args:
+            parent: Container the row widgets are packed into.
+            kinds: Row builders indexed by kind name.
+            max_pool_size: Hidden widgets kept per kind for recycling.
+        """
+        self.parent: Any = parent
+        self.kinds: Dict[str, RowKind] = kinds
+        self.max_pool_size: int = max_pool_size
+        self.widgets: Dict[Tuple[str, str], Any] = {}
+        self.data: Dict[Tuple[str, str], Any] = {}
+        self.order: List[Tuple[str, str]] = []
+        self.pools: Dict[str, List[Any]] = {name: [] for name in kinds}
+
+    def reconcile(self, rows: Sequence[Row]) -> None:
+        """Updates the container so it shows exactly `rows`, in order."""
+        new_order = [(kind, key) for kind, key, _ in rows]
+        wanted = set(new_order)
+
+        for ident in self.order:
+            if ident not in wanted:
+                self._release(ident)
+
+        kept = [ident for ident in self.order if ident in wanted]
+        appended: List[Tuple[str, str]] = []
+        for kind, key, data in rows:
+            ident = (kind, key)
+            if ident in self.widgets:
+                if self.data[ident] != data:
+                    self.kinds[kind].update(self.widgets[ident], data)
+                    self.data[ident] = data
+            else:
+                self.widgets[ident] = self._acquire(kind)
+                self.kinds[kind].update(self.widgets[ident], data)
+                self.data[ident] = data
+                appended.append(ident)
+
+        if new_order[:len(kept)] == kept:
+            # Only removals and appends: existing rows keep their place.
+            for ident in appended:
+                self._pack(ident)
+        else:
+            for ident in new_order:
+                self.widgets[ident].pack_forget()
+            for ident in new_order:
+                self._pack(ident)
+
+        self.order = new_order
+
+    def _pack(self, ident: Tuple[str, str]) -> None:
+        """Packs a row widget at the end of the container."""
+        self.widgets[ident].pack(**self.kinds[ident[0]].pack)
+
+    def _acquire(self, kind: str) -> Any:
+        """Returns a pooled widget of the given kind or creates a new one."""
+        pool = self.pools[kind]
+        if pool:
+            return pool.pop()
+        return self.kinds[kind].create(self.parent)
+
+    def _release(self, ident: Tuple[str, str]) -> None:
+        """Hides a row and returns its widget to the pool."""
+        widget = self.widgets.pop(ident)
+        del self.data[ident]
+        widget.pack_forget()
+        pool = self.pools[ident[0]]
+        if len(pool) < self.max_pool_size:
+            pool.append(widget)
+        else:
+            widget.destroy()
@@ -1,37 +1,230 @@
 """
-Utility module for cryptographic operations using Fernet (symmetric encryption).
-Handles key generation, storage, and message encryption/decryption.
+Utility module for cryptographic operations.
+Handles key generation, storage, and message encryption/decryption using
+either Fernet or an AEAD suite (AES-GCM / ChaCha20-Poly1305) with a
+compact binary envelope, key IDs and key rotation, plus per-user X25519
+identities for end-to-end encrypted direct and group messages.
 """
 
+import base64
+import binascii
+import json
 import os
-from typing import Optional
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence, Union
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 
 KEY_FILE: str = "server.key"
+KEYRING_FILE: str = "server.keyring"
+
+SUITE_FERNET: str = "fernet"
+SUITE_AES_GCM: str = "aes-gcm"
+SUITE_CHACHA20: str = "chacha20-poly1305"
+CIPHER_SUITE: str = SUITE_AES_GCM
+
+ENVELOPE_VERSION: int = 1
+NONCE_SIZE: int = 12
+AEAD_KEY_SIZE: int = 32
+TAG_SIZE: int = 16
+# version, suite id, key id
+ENVELOPE_HEADER = struct.Struct("!BBI")
+
+_SUITE_IDS: Dict[str, int] = {SUITE_AES_GCM: 1, SUITE_CHACHA20: 2}
+ENVELOPE_OVERHEAD: int = ENVELOPE_HEADER.size + NONCE_SIZE + TAG_SIZE
+
+DECRYPTION_ERROR: str = "[Decryption Error]"
+# Batches at least this large are split across a thread pool (OpenSSL releases the GIL).
+PARALLEL_MIN_BATCH: int = 512
+# Payloads at least this large are sealed/opened in place in a reused scratch buffer;
+# for smaller ones the extra memoryview bookkeeping costs more than the copy it saves.
+BULK_INTO_MIN_SIZE: int = 1024
+
+E2E_PREFIX: str = "e2e:"
+IDENTITY_DIR: str = "keys"
+
+
+def envelope_prefix(suite: str = SUITE_AES_GCM, key_id: int = 1) -> str:
+    """
+    Returns the base64 text that every envelope of a suite and key ID starts
+    with. The 6-byte header encodes to whole base64 characters.
+    """
+    header = ENVELOPE_HEADER.pack(ENVELOPE_VERSION, _SUITE_IDS[suite], key_id)
+    return base64.b64encode(header).decode('ascii')
+
+
+class KeyRing:
+    """
+    Set of AEAD keys indexed by a numeric key ID.
+    New messages use the current key; older keys stay available for decryption.
+    An optional legacy Fernet key allows reading pre-AEAD tokens.
+    """
+
+    def __init__(self, suite: str, keys: Dict[int, bytes], current: int,
+                 legacy: Optional[bytes] = None) -> None:
+        if suite not in _SUITE_IDS:
+            raise ValueError(f"Unknown cipher suite: {suite}")
+        if current not in keys:
+            raise ValueError(f"Current key id {current} not in key ring")
+        self.suite: str = suite
+        self.keys: Dict[int, bytes] = keys
+        self.current: int = current
+        self.legacy: Optional[bytes] = legacy
+
+    @classmethod
+    def generate(cls, suite: str = CIPHER_SUITE, legacy: Optional[bytes] = None) -> "KeyRing":
+        """Creates a key ring with a single fresh key."""
+        return cls(suite, {1: os.urandom(AEAD_KEY_SIZE)}, 1, legacy)
+
+    def rotate(self) -> int:
+        """Adds a new key, makes it current and returns its ID."""
+        self.current = max(self.keys) + 1
+        self.keys[self.current] = os.urandom(AEAD_KEY_SIZE)
+        return self.current
+
+    def to_bytes(self) -> bytes:
+        """Serializes the key ring for storage or network transmission."""
+        data = {
+            "suite": self.suite,
+            "current": self.current,
+            "keys": {str(k): base64.b64encode(v).decode('ascii') for k, v in self.keys.items()},
+        }
+        if self.legacy:
+            data["legacy"] = self.legacy.decode('ascii')
+        return json.dumps(data).encode('utf-8')
+
+    @classmethod
+    def from_bytes(cls, raw: bytes) -> "KeyRing":
+        """Parses a key ring produced by `to_bytes`."""
+        data = json.loads(raw.decode('utf-8'))
+        keys = {int(k): base64.b64decode(v) for k, v in data["keys"].items()}
+        legacy = data.get("legacy")
+        return cls(data["suite"], keys, int(data["current"]),
+                   legacy.encode('ascii') if legacy else None)
+
+
+class AEADCipher:
+    """
+    Authenticated encryption with a binary envelope:
+    version (1) | suite (1) | key id (4) | nonce (12) | ciphertext + tag (16).
+    The header is bound to the ciphertext as associated data.
+    """
+
+    def __init__(self, keyring: KeyRing) -> None:
+        self.keyring: KeyRing = keyring
+        self._aeads: Dict[int, Union[AESGCM, ChaCha20Poly1305]] = {}
+
+    def _aead(self, key_id: int) -> Union[AESGCM, ChaCha20Poly1305]:
+        """Returns a cached AEAD primitive for the given key."""
+        aead = self._aeads.get(key_id)
+        if aead is None:
+            key = self.keyring.keys[key_id]
+            aead = AESGCM(key) if self.keyring.suite == SUITE_AES_GCM else ChaCha20Poly1305(key)
+            self._aeads[key_id] = aead
+        return aead
+
+    def encrypt(self, plaintext: bytes) -> bytes:
+        """Encrypts bytes under the current key with a fresh random nonce."""
+        suite_id = _SUITE_IDS[self.keyring.suite]
+        header = ENVELOPE_HEADER.pack(ENVELOPE_VERSION, suite_id, self.keyring.current)
+        nonce = os.urandom(NONCE_SIZE)
+        return header + nonce + self._aead(self.keyring.current).encrypt(
+            nonce, plaintext, header)
+
+    def decrypt(self, envelope: bytes) -> bytes:
+        """Verifies and decrypts an envelope. Raises ValueError if it is malformed."""
+        key_id = self._check_header(envelope)
+        hsize = ENVELOPE_HEADER.size
+        nonce = envelope[hsize:hsize + NONCE_SIZE]
+        return self._aead(key_id).decrypt(
+            nonce, envelope[hsize + NONCE_SIZE:], envelope[:hsize])
+
+    def _check_header(self, envelope: bytes) -> int:
+        """Validates an envelope header and returns its key ID."""
+        if len(envelope) < ENVELOPE_HEADER.size + NONCE_SIZE + TAG_SIZE:
+            raise ValueError("Envelope too short")
+        version, suite_id, key_id = ENVELOPE_HEADER.unpack_from(envelope)
+        if version != ENVELOPE_VERSION or suite_id != _SUITE_IDS[self.keyring.suite]:
+            raise ValueError("Unsupported envelope")
+        if key_id not in self.keyring.keys:
+            raise ValueError(f"Unknown key id {key_id}")
+        return int(key_id)
+
+    def seal_into(self, plaintext: bytes, buf: memoryview) -> int:
+        """
+        Writes the envelope for `plaintext` into `buf` without intermediate copies.
+        `buf` must hold at least ENVELOPE_OVERHEAD + len(plaintext) bytes.
+        Returns the number of bytes written.
+        """
+        hsize = ENVELOPE_HEADER.size
+        size = ENVELOPE_OVERHEAD + len(plaintext)
+        ENVELOPE_HEADER.pack_into(buf, 0, ENVELOPE_VERSION,
+                                  _SUITE_IDS[self.keyring.suite], self.keyring.current)
+        nonce = os.urandom(NONCE_SIZE)
+        buf[hsize:hsize + NONCE_SIZE] = nonce
+        aead = self._aead(self.keyring.current)
+        header = bytes(buf[:hsize])
+        if hasattr(aead, "encrypt_into"):
+            aead.encrypt_into(nonce, plaintext, header, buf[hsize + NONCE_SIZE:size])
+        else:
+            buf[hsize + NONCE_SIZE:size] = aead.encrypt(nonce, plaintext, header)
+        return size
+
+    def open_into(self, envelope: bytes, buf: memoryview) -> int:
+        """
+        Decrypts `envelope` into `buf` and returns the plaintext length.
+        `buf` must hold at least len(envelope) - ENVELOPE_OVERHEAD bytes.
+        """
+        key_id = self._check_header(envelope)
+        hsize = ENVELOPE_HEADER.size
+        size = len(envelope) - ENVELOPE_OVERHEAD
+        nonce = envelope[hsize:hsize + NONCE_SIZE]
+        aead = self._aead(key_id)
+        if hasattr(aead, "decrypt_into"):
+            aead.decrypt_into(nonce, envelope[hsize + NONCE_SIZE:], envelope[:hsize], buf[:size])
+        else:
+            buf[:size] = aead.decrypt(nonce, envelope[hsize + NONCE_SIZE:], envelope[:hsize])
+        return size
 
 
 class CryptoManager:
     """
-    Manages symmetric encryption using Fernet (AES).
+    Manages symmetric encryption using Fernet or an AEAD key ring.
     Handles key generation, persistence, encryption, and decryption.
     """
 
-    def __init__(self, key: Optional[bytes] = None) -> None:
+    def __init__(self, key: Optional[bytes] = None, suite: str = SUITE_FERNET) -> None:
         """
         Initializes the CryptoManager.
 
         Args:
             key: Optional key bytes. If provided (Client), it uses it.
                  If None (Server), it loads from file or generates a new one.
+                 Serialized key rings are detected automatically.
+            suite: Cipher suite the server generates keys for when no key is given.
         """
         self.key: bytes
 
         if key:
             self.key = key
-        else:
+        elif suite == SUITE_FERNET:
             self.key = self._load_or_generate_key()
+        else:
+            self.key = self._load_or_generate_keyring(suite)
 
-        self.cipher: Fernet = Fernet(self.key)
+        self.cipher: Optional[Fernet] = None
+        self.aead: Optional[AEADCipher] = None
+        if self.key.startswith(b"{"):
+            keyring = KeyRing.from_bytes(self.key)
+            self.aead = AEADCipher(keyring)
+            if keyring.legacy:
+                self.cipher = Fernet(keyring.legacy)
+        else:
+            self.cipher = Fernet(self.key)
 
     def _load_or_generate_key(self) -> bytes:
         """
@@ -47,24 +240,390 @@ class CryptoManager:
             f.write(new_key)
         return new_key
 
+    def _load_or_generate_keyring(self, suite: str) -> bytes:
+        """
+        Loads the key ring file or creates one. An existing Fernet key file
+        is kept as the legacy key so older history stays readable.
+        """
+        if os.path.exists(KEYRING_FILE):
+            with open(KEYRING_FILE, "rb") as f:
+                return f.read()
+
+        legacy: Optional[bytes] = None
+        if os.path.exists(KEY_FILE):
+            with open(KEY_FILE, "rb") as f:
+                legacy = f.read().strip() or None
+
+        raw = KeyRing.generate(suite, legacy).to_bytes()
+        with open(KEYRING_FILE, "wb") as f:
+            f.write(raw)
+        return raw
+
+    def rotate_key(self) -> int:
+        """
+        Rotates the AEAD key ring and persists it. Returns the new key ID.
+        Only sessions established after the rotation receive the new key.
+        """
+        if not self.aead:
+            raise ValueError("Key rotation requires an AEAD cipher suite")
+        key_id = self.aead.keyring.rotate()
+        self.key = self.aead.keyring.to_bytes()
+        with open(KEYRING_FILE, "wb") as f:
+            f.write(self.key)
+        return key_id
+
     def get_key_as_string(self) -> str:
         """Returns the key as a string for network transmission."""
         return self.key.decode('utf-8')
 
     def encrypt_message(self, message: str) -> str:
-        """Encrypts a plaintext string into a Fernet token."""
+        """Encrypts a plaintext string into a Fernet token or AEAD envelope."""
         if not message:
             return ""
         try:
+            if self.aead:
+                return base64.b64encode(self.aead.encrypt(message.encode('utf-8'))).decode('ascii')
+            if not self.cipher:
+                return ""
             return self.cipher.encrypt(message.encode('utf-8')).decode('utf-8')
         except Exception:  # pylint: disable=broad-exception-caught
             return ""
 
     def decrypt_message(self, encrypted_token: str) -> str:
-        """Decrypts a Fernet token back to plaintext."""
+        """Decrypts a Fernet token or AEAD envelope back to plaintext."""
         if not encrypted_token:
             return ""
         try:
+            # Fernet tokens always start with version byte 0x80 ("gA" in base64).
+            if self.aead and not encrypted_token.startswith("gA"):
+                return self.aead.decrypt(base64.b64decode(encrypted_token)).decode('utf-8')
+            if not self.cipher:
+                return DECRYPTION_ERROR
             return self.cipher.decrypt(encrypted_token.encode('utf-8')).decode('utf-8')
         except Exception:  # pylint: disable=broad-exception-caught
-            return "[Decryption Error]"
+            return DECRYPTION_ERROR
+
+    def encrypt_many(self, messages: Sequence[str],
+                     workers: Optional[int] = None) -> List[Optional[str]]:
+        """
+        Encrypts a batch of plaintexts.
+
+        Args:
+            messages: Plaintext strings.
+            workers: Thread count for large batches. Defaults to the CPU count
+                     once the batch reaches PARALLEL_MIN_BATCH; 1 disables threading.
+
+        Returns:
+            One token per input, "" for empty inputs and None for items that failed.
+        """
+        return self._run_batch(self._encrypt_chunk, messages, workers)
+
+    def decrypt_many(self, tokens: Sequence[str],
+                     workers: Optional[int] = None) -> List[Optional[str]]:
+        """
+        Decrypts a batch of Fernet tokens and/or AEAD envelopes.
+
+        Args:
+            tokens: Encrypted strings.
+            workers: Thread count for large batches (see encrypt_many).
+
+        Returns:
+            One plaintext per input, "" for empty inputs and None for items that
+            failed to decrypt, so callers can tell errors from real content.
+        """
+        return self._run_batch(self._decrypt_chunk, tokens, workers)
+
+    @staticmethod
+    def _run_batch(func: Callable[[Sequence[str]], List[Optional[str]]],
+                   items: Sequence[str], workers: Optional[int]) -> List[Optional[str]]:
+        """Runs `func` over the batch, split into per-thread chunks if it is large."""
+        if workers is None:
+            workers = (os.cpu_count() or 1) if len(items) >= PARALLEL_MIN_BATCH else 1
+        workers = max(1, min(workers, len(items)))
+        if workers == 1:
+            return func(items)
+
+        step = -(-len(items) // workers)
+        chunks = [items[i:i + step] for i in range(0, len(items), step)]
+        results: List[Optional[str]] = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for part in pool.map(func, chunks):
+                results.extend(part)
+        return results
+
+    def _encrypt_chunk(self, messages: Sequence[str]) -> List[Optional[str]]:
+        """Encrypts a chunk, reusing one scratch buffer for large AEAD envelopes."""
+        out: List[Optional[str]] = []
+        scratch = bytearray(0)
+        for message in messages:
+            if not message:
+                out.append("")
+                continue
+            try:
+                data = message.encode('utf-8')
+                if not self.aead:
+                    out.append(self.cipher.encrypt(data).decode('utf-8') if self.cipher else None)
+                elif len(data) < BULK_INTO_MIN_SIZE:
+                    out.append(binascii.b2a_base64(self.aead.encrypt(data), newline=False)
+                               .decode('ascii'))
+                else:
+                    if len(scratch) < len(data) + ENVELOPE_OVERHEAD:
+                        scratch = bytearray(len(data) + ENVELOPE_OVERHEAD)
+                    view = memoryview(scratch)
+                    size = self.aead.seal_into(data, view)
+                    out.append(binascii.b2a_base64(view[:size], newline=False).decode('ascii'))
+            except Exception:  # pylint: disable=broad-exception-caught
+                out.append(None)
+        return out
+
+    def _decrypt_chunk(self, tokens: Sequence[str]) -> List[Optional[str]]:
+        """Decrypts a chunk, reusing one scratch buffer for large AEAD plaintexts."""
+        out: List[Optional[str]] = []
+        scratch = bytearray(0)
+        for token in tokens:
+            if not token:
+                out.append("")
+                continue
+            try:
+                if not self.aead or token.startswith("gA"):
+                    out.append(self.cipher.decrypt(token.encode('utf-8')).decode('utf-8')
+                               if self.cipher else None)
+                    continue
+                envelope = binascii.a2b_base64(token)
+                if len(envelope) < BULK_INTO_MIN_SIZE:
+                    out.append(self.aead.decrypt(envelope).decode('utf-8'))
+                    continue
+                if len(scratch) < len(envelope):
+                    scratch = bytearray(len(envelope))
+                view = memoryview(scratch)
+                size = self.aead.open_into(envelope, view)
+                out.append(str(view[:size], 'utf-8'))
+            except Exception:  # pylint: disable=broad-exception-caught
+                out.append(None)
+        return out
+
+
+class KeyChanged(Exception):
+    """A peer reported an identity key other than the one pinned for it."""
+
+    def __init__(self, peer: str, public_key: str) -> None:
+        super().__init__(f"The identity key of {peer} changed")
+        self.peer: str = peer
+        self.public_key: str = public_key
+
+
+def _raw_public(key: X25519PublicKey) -> bytes:
+    """Returns the 32 raw bytes of an X25519 public key."""
+    return key.public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+
+
+class E2EManager:  # pylint: disable=too-many-instance-attributes
+    """
+    Client-side end-to-end encryption state for one user.
+
+    Each user owns an X25519 identity key. Direct messages use a symmetric key
+    derived once per peer (X25519 + HKDF) and cached, so the asymmetric work
+    is paid once per peer rather than per message. Each #group has a random
+    key which is wrapped with the pairwise key of every member.
+
+    The first key seen for a peer is pinned; a different key reported later
+    raises KeyChanged until it is accepted with replace_peer_key.
+    """
+
+    def __init__(self, username: str, private_key: Optional[X25519PrivateKey] = None) -> None:
+        self.username: str = username
+        self.private_key: X25519PrivateKey = private_key or X25519PrivateKey.generate()
+        self.peer_keys: Dict[str, str] = {}
+        # First key seen per peer; kept across sessions once loaded from disk.
+        self.pinned_keys: Dict[str, str] = {}
+        self.pin_file: Optional[str] = None
+        self.group_keys: Dict[str, bytes] = {}
+        self._pair_ciphers: Dict[str, AEADCipher] = {}
+        self._group_ciphers: Dict[str, AEADCipher] = {}
+
+    @staticmethod
+    def identity_path(username: str) -> str:
+        """Returns the local file holding a user's private identity key."""
+        return os.path.join(IDENTITY_DIR, f"{username}.x25519")
+
+    @staticmethod
+    def pins_path(username: str) -> str:
+        """Returns the local file holding the peer keys a user has pinned."""
+        return os.path.join(IDENTITY_DIR, f"{username}.peers")
+
+    @classmethod
+    def load(cls, username: str) -> "E2EManager":
+        """
+        Loads the user's identity and pinned peer keys from disk, or creates an
+        unsaved new identity. New pins are written back to disk.
+        """
+        path = cls.identity_path(username)
+        manager = cls(username)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                manager = cls(username, X25519PrivateKey.from_private_bytes(f.read()))
+        manager.pin_file = cls.pins_path(username)
+        if os.path.exists(manager.pin_file):
+            with open(manager.pin_file, encoding="utf-8") as f:
+                manager.pinned_keys = json.load(f)
+        return manager
+
+    def save(self) -> None:
+        """Persists the private identity key (owner-readable only)."""
+        os.makedirs(IDENTITY_DIR, exist_ok=True)
+        raw = self.private_key.private_bytes(
+            serialization.Encoding.Raw, serialization.PrivateFormat.Raw,
+            serialization.NoEncryption())
+        path = self.identity_path(self.username)
+        with open(path, "wb") as f:
+            f.write(raw)
+        os.chmod(path, 0o600)
+
+    def export_identity(self) -> str:
+        """
+        Returns the private identity key as text, to set up another device
+        with import_identity. Anyone holding it can read this user's messages.
+        """
+        raw = self.private_key.private_bytes(
+            serialization.Encoding.Raw, serialization.PrivateFormat.Raw,
+            serialization.NoEncryption())
+        return base64.b64encode(raw).decode('ascii')
+
+    @classmethod
+    def import_identity(cls, username: str, exported: str) -> "E2EManager":
+        """Saves an identity produced by export_identity on this device and returns it."""
+        manager = cls(username, X25519PrivateKey.from_private_bytes(base64.b64decode(exported)))
+        manager.save()
+        return manager
+
+    def public_key_string(self) -> str:
+        """Returns this user's public key for registration."""
+        return base64.b64encode(_raw_public(self.private_key.public_key())).decode('ascii')
+
+    def set_peer_key(self, peer: str, public_key: str) -> None:
+        """
+        Registers a peer's public key, pinning it if it is the first one seen.
+
+        Raises:
+            KeyChanged: If another key is pinned for the peer; the pinned key is
+                used instead, so its messages can still be read.
+        """
+        pinned = self.pinned_keys.get(peer)
+        if pinned is not None and pinned != public_key:
+            self.peer_keys[peer] = pinned
+            raise KeyChanged(peer, public_key)
+        self.peer_keys[peer] = public_key
+        if pinned is None:
+            self.pinned_keys[peer] = public_key
+            self._save_pins()
+
+    def replace_peer_key(self, peer: str, public_key: str) -> None:
+        """
+        Accepts a changed key for a peer after the user confirmed it.
+        An empty key drops the pin, for a peer that no longer uses E2E.
+        """
+        self.peer_keys.pop(peer, None)
+        self.pinned_keys.pop(peer, None)
+        self._pair_ciphers.pop(peer, None)
+        if public_key:
+            self.set_peer_key(peer, public_key)
+        else:
+            self._save_pins()
+
+    def is_pinned(self, peer: str) -> bool:
+        """Checks whether a key has been pinned for a peer."""
+        return peer in self.pinned_keys
+
+    def _save_pins(self) -> None:
+        """Writes the pinned keys if this identity was loaded from disk."""
+        if self.pin_file:
+            os.makedirs(os.path.dirname(self.pin_file) or ".", exist_ok=True)
+            with open(self.pin_file, "w", encoding="utf-8") as f:
+                json.dump(self.pinned_keys, f)
+
+    def has_peer(self, peer: str) -> bool:
+        """Checks whether a peer's public key is known."""
+        return peer == self.username or peer in self.peer_keys
+
+    def has_group(self, group: str) -> bool:
+        """Checks whether the key of a group is known."""
+        return group in self.group_keys
+
+    def _pair_cipher(self, peer: str) -> AEADCipher:
+        """Returns the cached pairwise cipher, deriving it on first use."""
+        cipher = self._pair_ciphers.get(peer)
+        if cipher is None:
+            if peer == self.username:
+                peer_pub = self.private_key.public_key()
+            else:
+                peer_pub = X25519PublicKey.from_public_bytes(base64.b64decode(self.peer_keys[peer]))
+            shared = self.private_key.exchange(peer_pub)
+            names = "\x00".join(sorted((self.username, peer))).encode('utf-8')
+            key = HKDF(hashes.SHA256(), AEAD_KEY_SIZE, None,
+                       b"secure-messenger/dm/" + names).derive(shared)
+            cipher = AEADCipher(KeyRing(SUITE_AES_GCM, {1: key}, 1))
+            self._pair_ciphers[peer] = cipher
+        return cipher
+
+    def _group_cipher(self, group: str) -> AEADCipher:
+        """Returns the cached cipher for a group key."""
+        cipher = self._group_ciphers.get(group)
+        if cipher is None:
+            cipher = AEADCipher(KeyRing(SUITE_AES_GCM, {1: self.group_keys[group]}, 1))
+            self._group_ciphers[group] = cipher
+        return cipher
+
+    @staticmethod
+    def _seal(cipher: AEADCipher, data: bytes) -> str:
+        """Encrypts bytes into a prefixed E2E token."""
+        return E2E_PREFIX + base64.b64encode(cipher.encrypt(data)).decode('ascii')
+
+    @staticmethod
+    def _open(cipher: AEADCipher, token: str) -> bytes:
+        """Decrypts a prefixed E2E token."""
+        return cipher.decrypt(base64.b64decode(token[len(E2E_PREFIX):]))
+
+    def encrypt_for(self, peer: str, text: str) -> str:
+        """Encrypts a direct message for a peer."""
+        return self._seal(self._pair_cipher(peer), text.encode('utf-8'))
+
+    def decrypt_from(self, peer: str, token: str) -> str:
+        """Decrypts a direct message exchanged with a peer."""
+        try:
+            return self._open(self._pair_cipher(peer), token).decode('utf-8')
+        except Exception:  # pylint: disable=broad-exception-caught
+            return DECRYPTION_ERROR
+
+    def new_group_key(self, group: str) -> None:
+        """Creates a fresh key for a group this user just created."""
+        self.group_keys[group] = os.urandom(AEAD_KEY_SIZE)
+        self._group_ciphers.pop(group, None)
+
+    def forget_group(self, group: str) -> None:
+        """Drops a locally held group key."""
+        self.group_keys.pop(group, None)
+        self._group_ciphers.pop(group, None)
+
+    def wrap_group_key(self, group: str, member: str) -> str:
+        """Encrypts the group key for one member (their public key must be known)."""
+        return self._seal(self._pair_cipher(member), self.group_keys[group])
+
+    def unwrap_group_key(self, group: str, wrapped: str, wrapped_by: str) -> bool:
+        """Installs a group key wrapped for this user. Returns False if it is invalid."""
+        try:
+            self.group_keys[group] = self._open(self._pair_cipher(wrapped_by), wrapped)
+        except Exception:  # pylint: disable=broad-exception-caught
+            return False
+        self._group_ciphers.pop(group, None)
+        return True
+
+    def encrypt_for_group(self, group: str, text: str) -> str:
+        """Encrypts a message for a group."""
+        return self._seal(self._group_cipher(group), text.encode('utf-8'))
+
+    def decrypt_for_group(self, group: str, token: str) -> str:
+        """Decrypts a group message."""
+        try:
+            return self._open(self._group_cipher(group), token).decode('utf-8')
+        except Exception:  # pylint: disable=broad-exception-caught
+            return DECRYPTION_ERROR
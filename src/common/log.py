@@ -0,0 +1,181 @@
+"""
+Structured, queue-backed logging.
+Records are enqueued on the calling thread and formatted/written by a
+background QueueListener, so a burst of errors never blocks handler threads
+on stdout. Per-connection context (user, action, request id) is attached
+from a context variable, and repeated messages are rate-limited and sampled.
+"""
+
+import copy
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Iterator, Optional, TextIO, Tuple
+
+LOGGER_NAME: str = "secure_messenger"
+
+# Each message template may be logged BURST times per WINDOW seconds; after
+# that only every SAMPLE_EVERY-th occurrence gets through.
+BURST: int = 10
+WINDOW: float = 10.0
+SAMPLE_EVERY: int = 100
+
+_context: ContextVar[Dict[str, Any]] = ContextVar("log_context", default={})
+_listener: Optional[QueueListener] = None  # pylint: disable=invalid-name
+_handler: Optional[QueueHandler] = None  # pylint: disable=invalid-name
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Returns a child of the application logger, e.g. get_logger("server")."""
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+
+@contextmanager
+def log_context(**fields: Any) -> Iterator[None]:
+    """Adds fields to every record logged by this thread inside the block."""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def bind_context(**fields: Any) -> None:
+    """Adds fields to the current thread's context until it ends."""
+    _context.set({**_context.get(), **fields})
+
+
+class ContextFilter(logging.Filter):  # pylint: disable=too-few-public-methods
+    """Copies the current log context onto the record as `record.ctx`."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.ctx = dict(_context.get())
+        return True
+
+
+class RateLimitFilter(logging.Filter):  # pylint: disable=too-few-public-methods
+    """
+    Limits repeated records with the same logger, level and message template.
+    The next record that gets through reports how many were suppressed.
+    """
+
+    def __init__(self, burst: int = BURST, window: float = WINDOW,
+                 sample_every: int = SAMPLE_EVERY) -> None:
+        super().__init__()
+        self.burst: int = burst
+        self.window: float = window
+        self.sample_every: int = sample_every
+        self._lock: threading.Lock = threading.Lock()
+        # key -> [window start, seen in window, suppressed since last emit]
+        self._state: Dict[Tuple[str, int, str], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            state = self._state.get(key)
+            if state is None or now - state[0] >= self.window:
+                suppressed = state[2] if state else 0
+                state = self._state[key] = [now, 0, suppressed]
+            state[1] += 1
+            seen = state[1]
+            allowed = (seen <= self.burst
+                       or (self.sample_every > 0 and (seen - self.burst) % self.sample_every == 0))
+            if not allowed:
+                state[2] += 1
+                return False
+            record.suppressed = state[2]
+            state[2] = 0
+        return True
+
+
+class StructuredQueueHandler(QueueHandler):
+    """QueueHandler that keeps the message and traceback as separate fields."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        entry.update(getattr(record, "ctx", {}))
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(level: int = logging.INFO, stream: Optional[TextIO] = None,
+                  burst: int = BURST, window: float = WINDOW,
+                  sample_every: int = SAMPLE_EVERY) -> QueueListener:
+    """
+    Routes the application logger through a queue to a background writer.
+    Calling it again replaces the previous configuration.
+
+    Args:
+        level: Minimum level to log.
+        stream: Destination for JSON lines (defaults to stderr).
+        burst: Records per message template allowed in each window.
+        window: Rate-limit window in seconds.
+        sample_every: After the burst, pass one in this many (0 drops them all).
+
+    Returns:
+        QueueListener: The running listener (stopped by shutdown_logging).
+    """
+    global _listener, _handler  # pylint: disable=global-statement
+    shutdown_logging()
+
+    records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JsonFormatter())
+
+    _handler = StructuredQueueHandler(records)
+    _handler.addFilter(RateLimitFilter(burst, window, sample_every))
+    _handler.addFilter(ContextFilter())
+
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(level)
+    logger.addHandler(_handler)
+    logger.propagate = False
+
+    _listener = QueueListener(records, output)
+    _listener.start()
+    return _listener
+
+
+def shutdown_logging() -> None:
+    """Flushes queued records and detaches the queue handler."""
+    global _listener, _handler  # pylint: disable=global-statement
+    if _listener:
+        _listener.stop()
+        _listener = None
+    if _handler:
+        logger = logging.getLogger(LOGGER_NAME)
+        logger.removeHandler(_handler)
+        logger.propagate = True
+        _handler = None
@@ -1,35 +1,237 @@
 """
 Module for handling network protocol operations including
 sending and receiving JSON data with length-prefixed headers.
+
+The top bit of the 4-byte length header marks a zlib-compressed body.
+Compression is negotiated at login; decoding is always supported.
 """
 
+import asyncio
 import json
+import select
 import socket
 import struct
-from typing import Optional, Dict, Any, cast
+import time
+import zlib
+from typing import Optional, Dict, Any, Callable, Tuple, cast
+from src.common.log import get_logger
+from src.common.crypto_utils import E2E_PREFIX, envelope_prefix
 
 HOST: str = '127.0.0.1'
 PORT: int = 5050
 HEADER_SIZE: int = 4
 
+FLAG_COMPRESSED: int = 0x80000000
+LENGTH_MASK: int = 0x7FFFFFFF
+COMPRESSION: str = "zlib"
+COMPRESS_THRESHOLD: int = 512
+COMPRESS_LEVEL: int = 6
+MAX_DECOMPRESSED_SIZE: int = 64 * 1024 * 1024
+# Largest frame receive_json accepts; servers pass a much smaller limit to read_frame.
+MAX_FRAME_SIZE: int = 64 * 1024 * 1024
+RECV_CHUNK: int = 65536
+# Seconds of silence before a peer is pinged, and before it is considered dead.
+HEARTBEAT_INTERVAL: float = 30.0
+HEARTBEAT_TIMEOUT: float = 90.0
+# Preset dictionary of the keys and values that open most frames (data_update,
+# history_response and msg), so even the first bytes compress well. Message texts
+# start with the AEAD envelope header (AES-GCM, key 1), alone or after the E2E prefix.
+_ENVELOPE: bytes = envelope_prefix().encode('ascii')
+ZDICT: bytes = (
+    b'{"action": "data_update", "friends": [], "groups": ["#"], "requests": [], '
+    b'"active_users": [], "public_rooms": [["&", ""]], "status": "success", '
+    b'{"action": "history_response", "target": "", "messages": '
+    b'[{"id": , "sender": "", "to": "", "text": "' + _ENVELOPE + b'"}, '
+    b'{"action": "msg", "sender": "", "to": "", "text": "' + E2E_PREFIX.encode('ascii') + _ENVELOPE
+)
+
+logger = get_logger("protocol")
+
+# Optional hook called with ("in" | "out", frame size in bytes) for every frame.
+_frame_observer: Optional[Callable[[str, int], None]] = None  # pylint: disable=invalid-name
+
+
+class FrameError(Exception):
+    """
+    Raised by read_frame when a peer sends an oversized frame, exceeds its
+    read budget, stays idle too long or sends a frame too slowly.
+    """
+
+    def __init__(self, reason: str, msg: str) -> None:
+        super().__init__(msg)
+        self.reason: str = reason
+
 
-def send_json(sock: socket.socket, data_dict: Dict[str, Any]) -> None:
+class ReadBudget:  # pylint: disable=too-few-public-methods
+    """Token bucket of bytes a connection may send: `capacity` per `window` seconds."""
+
+    def __init__(self, capacity: int, window: float) -> None:
+        self.capacity: float = float(capacity)
+        self.rate: float = capacity / window
+        self.tokens: float = float(capacity)
+        self.stamp: float = time.monotonic()
+
+    def charge(self, size: int) -> bool:
+        """Takes `size` bytes from the budget; returns False if they are not available."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if size > self.tokens:
+            return False
+        self.tokens -= size
+        return True
+
+
+def set_frame_observer(observer: Optional[Callable[[str, int], None]]) -> None:
+    """Installs (or removes, with None) a process-wide frame size observer."""
+    global _frame_observer  # pylint: disable=global-statement
+    _frame_observer = observer
+
+
+def encode_frame(data_dict: Dict[str, Any], compress: bool = False) -> bytes:
+    """
+    Serializes a dictionary into a length-prefixed JSON frame.
+
+    Args:
+        data_dict: The dictionary to send.
+        compress: Compress bodies of at least COMPRESS_THRESHOLD bytes when that
+            makes them smaller (only for peers that negotiated compression).
+    """
+    json_data = json.dumps(data_dict, ensure_ascii=False).encode('utf-8')
+    if compress and len(json_data) >= COMPRESS_THRESHOLD:
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zdict=ZDICT)
+        packed = compressor.compress(json_data) + compressor.flush()
+        if len(packed) < len(json_data):
+            return struct.pack('!I', len(packed) | FLAG_COMPRESSED) + packed
+    return struct.pack('!I', len(json_data)) + json_data
+
+
+def decode_frame(body: bytes, compressed: bool = False,
+                 max_inflated: int = MAX_DECOMPRESSED_SIZE) -> Dict[str, Any]:
+    """
+    Parses the body of a frame (without its header).
+
+    Raises:
+        ValueError: If the body is not valid (compressed) JSON or inflates
+            beyond `max_inflated` bytes.
+    """
+    if compressed:
+        try:
+            inflater = zlib.decompressobj(zdict=ZDICT)
+            body = inflater.decompress(body, max_inflated)
+        except zlib.error as e:
+            raise ValueError(f"Corrupt compressed frame: {e}") from e
+        if inflater.unconsumed_tail or not inflater.eof:
+            raise ValueError("Compressed frame is truncated or too large")
+    return cast(Dict[str, Any], json.loads(body.decode('utf-8')))
+
+
+def split_header(header: bytes) -> Tuple[int, bool]:
+    """Returns (body length, compressed flag) from a 4-byte frame header."""
+    value = struct.unpack('!I', header)[0]
+    return value & LENGTH_MASK, bool(value & FLAG_COMPRESSED)
+
+
+def send_json(sock: socket.socket, data_dict: Dict[str, Any], compress: bool = False) -> None:
     """
     Sends a dictionary as a JSON message with a length-prefixed header.
 
     Args:
         sock: The target socket.
         data_dict: The dictionary containing data to send.
+        compress: Whether the peer negotiated compression.
     """
     try:
-        json_data = json.dumps(data_dict, ensure_ascii=False).encode('utf-8')
-        header = struct.pack('!I', len(json_data))
-        sock.sendall(header + json_data)
+        frame = encode_frame(data_dict, compress)
+        sock.sendall(frame)
+        if _frame_observer:
+            _frame_observer("out", len(frame))
     except Exception as e:  # pylint: disable=broad-exception-caught
-        print(f"Error sending: {e}")
+        logger.warning("Error sending: %s", e)
+
+
+def _wait_readable(sock: socket.socket, timeout: Optional[float]) -> bool:
+    """
+    Waits up to `timeout` seconds (forever if None) for data or EOF on `sock`.
+
+    Deadlines are enforced here rather than with sock.settimeout(): the
+    socket's timeout also applies to sendall, and lane workers send on the
+    same socket while its reader waits. A send cut short by the reader's
+    deadline would leave a partial frame in the stream.
+    """
+    if timeout is None:
+        return True
+    timeout = max(timeout, 0.0)
+    if hasattr(select, "poll"):
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        return bool(poller.poll(timeout * 1000))
+    return bool(select.select([sock], [], [], timeout)[0])
+
+
+def _recv_exactly(sock: socket.socket, size: int, deadline: Optional[float]) -> Optional[bytes]:
+    """Reads exactly `size` bytes, or returns None if the peer closes first."""
+    buf = bytearray()
+    while len(buf) < size:
+        if deadline is not None and not _wait_readable(sock, deadline - time.monotonic()):
+            raise FrameError("slow", "Frame not received in time")
+        chunk = sock.recv(min(size - len(buf), RECV_CHUNK))
+        if not chunk:
+            return None
+        buf += chunk
+    return bytes(buf)
+
+
+def read_frame(sock: socket.socket, max_size: int = MAX_FRAME_SIZE, *,  # pylint: disable=too-many-arguments
+               idle_timeout: Optional[float] = None, frame_timeout: Optional[float] = None,
+               budget: Optional[ReadBudget] = None,
+               max_inflated: int = MAX_DECOMPRESSED_SIZE) -> Optional[Dict[str, Any]]:
+    """
+    Reads one frame, rejecting it as soon as its header shows it is too large.
+
+    Args:
+        sock: The source socket.
+        max_size: Largest body accepted, checked before any of it is read.
+        idle_timeout: Seconds to wait for the next frame to start (None waits forever).
+        frame_timeout: Seconds allowed from the first header byte to the last body byte.
+        budget: Byte budget charged with each frame before its body is read.
+        max_inflated: Largest body accepted after decompression.
+
+    Returns:
+        The parsed dictionary, or None if the peer closed the connection.
 
+    Raises:
+        FrameError: Oversized frame, exhausted budget, idle or slow peer.
+        ValueError: Malformed frame body.
+        OSError: Socket errors.
+    """
+    if not _wait_readable(sock, idle_timeout):
+        raise FrameError("idle", "Idle timeout")
+    header = sock.recv(HEADER_SIZE)
+    if not header:
+        return None
 
-def receive_json(sock: socket.socket) -> Optional[Dict[str, Any]]:
+    deadline = time.monotonic() + frame_timeout if frame_timeout is not None else None
+    if len(header) < HEADER_SIZE:
+        rest = _recv_exactly(sock, HEADER_SIZE - len(header), deadline)
+        if rest is None:
+            return None
+        header += rest
+    msg_length, compressed = split_header(header)
+    if msg_length > max_size:
+        raise FrameError("too_large", f"Frame of {msg_length} bytes exceeds limit of {max_size}")
+    if budget and not budget.charge(HEADER_SIZE + msg_length):
+        raise FrameError("budget", "Read budget exceeded")
+
+    data = _recv_exactly(sock, msg_length, deadline)
+    if data is None:
+        return None
+    if _frame_observer:
+        _frame_observer("in", HEADER_SIZE + msg_length)
+    return decode_frame(data, compressed, max_inflated)
+
+
+def receive_json(sock: socket.socket, max_size: int = MAX_FRAME_SIZE) -> Optional[Dict[str, Any]]:
     """
     Receives exactly one JSON message from the socket.
 
@@ -37,23 +239,55 @@ def receive_json(sock: socket.socket) -> Optional[Dict[str, Any]]:
 
     Args:
         sock: The source socket.
+        max_size: Largest frame accepted.
 
     Returns:
         The parsed dictionary or None if connection fails/closes.
     """
     try:
-        header = sock.recv(HEADER_SIZE)
-        if not header:
-            return None
-        msg_length = struct.unpack('!I', header)[0]
+        return read_frame(sock, max_size)
+    except Exception:  # pylint: disable=broad-exception-caught
+        return None
 
-        data = b""
-        while len(data) < msg_length:
-            chunk = sock.recv(min(msg_length - len(data), 4096))
-            if not chunk:
-                return None
-            data += chunk
 
-        return cast(Dict[str, Any], json.loads(data.decode('utf-8')))
-    except Exception:  # pylint: disable=broad-exception-caught
+async def async_send_json(writer: asyncio.StreamWriter, data_dict: Dict[str, Any],
+                          compress: bool = False) -> None:
+    """
+    Sends a dictionary as a length-prefixed JSON frame on an asyncio stream.
+    Unlike send_json, connection errors are raised to the caller.
+
+    Args:
+        writer: The target stream.
+        data_dict: The dictionary containing data to send.
+        compress: Whether the peer negotiated compression.
+    """
+    frame = encode_frame(data_dict, compress)
+    writer.write(frame)
+    await writer.drain()
+    if _frame_observer:
+        _frame_observer("out", len(frame))
+
+
+async def async_receive_json(reader: asyncio.StreamReader,
+                             max_size: int = MAX_FRAME_SIZE) -> Optional[Dict[str, Any]]:
+    """
+    Receives exactly one JSON frame from an asyncio stream.
+
+    Args:
+        reader: The source stream.
+        max_size: Largest frame accepted.
+
+    Returns:
+        The parsed dictionary or None if the connection fails/closes.
+    """
+    try:
+        header = await reader.readexactly(HEADER_SIZE)
+        msg_length, compressed = split_header(header)
+        if msg_length > max_size:
+            return None
+        data = await reader.readexactly(msg_length)
+        if _frame_observer:
+            _frame_observer("in", HEADER_SIZE + msg_length)
+        return decode_frame(data, compressed)
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
         return None
@@ -0,0 +1,121 @@
+"""
+Admission control for client requests.
+
+Each user gets a token bucket per action, and a global controller caps
+concurrent connections and requests being processed. When the server is
+busy, expensive reads (get_history, get_data) are shed before message
+delivery.
+"""
+
+import threading
+from types import MappingProxyType
+from typing import Dict, Mapping, Optional, Tuple
+from src.common.protocol import ReadBudget
+
+# Requests allowed per user: (burst, per window seconds); "*" covers other actions.
+DEFAULT_RATES: Mapping[str, Tuple[int, float]] = MappingProxyType({
+    "msg": (30, 10.0),
+    "get_history": (20, 10.0),
+    "get_data": (10, 10.0),
+    "*": (60, 10.0),
+})
+# Shed first when the server is busy.
+LOW_PRIORITY = frozenset({"get_history", "get_data"})
+# Never limited: heartbeats must get through for a busy server to stay reachable.
+EXEMPT = frozenset({"ping", "pong"})
+# Fraction of max_in_flight that low-priority requests may occupy.
+SHED_FRACTION: float = 0.5
+
+
+class RateLimiter:
+    """Per-user, per-action token buckets."""
+
+    def __init__(self, rates: Mapping[str, Tuple[int, float]] = DEFAULT_RATES) -> None:
+        """
+        Initializes the limiter.
+
+        Args:
+            rates: (burst, window seconds) per action, with "*" as the fallback.
+                Actions without an entry and no fallback are not limited.
+        """
+        self.rates: Mapping[str, Tuple[int, float]] = rates
+        self._buckets: Dict[Tuple[str, str], ReadBudget] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def allow(self, user: str, action: str) -> Optional[float]:
+        """
+        Takes one token from the user's bucket for this action.
+
+        Returns:
+            None if the request may proceed, otherwise the seconds until it would.
+        """
+        key = action if action in self.rates else "*"
+        if key not in self.rates:
+            return None
+        with self._lock:
+            bucket = self._buckets.get((user, key))
+            if bucket is None:
+                bucket = self._buckets[(user, key)] = ReadBudget(*self.rates[key])
+            if bucket.charge(1):
+                return None
+            return (1 - bucket.tokens) / bucket.rate
+
+    def forget(self, user: str) -> None:
+        """Drops a user's buckets once their last session has closed."""
+        with self._lock:
+            for key in [k for k in self._buckets if k[0] == user]:
+                del self._buckets[key]
+
+
+class AdmissionController:
+    """Caps open connections and requests being processed at once."""
+
+    def __init__(self, max_connections: int, max_in_flight: int,
+                 shed_fraction: float = SHED_FRACTION) -> None:
+        """
+        Initializes the controller.
+
+        Args:
+            max_connections: Connections served at once; more are refused.
+            max_in_flight: Requests processed at once.
+            shed_fraction: Share of max_in_flight that LOW_PRIORITY actions may use.
+        """
+        self.max_connections: int = max_connections
+        self.max_in_flight: int = max_in_flight
+        self.low_priority_limit: int = max(1, int(max_in_flight * shed_fraction))
+        self.connections: int = 0
+        self.in_flight: int = 0
+        self._lock: threading.Lock = threading.Lock()
+
+    def open_connection(self) -> bool:
+        """Reserves a connection slot; False if the server is full."""
+        with self._lock:
+            if self.connections >= self.max_connections:
+                return False
+            self.connections += 1
+            return True
+
+    def close_connection(self) -> None:
+        """Releases a connection slot."""
+        with self._lock:
+            self.connections -= 1
+
+    def begin(self, action: str) -> bool:
+        """
+        Reserves a processing slot for a request. Low-priority actions are
+        refused once they would take more than their share.
+
+        Returns:
+            bool: False if the request should be shed; otherwise end() must follow.
+        """
+        limit = self.low_priority_limit if action in LOW_PRIORITY else self.max_in_flight
+        with self._lock:
+            if self.in_flight >= limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def end(self) -> None:
+        """Releases a processing slot."""
+        with self._lock:
+            self.in_flight -= 1
@@ -3,25 +3,44 @@ Database module handling SQLite interactions for users, friends,
 groups, public rooms, and message history.
 """
 
+import contextlib
 import sqlite3
 import hashlib
 import os
-from typing import List, Tuple, Dict
+import sys
+from typing import Any, Iterator, List, Tuple, Dict, Optional, Set
+from src.server.message_log import MessageLog
 
 DB_DIR: str = "data"
 DB_PATH: str = os.path.join(DB_DIR, "data.db")
+# Per-month archive files live in this directory next to DB_PATH.
+ARCHIVE_DIR_NAME: str = "archive"
 
 
-class Database:
+class Database:  # pylint: disable=too-many-public-methods
     """
     Handles all SQLite database interactions including users, friends,
     groups, public rooms, and message history.
     """
 
-    def __init__(self) -> None:
+    def __init__(self, message_log: Optional[MessageLog] = None) -> None:
+        """
+        Opens the database, creating or migrating its tables.
+
+        Args:
+            message_log: Optional append-only store for messages. When given,
+                store_message, get_chat_history, get_messages_since and
+                get_last_message_id use it instead of the messages table.
+        """
         if not os.path.exists(DB_DIR):
             os.makedirs(DB_DIR)
         self.create_tables()
+        self.message_log: Optional[MessageLog] = message_log
+        # Usernames known to be registered; users are never deleted.
+        self._known_users: Set[str] = set()
+        if message_log is not None:
+            # New ids continue after SQLite's, so device cursors stay valid.
+            message_log.advance_to(self._sqlite_last_message_id())
 
     def get_connection(self) -> sqlite3.Connection:
         """Creates and returns a new database connection."""
@@ -72,18 +91,156 @@ class Database:
                         creator TEXT
                     )
                 """)
+                backfill_rooms = not conn.execute(
+                    "SELECT name FROM sqlite_master WHERE type='table' AND name='room_members'"
+                ).fetchone()
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS room_members (
+                        room_name TEXT NOT NULL,
+                        username TEXT NOT NULL,
+                        PRIMARY KEY (room_name, username)
+                    )
+                """)
+                if backfill_rooms:
+                    # Rooms created before subscriptions existed keep their creator.
+                    conn.execute(
+                        "INSERT OR IGNORE INTO room_members (room_name, username) "
+                        "SELECT room_name, creator FROM public_rooms WHERE creator IS NOT NULL"
+                    )
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS group_keys (
+                        group_name TEXT NOT NULL,
+                        username TEXT NOT NULL,
+                        wrapped_key TEXT NOT NULL,
+                        wrapped_by TEXT NOT NULL,
+                        PRIMARY KEY (group_name, username)
+                    )
+                """)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS conversations (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        name TEXT UNIQUE,
+                        user_lo INTEGER REFERENCES users(id),
+                        user_hi INTEGER REFERENCES users(id),
+                        UNIQUE (user_lo, user_hi)
+                    )
+                """)
+                columns = [row[1] for row in conn.execute("PRAGMA table_info(messages)")]
+                migrate_messages = "receiver" in columns
+                if migrate_messages:
+                    # Old schema keyed by usernames; moved over in one transaction below.
+                    if not conn.in_transaction:
+                        conn.execute("BEGIN")
+                    conn.execute("ALTER TABLE messages RENAME TO messages_v1")
                 conn.execute("""
                     CREATE TABLE IF NOT EXISTS messages (
                         id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        sender TEXT NOT NULL,
-                        receiver TEXT NOT NULL,
+                        conversation_id INTEGER NOT NULL REFERENCES conversations(id),
+                        sender_id INTEGER NOT NULL REFERENCES users(id),
                         content TEXT NOT NULL,
                         timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
                     )
                 """)
+                conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_messages_conversation "
+                    "ON messages (conversation_id, id)"
+                )
+                if migrate_messages:
+                    self._migrate_messages(conn)
+                # Archived months: the id range each file holds and its conversations.
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS archives (
+                        month TEXT PRIMARY KEY,
+                        min_id INTEGER NOT NULL,
+                        max_id INTEGER NOT NULL
+                    )
+                """)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS archived_conversations (
+                        conversation_id INTEGER NOT NULL,
+                        month TEXT NOT NULL,
+                        PRIMARY KEY (conversation_id, month)
+                    )
+                """)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS device_cursors (
+                        username TEXT NOT NULL,
+                        device TEXT NOT NULL,
+                        last_message_id INTEGER NOT NULL,
+                        PRIMARY KEY (username, device)
+                    )
+                """)
+                columns = [row[1] for row in conn.execute("PRAGMA table_info(users)")]
+                if "public_key" not in columns:
+                    conn.execute("ALTER TABLE users ADD COLUMN public_key TEXT")
         finally:
             conn.close()
 
+    @staticmethod
+    def _migrate_messages(conn: sqlite3.Connection) -> None:
+        """
+        Moves messages_v1 rows (sender/receiver usernames) to conversation ids.
+        Message ids are kept so device cursors stay valid. Rows naming an
+        unknown user cannot be mapped and are left in messages_v1.
+        """
+        conn.execute(
+            "INSERT OR IGNORE INTO conversations (name) SELECT DISTINCT receiver "
+            "FROM messages_v1 WHERE receiver LIKE '#%' OR receiver LIKE '&%'"
+        )
+        conn.execute("""
+            INSERT OR IGNORE INTO conversations (user_lo, user_hi)
+            SELECT DISTINCT MIN(s.id, r.id), MAX(s.id, r.id) FROM messages_v1 m
+            JOIN users s ON s.username = m.sender
+            JOIN users r ON r.username = m.receiver
+            WHERE m.receiver NOT LIKE '#%' AND m.receiver NOT LIKE '&%'
+        """)
+        conn.execute("""
+            INSERT INTO messages (id, conversation_id, sender_id, content, timestamp)
+            SELECT m.id, c.id, s.id, m.content, m.timestamp FROM messages_v1 m
+            JOIN users s ON s.username = m.sender
+            JOIN conversations c ON c.name = m.receiver
+        """)
+        conn.execute("""
+            INSERT INTO messages (id, conversation_id, sender_id, content, timestamp)
+            SELECT m.id, c.id, s.id, m.content, m.timestamp FROM messages_v1 m
+            JOIN users s ON s.username = m.sender
+            JOIN users r ON r.username = m.receiver
+            JOIN conversations c ON c.user_lo = MIN(s.id, r.id) AND c.user_hi = MAX(s.id, r.id)
+            WHERE m.receiver NOT LIKE '#%' AND m.receiver NOT LIKE '&%'
+        """)
+        conn.execute("DELETE FROM messages_v1 WHERE id IN (SELECT id FROM messages)")
+        if not conn.execute("SELECT 1 FROM messages_v1 LIMIT 1").fetchone():
+            conn.execute("DROP TABLE messages_v1")
+
+    @staticmethod
+    def _conversation_id(conn: sqlite3.Connection, user: str, other: str,
+                         create: bool = False) -> Optional[int]:
+        """
+        Returns the id of the conversation between `user` and `other` (a user,
+        #group or &room), creating it if asked.
+
+        Returns:
+            The id, or None if it does not exist or `other` is an unknown user.
+        """
+        if other.startswith("#") or other.startswith("&"):
+            select, insert = "WHERE name = ?", "(name) VALUES (?)"
+            params: Tuple[Any, ...] = (other,)
+        else:
+            ids = dict(conn.execute(
+                "SELECT username, id FROM users WHERE username IN (?, ?)", (user, other)
+            ).fetchall())
+            if user not in ids or other not in ids:
+                return None
+            select, insert = "WHERE user_lo = ? AND user_hi = ?", "(user_lo, user_hi) VALUES (?, ?)"
+            params = (min(ids[user], ids[other]), max(ids[user], ids[other]))
+        row = conn.execute(f"SELECT id FROM conversations {select}", params).fetchone()
+        if row is None and create:
+            # Only the first message of a conversation writes here; OR IGNORE covers a
+            # concurrent first message on another connection.
+            conn.execute(f"INSERT OR IGNORE INTO conversations {insert}", params)
+            row = conn.execute(f"SELECT id FROM conversations {select}", params).fetchone()
+        return int(row[0]) if row else None
+
     def _hash_password(self, password: str) -> str:
         """Hashes a password using SHA-256."""
         return hashlib.sha256(password.encode()).hexdigest()
@@ -117,6 +274,28 @@ class Database:
         finally:
             conn.close()
 
+    def set_public_key(self, username: str, public_key: str) -> None:
+        """Stores the user's E2E public key."""
+        conn = self.get_connection()
+        try:
+            with conn:
+                conn.execute(
+                    "UPDATE users SET public_key = ? WHERE username = ?", (public_key, username)
+                )
+        finally:
+            conn.close()
+
+    def get_public_key(self, username: str) -> Optional[str]:
+        """Returns the user's E2E public key, or None if unknown."""
+        conn = self.get_connection()
+        try:
+            row = conn.execute(
+                "SELECT public_key FROM users WHERE username = ?", (username,)
+            ).fetchone()
+            return row[0] if row and row[0] else None
+        finally:
+            conn.close()
+
     def send_friend_request(self, sender: str, receiver: str) -> str:
         """Sends a friend request. Returns status string."""
         if sender == receiver:
@@ -240,6 +419,32 @@ class Database:
         finally:
             conn.close()
 
+    def store_group_key(self, group_name: str, username: str,
+                        wrapped_key: str, wrapped_by: str) -> None:
+        """Stores a group key wrapped for one member."""
+        conn = self.get_connection()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO group_keys "
+                    "(group_name, username, wrapped_key, wrapped_by) VALUES (?, ?, ?, ?)",
+                    (group_name, username, wrapped_key, wrapped_by)
+                )
+        finally:
+            conn.close()
+
+    def get_group_key(self, group_name: str, username: str) -> Optional[Tuple[str, str]]:
+        """Returns (wrapped_key, wrapped_by) for a member, or None."""
+        conn = self.get_connection()
+        try:
+            row = conn.execute(
+                "SELECT wrapped_key, wrapped_by FROM group_keys "
+                "WHERE group_name = ? AND username = ?", (group_name, username)
+            ).fetchone()
+            return (row[0], row[1]) if row else None
+        finally:
+            conn.close()
+
     def create_public_room(self, room_name: str, tags: str, creator: str) -> bool:
         """Creates a public room with tags."""
         conn = self.get_connection()
@@ -249,6 +454,10 @@ class Database:
                     "INSERT INTO public_rooms (room_name, tags, creator) VALUES (?, ?, ?)",
                     (room_name, tags, creator)
                 )
+                conn.execute(
+                    "INSERT INTO room_members (room_name, username) VALUES (?, ?)",
+                    (room_name, creator)
+                )
             return True
         except sqlite3.IntegrityError:
             return False
@@ -264,42 +473,352 @@ class Database:
         finally:
             conn.close()
 
-    def store_message(self, sender: str, receiver: str, encrypted_content: str) -> None:
-        """Stores an encrypted message in the database for history/offline access."""
+    def join_room(self, room_name: str, username: str) -> bool:
+        """Subscribes a user to a public room. Returns False if the room does not exist."""
         conn = self.get_connection()
         try:
+            if not conn.execute(
+                "SELECT room_name FROM public_rooms WHERE room_name = ?", (room_name,)
+            ).fetchone():
+                return False
             with conn:
                 conn.execute(
-                    "INSERT INTO messages (sender, receiver, content) VALUES (?, ?, ?)",
-                    (sender, receiver, encrypted_content)
+                    "INSERT OR IGNORE INTO room_members (room_name, username) VALUES (?, ?)",
+                    (room_name, username)
                 )
+            return True
         finally:
             conn.close()
 
-    def get_chat_history(self, user1: str, user2: str) -> List[Dict[str, str]]:
-        """Retrieves chat history between two entities."""
+    def leave_room(self, room_name: str, username: str) -> None:
+        """Unsubscribes a user from a public room."""
         conn = self.get_connection()
         try:
-            cursor = conn.cursor()
-            if user2.startswith("#") or user2.startswith("&"):
-                # Group/Room history
-                cursor.execute(
-                    "SELECT sender, receiver, content FROM messages "
-                    "WHERE receiver = ? ORDER BY id ASC",
-                    (user2,)
+            with conn:
+                conn.execute(
+                    "DELETE FROM room_members WHERE room_name = ? AND username = ?",
+                    (room_name, username)
                 )
-            else:
-                # Direct message history
-                cursor.execute("""
-                    SELECT sender, receiver, content FROM messages 
-                    WHERE (sender = ? AND receiver = ?) OR (sender = ? AND receiver = ?)
-                    ORDER BY id ASC
-                """, (user1, user2, user2, user1))
-
-            rows = cursor.fetchall()
-            history = []
-            for r in rows:
-                history.append({"sender": r[0], "to": r[1], "text": r[2]})
-            return history
         finally:
             conn.close()
+
+    def get_room_members(self, room_name: str) -> List[str]:
+        """Returns the subscribers of a public room."""
+        conn = self.get_connection()
+        try:
+            cursor = conn.execute(
+                "SELECT username FROM room_members WHERE room_name = ?", (room_name,)
+            )
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            conn.close()
+
+    def get_user_rooms(self, username: str) -> List[str]:
+        """Returns the public rooms a user is subscribed to."""
+        conn = self.get_connection()
+        try:
+            cursor = conn.execute(
+                "SELECT room_name FROM room_members WHERE username = ?", (username,)
+            )
+            return [row[0] for row in cursor.fetchall()]
+        finally:
+            conn.close()
+
+    def store_message(self, sender: str, receiver: str, encrypted_content: str) -> int:
+        """
+        Stores an encrypted message in the database for history/offline access.
+
+        Returns:
+            int: The id of the stored message, or 0 if the sender or the
+                direct-message receiver is not a registered user.
+        """
+        if self.message_log is not None:
+            named = receiver.startswith("#") or receiver.startswith("&")
+            if not self._is_registered(sender) or not (named or self._is_registered(receiver)):
+                return 0
+            return self.message_log.append(sender, receiver, encrypted_content)
+        conn = self.get_connection()
+        try:
+            # Nothing is written (or committed) for an unknown sender or receiver.
+            row = conn.execute("SELECT id FROM users WHERE username = ?", (sender,)).fetchone()
+            if not row:
+                return 0
+            with conn:
+                conversation = self._conversation_id(conn, sender, receiver, create=True)
+                if conversation is None:
+                    return 0
+                cursor = conn.execute(
+                    "INSERT INTO messages (conversation_id, sender_id, content) VALUES (?, ?, ?)",
+                    (conversation, row[0], encrypted_content)
+                )
+                return int(cursor.lastrowid or 0)
+        finally:
+            conn.close()
+
+    def _is_registered(self, username: str) -> bool:
+        """Returns whether a user exists, remembering those that do."""
+        if username in self._known_users:
+            return True
+        conn = self.get_connection()
+        try:
+            if not conn.execute("SELECT id FROM users WHERE username = ?", (username,)).fetchone():
+                return False
+        finally:
+            conn.close()
+        self._known_users.add(username)
+        return True
+
+    def get_last_message_id(self) -> int:
+        """Returns the id of the newest message, or 0 if there are none."""
+        if self.message_log is not None:
+            return self.message_log.last_id
+        return self._sqlite_last_message_id()
+
+    def _sqlite_last_message_id(self) -> int:
+        """Returns the last id given out by the messages table."""
+        conn = self.get_connection()
+        try:
+            # The sequence still counts messages that were moved to archives.
+            row = conn.execute(
+                "SELECT seq FROM sqlite_sequence WHERE name = 'messages'"
+            ).fetchone()
+            return int(row[0]) if row else 0
+        finally:
+            conn.close()
+
+    def get_device_cursor(self, username: str, device: str) -> Optional[int]:
+        """Returns the id of the last message delivered to a device, or None if it is new."""
+        conn = self.get_connection()
+        try:
+            row = conn.execute(
+                "SELECT last_message_id FROM device_cursors WHERE username = ? AND device = ?",
+                (username, device)
+            ).fetchone()
+            return int(row[0]) if row else None
+        finally:
+            conn.close()
+
+    def set_device_cursor(self, username: str, device: str, message_id: int) -> None:
+        """Records the last message delivered to a device."""
+        conn = self.get_connection()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO device_cursors (username, device, last_message_id) "
+                    "VALUES (?, ?, ?)",
+                    (username, device, message_id)
+                )
+        finally:
+            conn.close()
+
+    def get_messages_since(self, username: str, after_id: int,
+                           up_to_id: int) -> List[Dict[str, str]]:
+        """
+        Returns the direct and group messages a user sent or received with
+        after_id < id <= up_to_id, oldest first. Archived months in that
+        range are read too.
+        """
+        if self.message_log is not None:
+            groups = set(self.get_user_groups(username))
+            return self.message_log.messages_since(username, groups, after_id, up_to_id)
+        conn = self.get_connection()
+        try:
+            months = [r[0] for r in conn.execute(
+                "SELECT month FROM archives WHERE max_id > ? AND min_id <= ? ORDER BY min_id",
+                (after_id, up_to_id)
+            )]
+            rows: List[Tuple[str, str, str]] = []
+            for month in months:
+                with self._attached(conn, month) as table:
+                    if table:
+                        rows += self._messages_since(conn, table, username, after_id, up_to_id)
+            rows += self._messages_since(conn, "main.messages", username, after_id, up_to_id)
+            return [{"sender": r[0], "to": r[1], "text": r[2]} for r in rows]
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _messages_since(conn: sqlite3.Connection, table: str, username: str,
+                        after_id: int, up_to_id: int) -> List[Tuple[str, str, str]]:
+        """get_messages_since over one messages table: (sender, to, text) rows."""
+        return conn.execute(f"""
+            SELECT s.username,
+                   COALESCE(c.name, CASE WHEN m.sender_id = c.user_lo
+                                         THEN hi.username ELSE lo.username END),
+                   m.content
+            FROM {table} m
+            JOIN main.conversations c ON c.id = m.conversation_id
+            JOIN main.users s ON s.id = m.sender_id
+            LEFT JOIN main.users lo ON lo.id = c.user_lo
+            LEFT JOIN main.users hi ON hi.id = c.user_hi
+            WHERE m.id > ? AND m.id <= ?
+              AND (s.username = ? OR lo.username = ? OR hi.username = ?
+                   OR c.name IN (SELECT group_name FROM main.group_members WHERE username = ?))
+              AND (c.name IS NULL OR c.name NOT LIKE '&%')
+            ORDER BY m.id ASC
+        """, (after_id, up_to_id, username, username, username, username)).fetchall()
+
+    def get_chat_history(self, user1: str, user2: str, limit: Optional[int] = None,
+                         before: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        Retrieves chat history between two entities, oldest first. This is a
+        single range scan of one conversation. Archived months are attached
+        only when the page reaches past the hot database.
+
+        Args:
+            user1: The requesting user.
+            user2: The other user, or a #group / &room.
+            limit: Only the newest `limit` messages; None for all of them.
+            before: Only messages with an id below this.
+
+        Returns:
+            Messages as {"id", "sender", "to", "text"}.
+        """
+        if self.message_log is not None:
+            return self.message_log.history(user1, user2, limit, before)
+        conn = self.get_connection()
+        try:
+            conversation = self._conversation_id(conn, user1, user2)
+            if conversation is None:
+                return []
+            rows = self._history_rows(conn, "main.messages", conversation, limit, before)
+            if limit is None or len(rows) < limit:
+                # The page reaches past the hot database: read older months, newest first.
+                oldest = rows[-1][0] if rows else (sys.maxsize if before is None else before)
+                months = [r[0] for r in conn.execute("""
+                    SELECT a.month FROM archives a
+                    JOIN archived_conversations c ON c.month = a.month
+                    WHERE c.conversation_id = ? AND a.min_id < ?
+                    ORDER BY a.max_id DESC
+                """, (conversation, oldest))]
+                for month in months:
+                    if limit is not None and len(rows) >= limit:
+                        break
+                    with self._attached(conn, month) as table:
+                        if table:
+                            rows += self._history_rows(
+                                conn, table, conversation,
+                                None if limit is None else limit - len(rows),
+                                rows[-1][0] if rows else oldest)
+            rows.reverse()
+            # Group/room messages go to the group; a direct message to the other user.
+            named = user2.startswith("#") or user2.startswith("&")
+            return [{"id": r[0], "sender": r[1], "to": user2 if named or r[1] == user1 else user1,
+                     "text": r[2]} for r in rows]
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _history_rows(conn: sqlite3.Connection, table: str, conversation: int,
+                      limit: Optional[int], before: Optional[int]) -> List[Tuple[int, str, str]]:
+        """Newest-first (id, sender, content) rows of one conversation in one messages table."""
+        where, params = "m.conversation_id = ?", [conversation]
+        if before is not None:
+            where += " AND m.id < ?"
+            params.append(before)
+        query = (f"SELECT m.id, u.username, m.content FROM {table} m "
+                 f"JOIN main.users u ON u.id = m.sender_id WHERE {where} ORDER BY m.id DESC")
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        return conn.execute(query, params).fetchall()
+
+    @staticmethod
+    def archive_path(month: str) -> str:
+        """Returns the archive file for a month ("YYYY-MM")."""
+        return os.path.join(os.path.dirname(DB_PATH), ARCHIVE_DIR_NAME, f"messages-{month}.db")
+
+    @contextlib.contextmanager
+    def _attached(self, conn: sqlite3.Connection, month: str) -> Iterator[Optional[str]]:
+        """
+        Attaches a month's archive to `conn` for the duration of the block.
+
+        Yields:
+            The name of its messages table, or None if the file is missing.
+        """
+        path = self.archive_path(month)
+        if not os.path.exists(path):
+            yield None
+            return
+        conn.execute("ATTACH DATABASE ? AS archive", (path,))
+        try:
+            yield "archive.messages"
+        finally:
+            conn.execute("DETACH DATABASE archive")
+
+    def archive_messages(self, older_than_days: float) -> int:
+        """
+        Moves messages older than `older_than_days` into per-month archive
+        files, one transaction per month. Message ids are kept, so history
+        pages and device cursors span both.
+
+        The message log, when used, is not archived; see MessageLog.compact.
+
+        Returns:
+            int: Number of messages moved.
+        """
+        if self.message_log is not None:
+            return 0
+        conn = self.get_connection()
+        try:
+            cutoff = conn.execute(
+                "SELECT datetime('now', ?)", (f"-{older_than_days} days",)
+            ).fetchone()[0]
+            # Ids grow with time, so everything below the first recent id is old.
+            row = conn.execute(
+                "SELECT id FROM messages WHERE timestamp >= ? ORDER BY id LIMIT 1", (cutoff,)
+            ).fetchone()
+            boundary = row[0] if row else sys.maxsize
+            months = conn.execute("""
+                SELECT strftime('%Y-%m', timestamp), MIN(id), MAX(id) FROM messages
+                WHERE id < ? GROUP BY 1 ORDER BY 2
+            """, (boundary,)).fetchall()
+
+            moved = 0
+            for month, lo, hi in months:
+                os.makedirs(os.path.dirname(self.archive_path(month)), exist_ok=True)
+                conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path(month),))
+                try:
+                    moved += self._archive_month(conn, month, lo, hi)
+                finally:
+                    conn.execute("DETACH DATABASE archive")
+            return moved
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _archive_month(conn: sqlite3.Connection, month: str, lo: int, hi: int) -> int:
+        """Moves one month's messages with lo <= id <= hi into the attached archive."""
+        in_month = "id BETWEEN ? AND ? AND strftime('%Y-%m', timestamp) = ?"
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS archive.messages (
+                    id INTEGER PRIMARY KEY,
+                    conversation_id INTEGER NOT NULL,
+                    sender_id INTEGER NOT NULL,
+                    content TEXT NOT NULL,
+                    timestamp DATETIME
+                )
+            """)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS archive.idx_messages_conversation "
+                "ON messages (conversation_id, id)"
+            )
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO archive.messages "
+                "(id, conversation_id, sender_id, content, timestamp) "
+                f"SELECT id, conversation_id, sender_id, content, timestamp FROM main.messages "
+                f"WHERE {in_month}", (lo, hi, month)
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO archived_conversations (conversation_id, month) "
+                f"SELECT DISTINCT conversation_id, ? FROM main.messages WHERE {in_month}",
+                (month, lo, hi, month)
+            )
+            conn.execute("""
+                INSERT INTO archives (month, min_id, max_id) VALUES (?, ?, ?)
+                ON CONFLICT (month) DO UPDATE SET
+                    min_id = MIN(min_id, excluded.min_id), max_id = MAX(max_id, excluded.max_id)
+            """, (month, lo, hi))
+            conn.execute(f"DELETE FROM main.messages WHERE {in_month}", (lo, hi, month))
+            return cursor.rowcount
@@ -0,0 +1,137 @@
+"""
+Request lanes: separate worker pools for real-time messages, history/bulk
+reads and social-graph mutations, so a slow read never delays a send.
+
+Each lane has a fixed number of workers with one bounded FIFO queue each.
+Requests are routed to a worker by conversation key, so requests on the
+same conversation run one at a time and in arrival order. Requests that
+change who belongs to a conversation (MEMBERSHIP_ACTIONS) are finished
+before the connection reads on, because its next requests on any lane may
+depend on them.
+"""
+
+import contextvars
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from types import MappingProxyType
+from typing import Any, Callable, Dict, FrozenSet, Hashable, List, Mapping, Optional, Tuple
+
+REALTIME: str = "realtime"
+READS: str = "reads"
+SOCIAL: str = "social"
+
+# Workers and queued requests per worker for each lane.
+DEFAULT_LANES: Mapping[str, Tuple[int, int]] = MappingProxyType({
+    REALTIME: (4, 1000),
+    READS: (4, 100),
+    SOCIAL: (2, 500),
+})
+
+# Seconds a closing connection waits for its queued requests to finish.
+DRAIN_TIMEOUT: float = 5.0
+
+LANE_OF: Mapping[str, str] = MappingProxyType({
+    "msg": REALTIME,
+    "get_public_key": REALTIME,
+    "get_history": READS,
+    "get_data": READS,
+    "send_friend_request": SOCIAL,
+    "handle_request": SOCIAL,
+    "create_group": SOCIAL,
+    "join_group": SOCIAL,
+    "share_group_key": SOCIAL,
+    "get_group_key": SOCIAL,
+    "create_public_room": SOCIAL,
+    "join_room": SOCIAL,
+    "leave_room": SOCIAL,
+})
+
+# A msg to a group sent right after creating or joining it runs on another
+# lane; the connection waits for these so the message is not dropped by the
+# membership check.
+MEMBERSHIP_ACTIONS: FrozenSet[str] = frozenset({
+    "create_group", "join_group", "create_public_room", "join_room", "leave_room",
+})
+
+Task = Tuple["Future[Any]", contextvars.Context, Callable[[], Any], float]
+
+
+def conversation_key(user: str, req: Dict[str, Any]) -> Hashable:
+    """
+    Returns the conversation a request belongs to: the #group or &room, or
+    the pair of users of a direct chat. Group key actions share their group's
+    key so that creating a group and sharing its key stay in order.
+    """
+    action = req.get("action")
+    if action in ("create_public_room", "join_room", "leave_room"):
+        name = str(req.get("room_name", ""))
+        return name if name.startswith("&") else "&" + name
+    if "group_name" in req:
+        return str(req["group_name"])
+    other = str(req.get("to") or req.get("target") or req.get("sender") or "")
+    if other.startswith("#") or other.startswith("&"):
+        return other
+    return tuple(sorted((user, other))) if other else user
+
+
+class LaneExecutor:
+    """A pool of single-threaded workers, each draining its own bounded queue."""
+
+    def __init__(self, name: str, workers: int, queue_size: int,
+                 on_wait: Optional[Callable[[str, float], None]] = None) -> None:
+        """
+        Starts the workers.
+
+        Args:
+            name: Lane name, used for thread names and the on_wait callback.
+            workers: Number of worker threads.
+            queue_size: Requests each worker may have queued.
+            on_wait: Called with (lane, seconds queued) as each request starts.
+        """
+        self.name: str = name
+        self.on_wait: Optional[Callable[[str, float], None]] = on_wait
+        self._queues: List["queue.Queue[Optional[Task]]"] = [
+            queue.Queue(queue_size) for _ in range(workers)]
+        self._threads: List[threading.Thread] = [
+            threading.Thread(target=self._work, args=(q,), name=f"lane-{name}-{i}", daemon=True)
+            for i, q in enumerate(self._queues)]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, key: Hashable, fn: Callable[[], Any]) -> "Future[Any]":
+        """
+        Queues `fn` on the worker owning `key`. It runs in the caller's
+        context variables (log context).
+
+        Raises:
+            queue.Full: If that worker's queue is full.
+        """
+        future: "Future[Any]" = Future()
+        task = (future, contextvars.copy_context(), fn, time.monotonic())
+        self._queues[hash(key) % len(self._queues)].put_nowait(task)
+        return future
+
+    def shutdown(self) -> None:
+        """Stops the workers once their queued requests are done."""
+        for q in self._queues:
+            q.put(None)
+        for t in self._threads:
+            t.join()
+
+    def _work(self, tasks: "queue.Queue[Optional[Task]]") -> None:
+        """Worker loop: runs queued requests in order until shut down."""
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            future, ctx, fn, queued_at = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            if self.on_wait:
+                self.on_wait(self.name, time.monotonic() - queued_at)
+            try:
+                future.set_result(ctx.run(fn))
+            except BaseException as e:  # pylint: disable=broad-exception-caught
+                future.set_exception(e)
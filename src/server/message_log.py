@@ -0,0 +1,407 @@
+"""
+Append-only, memory-mapped message store.
+
+Messages are written once and read back a conversation page at a time. That
+suits an append-only log better than a B-tree. Records are appended to
+segment files that roll over at `segment_size` bytes. An in-memory index
+maps each conversation to its message ids and record positions. History
+pages are decoded directly from memory-mapped segments, without read calls.
+
+Each record carries a CRC32. On open, the segments named in the MANIFEST are
+scanned to rebuild the index. A torn or corrupt tail, left by an
+interrupted write, is truncated. Compaction rewrites sealed
+segments so that each conversation's records are contiguous. The manifest is
+replaced atomically, so a crash leaves either the old or the new segments.
+"""
+
+import bisect
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+from array import array
+from typing import Any, Dict, Hashable, Iterator, List, Optional, Set, Tuple
+from src.common.log import get_logger
+
+logger = get_logger("message_log")
+
+MANIFEST: str = "MANIFEST"
+# Files this log writes; anything else in the directory is left alone.
+SEGMENT_NAME = re.compile(r"\d{8}\.(log|compact)")
+DEFAULT_SEGMENT_SIZE: int = 64 * 1024 * 1024
+# crc32 (of the rest of the record), id, sender/receiver/content byte lengths.
+RECORD = struct.Struct("<IQHHI")
+# A record position packs the segment number above the offset within it.
+OFFSET_BITS: int = 32
+
+Message = Dict[str, Any]
+
+
+def conversation_of(sender: str, receiver: str) -> Hashable:
+    """Returns the conversation a message belongs to: the #group/&room or the user pair."""
+    if receiver.startswith("#") or receiver.startswith("&"):
+        return receiver
+    return (sender, receiver) if sender <= receiver else (receiver, sender)
+
+
+class MessageLog:  # pylint: disable=too-many-instance-attributes
+    """Segmented append-only message log with a per-conversation index."""
+
+    def __init__(self, directory: str, segment_size: int = DEFAULT_SEGMENT_SIZE,
+                 sync: bool = False) -> None:
+        """
+        Opens (or creates) the log in `directory` and recovers its index.
+
+        Args:
+            directory: Folder holding the segments and the MANIFEST.
+            segment_size: Bytes after which a new segment is started (< 4 GiB).
+            sync: fsync after every append. Without it, a write survives a
+                process crash but not a power loss.
+        """
+        self.directory: str = directory
+        self.segment_size: int = min(segment_size, (1 << OFFSET_BITS) - 1)
+        self.sync: bool = sync
+        self.last_id: int = 0
+        # Live segments by number; the last one in _order receives appends.
+        self._order: List[int] = []
+        self._names: Dict[int, str] = {}
+        self._maps: Dict[int, mmap.mmap] = {}
+        # Per conversation, and for the whole log: ids and record positions, sorted by id.
+        self._conversations: Dict[Hashable, Tuple["array[int]", "array[int]"]] = {}
+        self._ids: "array[int]" = array("Q")
+        self._positions: "array[int]" = array("Q")
+        self._fd: int = -1
+        self._size: int = 0
+        self._lock: threading.RLock = threading.RLock()
+        self._compact_lock: threading.Lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+
+    # --- writes ---
+
+    def append(self, sender: str, receiver: str, content: str) -> int:
+        """
+        Appends a message.
+
+        Returns:
+            int: The id of the stored message.
+        """
+        s, r, c = sender.encode(), receiver.encode(), content.encode()
+        with self._lock:
+            msg_id = self.last_id + 1
+            body = RECORD.pack(0, msg_id, len(s), len(r), len(c))[4:] + s + r + c
+            record = struct.pack("<I", zlib.crc32(body)) + body
+            if self._size and self._size + len(record) > self.segment_size:
+                self._roll()
+            view = memoryview(record)
+            while view:
+                view = view[os.write(self._fd, view):]
+            if self.sync:
+                os.fsync(self._fd)
+            pos = (self._order[-1] << OFFSET_BITS) | self._size
+            self._size += len(record)
+            self.last_id = msg_id
+            self._index(conversation_of(sender, receiver), msg_id, pos)
+            return msg_id
+
+    def advance_to(self, msg_id: int) -> None:
+        """Makes the next appended id follow `msg_id` (continuing another store's ids)."""
+        with self._lock:
+            self.last_id = max(self.last_id, msg_id)
+
+    # --- reads ---
+
+    def history(self, user1: str, user2: str, limit: Optional[int] = None,
+                before: Optional[int] = None) -> List[Message]:
+        """
+        Returns a conversation's messages, oldest first, like Database.get_chat_history.
+
+        Args:
+            user1: The requesting user.
+            user2: The other user, or a #group / &room.
+            limit: Only the newest `limit` messages; None for all of them.
+            before: Only messages with an id below this.
+        """
+        with self._lock:
+            entry = self._conversations.get(conversation_of(user1, user2))
+            if entry is None:
+                return []
+            ids, positions = entry
+            end = len(ids) if before is None else bisect.bisect_left(ids, before)
+            start = 0 if limit is None else max(0, end - limit)
+            return [self._read(positions[i]) for i in range(start, end)]
+
+    def messages_since(self, username: str, groups: Set[str], after_id: int,
+                       up_to_id: int) -> List[Dict[str, str]]:
+        """
+        Returns the direct and group messages a user sent or received with
+        after_id < id <= up_to_id, oldest first, like Database.get_messages_since.
+
+        Args:
+            username: The user catching up.
+            groups: The #groups the user belongs to.
+            after_id: Last id the device has.
+            up_to_id: Newest id to include.
+        """
+        with self._lock:
+            start = bisect.bisect_right(self._ids, after_id)
+            end = bisect.bisect_right(self._ids, up_to_id)
+            missed = []
+            for i in range(start, end):
+                m = self._read(self._positions[i])
+                to = m["to"]
+                if to.startswith("&"):
+                    continue
+                if username in (m["sender"], to) or to in groups:
+                    missed.append({"sender": m["sender"], "to": to, "text": m["text"]})
+            return missed
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    # --- maintenance ---
+
+    def compact(self) -> int:
+        """
+        Rewrites the sealed segments that have not been compacted yet so that
+        each conversation's records are contiguous. The active segment is left
+        alone, and appends continue while the new segments are written.
+
+        Returns:
+            int: Number of records rewritten.
+        """
+        with self._compact_lock:
+            with self._lock:
+                sources = [n for n in self._order[:-1] if not self._names[n].endswith(".compact")]
+                maps = [self._maps[n] for n in sources if n in self._maps]
+            if not sources:
+                return 0
+
+            # Sealed segments never change, so they are read without holding _lock.
+            written, moved = self._write_compacted(self._by_conversation(maps))
+
+            with self._lock:
+                keep = [n for n in self._order if n not in sources]
+                self._order = [n for n, _ in written] + keep
+                self._write_manifest()
+                for msg_id, key, pos in moved:
+                    self._relocate(key, msg_id, pos)
+                for n in sources:
+                    if n in self._maps:
+                        self._maps.pop(n).close()
+                    os.remove(os.path.join(self.directory, self._names.pop(n)))
+            return len(moved)
+
+    def close(self) -> None:
+        """Closes the active segment and every mapping."""
+        with self._lock:
+            for mm in self._maps.values():
+                mm.close()
+            self._maps.clear()
+            if self._fd >= 0:
+                os.close(self._fd)
+                self._fd = -1
+
+    # --- internals ---
+
+    def _recover(self) -> None:
+        """Loads the manifest, drops orphaned segments and rebuilds the index."""
+        manifest = os.path.join(self.directory, MANIFEST)
+        names: List[str] = []
+        if os.path.exists(manifest):
+            with open(manifest, encoding="utf-8") as f:
+                names = json.load(f)["segments"]
+        for name in os.listdir(self.directory):
+            orphan = SEGMENT_NAME.fullmatch(name) is not None or name == MANIFEST + ".tmp"
+            if orphan and name not in names:
+                # Written by a roll or compaction that never reached the manifest.
+                logger.warning("Removing orphaned log file %s", name)
+                os.remove(os.path.join(self.directory, name))
+
+        entries: List[Tuple[int, Hashable, int]] = []
+        for name in names:
+            if not os.path.exists(os.path.join(self.directory, name)):
+                logger.error("Log segment %s is missing", name)
+                continue
+            number = int(name.split(".")[0])
+            self._order.append(number)
+            self._names[number] = name
+            entries += self._load_segment(number)
+
+        entries.sort(key=lambda e: e[0])
+        for msg_id, key, pos in entries:
+            self._index(key, msg_id, pos)
+        self.last_id = entries[-1][0] if entries else 0
+
+        if not self._order or self._names[self._order[-1]].endswith(".compact"):
+            self._roll()
+        else:
+            path = os.path.join(self.directory, self._names[self._order[-1]])
+            self._fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+            self._size = os.path.getsize(path)
+
+    def _load_segment(self, number: int) -> List[Tuple[int, Hashable, int]]:
+        """
+        Maps a segment and returns (id, conversation, position) for its records.
+        A torn or corrupt tail (an interrupted write) is truncated.
+        """
+        path = os.path.join(self.directory, self._names[number])
+        size = os.path.getsize(path)
+        if not size:
+            return []
+        entries = []
+        valid = 0
+        mm = self._remap(number)
+        for _, msg_id, sender, receiver, start, end in self._scan(mm):
+            entries.append((msg_id, conversation_of(sender, receiver),
+                            (number << OFFSET_BITS) | start))
+            valid = end
+        if valid < size:
+            logger.warning("Truncating %d bytes of torn or corrupt records in %s",
+                           size - valid, self._names[number])
+            self._maps.pop(number).close()
+            os.truncate(path, valid)
+            if valid:
+                self._remap(number)
+        return entries
+
+    @staticmethod
+    def _scan(mm: mmap.mmap) -> Iterator[Tuple[int, int, str, str, int, int]]:
+        """
+        Yields (crc, id, sender, receiver, start, end) for each valid record in
+        a segment, stopping at the first torn or corrupt one.
+        """
+        size = len(mm)
+        off = 0
+        with memoryview(mm) as view:
+            while off + RECORD.size <= size:
+                crc, msg_id, ls, lr, lc = RECORD.unpack_from(view, off)
+                end = off + RECORD.size + ls + lr + lc
+                if end > size or zlib.crc32(view[off + 4:end]) != crc:
+                    return
+                head = off + RECORD.size
+                yield (crc, msg_id, str(view[head:head + ls], "utf-8"),
+                       str(view[head + ls:head + ls + lr], "utf-8"), off, end)
+                off = end
+
+    def _read(self, pos: int) -> Message:
+        """Decodes the record at a position straight from its segment's mapping."""
+        number, off = pos >> OFFSET_BITS, pos & ((1 << OFFSET_BITS) - 1)
+        mm = self._maps.get(number)
+        if mm is None or len(mm) <= off:
+            mm = self._remap(number)
+        with memoryview(mm) as view:
+            _, msg_id, ls, lr, lc = RECORD.unpack_from(view, off)
+            head = off + RECORD.size
+            return {"id": msg_id,
+                    "sender": str(view[head:head + ls], "utf-8"),
+                    "to": str(view[head + ls:head + ls + lr], "utf-8"),
+                    "text": str(view[head + ls + lr:head + ls + lr + lc], "utf-8")}
+
+    def _remap(self, number: int) -> mmap.mmap:
+        """Maps the active segment again after it has grown."""
+        old = self._maps.pop(number, None)
+        if old is not None:
+            old.close()
+        with open(os.path.join(self.directory, self._names[number]), "rb") as f:
+            mm = self._maps[number] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return mm
+
+    def _index(self, key: Hashable, msg_id: int, pos: int) -> None:
+        """Adds a record to the conversation and global indexes."""
+        entry = self._conversations.get(key)
+        if entry is None:
+            entry = self._conversations[key] = (array("Q"), array("Q"))
+        entry[0].append(msg_id)
+        entry[1].append(pos)
+        self._ids.append(msg_id)
+        self._positions.append(pos)
+
+    def _relocate(self, key: Hashable, msg_id: int, pos: int) -> None:
+        """Points the indexes at a record's new position after compaction."""
+        ids, positions = self._conversations[key]
+        positions[bisect.bisect_left(ids, msg_id)] = pos
+        self._positions[bisect.bisect_left(self._ids, msg_id)] = pos
+
+    def _new_segment(self, suffix: str) -> Tuple[int, str]:
+        """Reserves the next segment number and its file name."""
+        number = max(self._names, default=0) + 1
+        name = f"{number:08d}{suffix}"
+        self._names[number] = name
+        return number, name
+
+    def _roll(self) -> None:
+        """Seals the active segment and starts a new one."""
+        if self._fd >= 0:
+            os.close(self._fd)
+        number, name = self._new_segment(".log")
+        self._fd = os.open(os.path.join(self.directory, name),
+                           os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self._size = 0
+        self._order.append(number)
+        self._write_manifest()
+
+    @classmethod
+    def _by_conversation(cls, maps: List[mmap.mmap]) -> Dict[Hashable, List[Tuple[int, bytes]]]:
+        """Groups the raw records of some segments by conversation as (id, bytes)."""
+        records: Dict[Hashable, List[Tuple[int, bytes]]] = {}
+        for mm in maps:
+            for _, msg_id, sender, receiver, start, end in cls._scan(mm):
+                records.setdefault(conversation_of(sender, receiver), []).append(
+                    (msg_id, mm[start:end]))
+        return records
+
+    def _write_compacted(self, records: Dict[Hashable, List[Tuple[int, bytes]]]
+                         ) -> Tuple[List[Tuple[int, str]], List[Tuple[int, Hashable, int]]]:
+        """
+        Writes records grouped by conversation into new .compact segments.
+
+        Returns:
+            The (number, name) of each new segment, and (id, conversation, new
+            position) for each record.
+        """
+        written: List[Tuple[int, str]] = []
+        moved: List[Tuple[int, Hashable, int]] = []
+        f = None
+        size = 0
+        try:
+            for key, items in records.items():
+                items.sort()
+                for msg_id, data in items:
+                    if f is None or size + len(data) > self.segment_size:
+                        if f is not None:
+                            self._seal(f)
+                        with self._lock:
+                            number, name = self._new_segment(".compact")
+                        written.append((number, name))
+                        f = open(os.path.join(self.directory, name), "wb")  # pylint: disable=consider-using-with
+                        size = 0
+                    moved.append((msg_id, key, (written[-1][0] << OFFSET_BITS) | size))
+                    f.write(data)
+                    size += len(data)
+        finally:
+            if f is not None:
+                self._seal(f)
+        with self._lock:
+            for number, _ in written:
+                self._remap(number)
+        return written, moved
+
+    @staticmethod
+    def _seal(f: Any) -> None:
+        """Flushes a new segment to disk before the manifest can name it."""
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+    def _write_manifest(self) -> None:
+        """Atomically replaces the MANIFEST with the live segments, in order."""
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"segments": [self._names[n] for n in self._order]}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
@@ -0,0 +1,230 @@
+"""
+Server instrumentation: counters, histograms and gauges rendered in the
+Prometheus text exposition format, plus a loopback-only HTTP endpoint.
+"""
+
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+METRICS_HOST: str = "127.0.0.1"
+METRICS_PORT: int = 9105
+
+LATENCY_BUCKETS: Tuple[float, ...] = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SIZE_BUCKETS: Tuple[float, ...] = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+FANOUT_BUCKETS: Tuple[float, ...] = (0, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+Labels = Tuple[Tuple[str, str], ...]
+# A histogram copied under the lock: (buckets, counts, sum, count).
+HistogramSnapshot = Tuple[Tuple[float, ...], List[int], float, int]
+# Extra endpoint: receives the query parameters and returns (status, body).
+Route = Callable[[Dict[str, str]], Tuple[int, str]]
+
+
+def _labels(labels: Optional[Dict[str, str]]) -> Labels:
+    """Normalizes a label dict into a hashable, sorted tuple."""
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _escape(value: str) -> str:
+    """Escapes a label value for the text format."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    """Renders labels as {k="v",...} (empty string when there are none)."""
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(str(v))}"' for k, v in pairs) + "}"
+
+
+class Histogram:  # pylint: disable=too-few-public-methods
+    """Cumulative-bucket histogram (not thread-safe on its own; guarded by Metrics)."""
+
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets: Tuple[float, ...] = tuple(buckets)
+        self.counts: List[int] = [0] * (len(self.buckets) + 1)
+        self.sum: float = 0.0
+        self.count: int = 0
+
+    def observe(self, value: float) -> None:
+        """Records one observation."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters, histograms and callback gauges.
+    Metric names and help texts are declared on first use.
+    """
+
+    def __init__(self) -> None:
+        self._lock: threading.Lock = threading.Lock()
+        self._meta: Dict[str, Tuple[str, str]] = {}
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self.gauges: Dict[str, Callable[[], float]] = {}
+
+    def inc(self, name: str, labels: Optional[Dict[str, str]] = None,
+            value: float = 1.0, doc: str = "") -> None:
+        """Increments a counter."""
+        key = (name, _labels(labels))
+        with self._lock:
+            self._meta.setdefault(name, ("counter", doc))
+            self.counters[key] = self.counters.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, labels: Optional[Dict[str, str]] = None,
+                buckets: Sequence[float] = LATENCY_BUCKETS, doc: str = "") -> None:
+        """Records a histogram observation."""
+        key = (name, _labels(labels))
+        with self._lock:
+            self._meta.setdefault(name, ("histogram", doc))
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram(buckets)
+            hist.observe(value)
+
+    def gauge(self, name: str, func: Callable[[], float], doc: str = "") -> None:
+        """Registers a gauge whose value is read at render time."""
+        with self._lock:
+            self._meta[name] = ("gauge", doc)
+            self.gauges[name] = func
+
+    @contextmanager
+    def timer(self, name: str, labels: Optional[Dict[str, str]] = None,
+              doc: str = "") -> Iterator[None]:
+        """Context manager observing the elapsed time of its block in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, labels, doc=doc)
+
+    def render(self) -> str:
+        """Returns all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            meta = dict(self._meta)
+            counters = dict(self.counters)
+            hists = {k: (h.buckets, list(h.counts), h.sum, h.count)
+                     for k, h in self.histograms.items()}
+            gauges = dict(self.gauges)
+
+        lines: List[str] = []
+        for name in sorted(meta):
+            kind, doc = meta[name]
+            if doc:
+                lines.append(f"# HELP {name} {doc}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "gauge":
+                lines.extend(_gauge_lines(name, gauges[name]))
+            lines.extend(_counter_lines(name, counters))
+            lines.extend(_histogram_lines(name, hists))
+        return "\n".join(lines) + "\n"
+
+
+def _gauge_lines(name: str, func: Callable[[], float]) -> List[str]:
+    """Renders a callback gauge; a failing callback renders nothing."""
+    try:
+        return [f"{name} {float(func())}"]
+    except Exception:  # pylint: disable=broad-exception-caught
+        return []
+
+
+def _counter_lines(name: str, counters: Dict[Tuple[str, Labels], float]) -> List[str]:
+    """Renders every label set of counter `name`."""
+    return [f"{name}{_format_labels(labels)} {value}"
+            for (cname, labels), value in sorted(counters.items()) if cname == name]
+
+
+def _histogram_lines(name: str, hists: Dict[Tuple[str, Labels], HistogramSnapshot]) -> List[str]:
+    """Renders the cumulative buckets, sum and count of every label set of histogram `name`."""
+    lines: List[str] = []
+    for (hname, labels), (buckets, counts, total, count) in sorted(hists.items()):
+        if hname != name:
+            continue
+        cumulative = 0
+        for bound, c in zip(list(buckets) + [float("inf")], counts):
+            cumulative += c
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            lines.append(f"{name}_bucket{_format_labels(labels, ('le', le))} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    return lines
+
+
+class TimedProxy:  # pylint: disable=too-few-public-methods
+    """
+    Wraps an object so every public method call is timed into histogram `name`,
+    labelled by method name. Other attributes pass through unchanged.
+    """
+
+    def __init__(self, target: Any, metrics: Metrics, name: str, label: str = "method") -> None:
+        self._target: Any = target
+        self._metrics: Metrics = metrics
+        self._name: str = name
+        self._label: str = label
+        self._wrapped: Dict[str, Callable[..., Any]] = {}
+
+    def __getattr__(self, attr: str) -> Any:
+        value = getattr(self._target, attr)
+        if attr.startswith("_") or not callable(value):
+            return value
+        wrapped = self._wrapped.get(attr)
+        if wrapped is None:
+            metrics, name, labels = self._metrics, self._name, {self._label: attr}
+
+            @functools.wraps(value)
+            def timed(*args: Any, **kwargs: Any) -> Any:
+                with metrics.timer(name, labels):
+                    return value(*args, **kwargs)
+
+            wrapped = self._wrapped[attr] = timed
+        return wrapped
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    """Serves GET /metrics from the server's Metrics registry, plus any extra routes."""
+
+    metrics: Metrics
+    routes: Dict[str, Route]
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        """Handles GET requests."""
+        url = urlsplit(self.path)
+        if url.path == "/metrics":
+            status, text = 200, self.metrics.render()
+        elif url.path in self.routes:
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            status, text = self.routes[url.path](params)
+        else:
+            self.send_error(404)
+            return
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:  # pylint: disable=redefined-builtin
+        """Silences per-request logging."""
+
+
+def start_metrics_server(metrics: Metrics, host: str = METRICS_HOST,
+                         port: int = METRICS_PORT,
+                         routes: Optional[Dict[str, Route]] = None) -> ThreadingHTTPServer:
+    """Starts the /metrics HTTP endpoint on a daemon thread and returns the server."""
+    handler = type("MetricsHandler", (_MetricsHandler,),
+                   {"metrics": metrics, "routes": dict(routes or {})})
+    httpd = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
@@ -0,0 +1,126 @@
+"""
+Opt-in runtime profiling for the server.
+A bounded window samples the stacks of every thread into the collapsed
+("folded") format used by flamegraph tools and records tracemalloc
+allocation sites in the protocol and database hot paths.
+"""
+
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from types import FrameType
+from typing import Dict, List, Optional, Tuple
+from src.common.log import get_logger
+
+logger = get_logger("profiling")
+
+PROFILE_DIR: str = "profiles"
+DEFAULT_DURATION: float = 30.0
+SAMPLE_INTERVAL: float = 0.005
+MAX_DURATION: float = 300.0
+TOP_ALLOCATIONS: int = 25
+# Files whose allocation sites are reported (send_json/receive_json, get_chat_history).
+ALLOC_FILES: Tuple[str, ...] = ("*/common/protocol.py", "*/server/database.py")
+
+
+class Profiler:
+    """
+    Runs at most one profiling window at a time on a background thread.
+    Results are written to PROFILE_DIR when the window ends.
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL) -> None:
+        self.interval: float = interval
+        self._lock: threading.Lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self.last_output: List[str] = []
+
+    @property
+    def running(self) -> bool:
+        """True while a profiling window is active."""
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration: float, trace_allocations: bool = True) -> bool:
+        """
+        Starts a profiling window of `duration` seconds (capped at MAX_DURATION).
+        Returns False if a window is already running.
+        """
+        with self._lock:
+            if self.running:
+                return False
+            self._thread = threading.Thread(
+                target=self._run, args=(min(duration, MAX_DURATION), trace_allocations),
+                name="profiler", daemon=True)
+            self._thread.start()
+            return True
+
+    def wait(self, timeout: Optional[float] = None) -> None:
+        """Blocks until the current window (if any) has finished."""
+        thread = self._thread
+        if thread:
+            thread.join(timeout)
+
+    def _run(self, duration: float, trace_allocations: bool) -> None:
+        """Samples stacks for `duration` seconds and writes the reports."""
+        started_tracing = trace_allocations and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(16)
+
+        stacks: Counter[str] = Counter()
+        me = threading.get_ident()
+        deadline = time.monotonic() + duration
+        samples = 0
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if ident != me:
+                    stacks[self._fold(names.get(ident, str(ident)), frame)] += 1
+            samples += 1
+            time.sleep(self.interval)
+
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        outputs = [self._write_folded(stacks, stamp)]
+        if trace_allocations and tracemalloc.is_tracing():
+            outputs.append(self._write_allocations(tracemalloc.take_snapshot(), stamp, samples))
+        if started_tracing:
+            tracemalloc.stop()
+        self.last_output = outputs
+        logger.info("%d samples written to %s", samples, ", ".join(outputs))
+
+    @staticmethod
+    def _fold(thread_name: str, frame: Optional[FrameType]) -> str:
+        """Turns a frame chain into 'thread;outer;...;inner' (root first)."""
+        parts: List[str] = []
+        while frame is not None:
+            code = frame.f_code
+            name = f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+            parts.append(name.replace(";", ":"))
+            frame = frame.f_back
+        parts.append(thread_name.replace(";", ":"))
+        return ";".join(reversed(parts))
+
+    @staticmethod
+    def _write_folded(stacks: Dict[str, int], stamp: str) -> str:
+        """Writes collapsed stacks ('a;b;c count' per line) for flamegraph.pl / speedscope."""
+        path = os.path.join(PROFILE_DIR, f"stacks-{stamp}.folded")
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(stacks.items()):
+                f.write(f"{stack} {count}\n")
+        return path
+
+    @staticmethod
+    def _write_allocations(snapshot: tracemalloc.Snapshot, stamp: str, samples: int) -> str:
+        """Writes the top allocating lines in the protocol and database modules."""
+        filtered = snapshot.filter_traces([tracemalloc.Filter(True, p) for p in ALLOC_FILES])
+        path = os.path.join(PROFILE_DIR, f"alloc-{stamp}.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(f"# top {TOP_ALLOCATIONS} allocation sites after {samples} samples\n")
+            for stat in filtered.statistics("lineno")[:TOP_ALLOCATIONS]:
+                frame = stat.traceback[0]
+                f.write(f"{frame.filename}:{frame.lineno} size={stat.size / 1024:.1f} KiB "
+                        f"count={stat.count}\n")
+        return path
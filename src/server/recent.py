@@ -0,0 +1,155 @@
+"""
+In-memory ring buffers of the most recent messages per conversation.
+
+`get_history` asks for the latest page of a chat far more often than for
+anything older. The server keeps the last few messages of each active
+conversation here, appended as they are sent. A request the buffer can
+answer never reaches SQLite. Older pages fall through to the database.
+
+All buffers share one memory budget. When it is exceeded, the conversations
+idle the longest are evicted first.
+"""
+
+import bisect
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional
+
+# Messages kept per conversation.
+DEFAULT_PER_CONVERSATION: int = 100
+# Approximate bytes all buffers may hold together.
+DEFAULT_BUDGET: int = 16 * 1024 * 1024
+# Rough per-message cost of the dict, its keys and the id, on top of the strings.
+MESSAGE_OVERHEAD: int = 256
+
+Message = Dict[str, Any]
+
+
+def message_size(msg: Message) -> int:
+    """Approximate memory used by one cached message."""
+    return MESSAGE_OVERHEAD + sum(len(v) for v in msg.values() if isinstance(v, str))
+
+
+class _Ring:
+    """The newest messages of one conversation, sorted by id."""
+
+    __slots__ = ("ids", "messages", "size", "complete")
+
+    def __init__(self) -> None:
+        self.ids: List[int] = []
+        self.messages: List[Message] = []
+        self.size: int = 0
+        # True while the ring holds every message of the conversation.
+        self.complete: bool = False
+
+    def insert(self, msg: Message) -> None:
+        """Adds a message in id order, ignoring one already present."""
+        msg_id = int(msg["id"])
+        i = bisect.bisect_left(self.ids, msg_id)
+        if i < len(self.ids) and self.ids[i] == msg_id:
+            return
+        self.ids.insert(i, msg_id)
+        self.messages.insert(i, msg)
+        self.size += message_size(msg)
+
+    def trim(self, capacity: int) -> None:
+        """Drops the oldest messages beyond capacity."""
+        extra = len(self.messages) - capacity
+        if extra > 0:
+            self.size -= sum(message_size(m) for m in self.messages[:extra])
+            del self.ids[:extra]
+            del self.messages[:extra]
+            self.complete = False
+
+
+class RecentMessages:
+    """Bounded, LRU-evicted ring buffers of recent messages per conversation."""
+
+    def __init__(self, per_conversation: int = DEFAULT_PER_CONVERSATION,
+                 budget: int = DEFAULT_BUDGET) -> None:
+        """
+        Initializes an empty cache.
+
+        Args:
+            per_conversation: Messages kept per conversation.
+            budget: Approximate bytes all conversations may hold together.
+        """
+        self.per_conversation: int = per_conversation
+        self.budget: int = budget
+        self.size: int = 0
+        self._rings: "OrderedDict[Hashable, _Ring]" = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._rings)
+
+    def append(self, key: Hashable, msg: Message) -> None:
+        """
+        Records a message just stored in the database. `msg` must carry its
+        database "id".
+        """
+        with self._lock:
+            ring = self._rings.get(key)
+            if ring is None:
+                ring = self._rings[key] = _Ring()
+            self._update(key, ring, [msg])
+
+    def fill(self, key: Hashable, messages: List[Message], complete: bool) -> None:
+        """
+        Seeds a conversation with the latest page read from the database.
+        Messages appended since that read are kept.
+
+        Args:
+            key: Conversation key.
+            messages: The newest messages of the conversation, oldest first.
+            complete: Whether `messages` is the whole conversation.
+        """
+        with self._lock:
+            old = self._rings.get(key)
+            ring = self._rings[key] = _Ring()
+            ring.complete = complete
+            newer = []
+            if old:
+                last = int(messages[-1]["id"]) if messages else 0
+                newer = [m for m in old.messages if int(m["id"]) > last]
+                self.size -= old.size
+            self._update(key, ring, messages + newer)
+
+    def recent(self, key: Hashable, limit: Optional[int] = None,
+               before: Optional[int] = None) -> Optional[List[Message]]:
+        """
+        Answers a history request from memory if the buffer holds enough.
+
+        Args:
+            key: Conversation key.
+            limit: Newest messages wanted; None for the whole conversation.
+            before: Only messages with an id below this.
+
+        Returns:
+            The messages oldest first, or None if the database must be asked.
+        """
+        with self._lock:
+            ring = self._rings.get(key)
+            if ring is None:
+                return None
+            end = len(ring.ids) if before is None else bisect.bisect_left(ring.ids, before)
+            if limit is not None and end >= limit:
+                page = ring.messages[end - limit:end]
+            elif ring.complete:
+                page = ring.messages[:end]
+            else:
+                return None
+            self._rings.move_to_end(key)
+            return list(page)
+
+    def _update(self, key: Hashable, ring: _Ring, messages: List[Message]) -> None:
+        """Adds messages to a ring, then enforces its capacity and the budget."""
+        self.size -= ring.size
+        for m in messages:
+            ring.insert(m)
+        ring.trim(self.per_conversation)
+        self.size += ring.size
+        self._rings.move_to_end(key)
+        while self.size > self.budget and self._rings:
+            _, idle = self._rings.popitem(last=False)
+            self.size -= idle.size
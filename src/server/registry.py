@@ -0,0 +1,91 @@
+"""
+Registry of authenticated client connections.
+
+Handler threads add and remove sessions on login and disconnect while others
+look users up and fan messages out. A user is online while any of their
+devices is connected. Writers copy the map under a lock and publish the
+copy; readers use whichever map is current without locking, so a broadcast
+never sees the map change underneath it.
+"""
+
+import socket
+import threading
+from types import MappingProxyType
+from typing import Dict, Mapping, Optional, Tuple
+
+Sessions = Tuple[socket.socket, ...]
+
+
+class ClientRegistry:
+    """
+    Maps usernames to their open sessions (one connection per device) with
+    copy-on-write updates.
+
+    Lookups and snapshots are O(1) and lock-free; add/remove copy the map
+    (O(n)), which suits a registry read on every message and written on
+    every login.
+    """
+
+    def __init__(self, initial: Optional[Mapping[str, socket.socket]] = None) -> None:
+        """
+        Initializes the registry.
+
+        Args:
+            initial: One connection per user to start with (mainly for tests).
+        """
+        self._lock: threading.Lock = threading.Lock()
+        # Never mutated once published; writers replace the reference.
+        self._clients: Dict[str, Sessions] = {u: (c,) for u, c in (initial or {}).items()}
+
+    def __contains__(self, username: object) -> bool:
+        return username in self._clients
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+    def sessions(self, username: str) -> Sessions:
+        """Returns the connections of a user, empty if they are offline."""
+        return self._clients.get(username, ())
+
+    def snapshot(self) -> Mapping[str, Sessions]:
+        """
+        Returns a read-only view of the current sessions per user.
+        Later logins and disconnects do not change it, so it is safe to iterate.
+        """
+        return MappingProxyType(self._clients)
+
+    def add(self, username: str, conn: socket.socket) -> int:
+        """
+        Registers a session; earlier sessions of the user stay open.
+
+        Returns:
+            int: Number of sessions the user now has.
+        """
+        with self._lock:
+            clients = dict(self._clients)
+            sessions = clients.get(username, ())
+            if conn not in sessions:
+                sessions += (conn,)
+            clients[username] = sessions
+            self._clients = clients
+        return len(sessions)
+
+    def remove(self, username: str, conn: socket.socket) -> bool:
+        """
+        Unregisters one session. The user goes offline with their last session.
+
+        Returns:
+            bool: True if the session was registered.
+        """
+        with self._lock:
+            sessions = self._clients.get(username, ())
+            if conn not in sessions:
+                return False
+            clients = dict(self._clients)
+            rest = tuple(c for c in sessions if c is not conn)
+            if rest:
+                clients[username] = rest
+            else:
+                del clients[username]
+            self._clients = clients
+        return True
@@ -4,66 +4,475 @@ Handles incoming connections, routing logic, client requests,
 and persistent data storage via Database.
 """
 
+import functools
+import itertools
+import queue
+import signal
 import socket
 import threading
-from typing import Dict, Tuple, Optional, Any
-from src.common.protocol import HOST, PORT, receive_json, send_json
+import time
+from concurrent.futures import Future, wait
+from typing import Dict, Iterator, List, Mapping, NamedTuple, Set, Tuple, Optional, Any, cast
+from src.common.log import get_logger, bind_context, log_context, setup_logging
+from src.common.protocol import (
+    HOST, PORT, COMPRESSION, HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT,
+    FrameError, ReadBudget, read_frame, send_json, set_frame_observer
+)
 from src.server.database import Database
-from src.common.crypto_utils import CryptoManager
-
-
-class ChatServer:
+from src.server.metrics import (
+    Metrics, TimedProxy, start_metrics_server, METRICS_PORT, SIZE_BUCKETS, FANOUT_BUCKETS
+)
+from src.server.profiling import Profiler, DEFAULT_DURATION
+from src.server.registry import ClientRegistry, Sessions
+from src.server.admission import AdmissionController, RateLimiter, DEFAULT_RATES, EXEMPT
+from src.server.lanes import (
+    LaneExecutor, DEFAULT_LANES, LANE_OF, MEMBERSHIP_ACTIONS, DRAIN_TIMEOUT, conversation_key
+)
+from src.server.recent import RecentMessages, DEFAULT_BUDGET, DEFAULT_PER_CONVERSATION
+from src.server.message_log import MessageLog
+from src.common.crypto_utils import CryptoManager, CIPHER_SUITE
+
+logger = get_logger("server")
+
+KNOWN_ACTIONS = frozenset({
+    "register", "login", "get_data", "get_history", "msg", "send_friend_request",
+    "handle_request", "create_group", "join_group", "create_public_room",
+    "get_public_key", "share_group_key", "get_group_key", "join_room", "leave_room",
+    "ping", "pong",
+})
+
+# Seconds an overloaded server asks clients to wait before retrying.
+OVERLOAD_RETRY_AFTER: float = 1.0
+
+IDENTITY_MISMATCH_MSG: str = (
+    "This account's encryption key is on another device. Copy keys/<username>.x25519 "
+    "from that device, or log in with replace_key to start a new key there.")
+
+
+class ConnectionLimits(NamedTuple):
+    """Per-connection guards applied while reading client requests."""
+    max_frame_size: int = 1024 * 1024
+    # Bytes a client may send per budget_window (token bucket).
+    read_budget: int = 8 * 1024 * 1024
+    budget_window: float = 60.0
+    # Seconds a connection may stay silent before logging in / after logging in.
+    login_timeout: Optional[float] = 30.0
+    idle_timeout: Optional[float] = None
+    # Seconds allowed to deliver one frame once its first byte arrived.
+    frame_timeout: Optional[float] = 15.0
+    # Logged-in sessions silent for heartbeat_interval are pinged; after
+    # heartbeat_timeout they are reaped. None disables the reaper.
+    heartbeat_interval: Optional[float] = HEARTBEAT_INTERVAL
+    heartbeat_timeout: float = HEARTBEAT_TIMEOUT
+    # Connections served and requests processed at once; see src/server/admission.py.
+    max_connections: int = 1000
+    max_in_flight: int = 64
+    # Per-user token buckets: action -> (burst, window seconds).
+    rates: Mapping[str, Tuple[int, float]] = DEFAULT_RATES
+    # Request lanes: name -> (workers, queued requests per worker); see src/server/lanes.py.
+    lanes: Mapping[str, Tuple[int, int]] = DEFAULT_LANES
+    # Recent messages kept in memory per conversation, and bytes for all of them.
+    recent_messages: int = DEFAULT_PER_CONVERSATION
+    recent_budget: int = DEFAULT_BUDGET
+    # Messages older than archive_after_days move to per-month archive files,
+    # checked every archive_interval seconds. None keeps them all in data.db.
+    archive_after_days: Optional[float] = 90.0
+    archive_interval: float = 3600.0
+
+
+class ChatServer:  # pylint: disable=too-many-instance-attributes
     """
     Main server class. Handles incoming connections, routing logic,
     client requests, and persistent data storage via Database.
     """
 
-    def __init__(self) -> None:
+    def __init__(self, host: str = HOST, port: int = PORT,
+                 metrics_port: Optional[int] = None,
+                 limits: ConnectionLimits = ConnectionLimits(),
+                 message_log_dir: Optional[str] = None) -> None:
+        """
+        Sets up the server; start() begins accepting connections.
+
+        Args:
+            host: Address to listen on.
+            port: Port to listen on.
+            metrics_port: Port for /metrics and /profile, or None.
+            limits: Connection, admission and storage limits.
+            message_log_dir: Store messages in an append-only log in this
+                folder instead of SQLite (see src/server/message_log.py).
+        """
+        self.host: str = host
+        self.port: int = port
+        self.metrics_port: Optional[int] = metrics_port
+        self.limits: ConnectionLimits = limits
         self.server_socket: socket.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.clients: Dict[str, socket.socket] = {}
-        self.db: Database = Database()
-
-        self.crypto: CryptoManager = CryptoManager()
+        self.clients: ClientRegistry = ClientRegistry()
+
+        self.metrics: Metrics = Metrics()
+        self.metrics.gauge("chat_connected_clients", lambda: len(self.clients),
+                           "Authenticated clients currently connected")
+        set_frame_observer(self._observe_frame)
+        self.db: Database = cast(Database, TimedProxy(
+            Database(MessageLog(message_log_dir) if message_log_dir else None),
+            self.metrics, "chat_db_query_duration_seconds"))
+        self.public_keys: Dict[str, str] = {}
+        # Subscribers per public room, loaded from room_members on first use.
+        self.room_subscribers: Dict[str, Set[str]] = {}
+        self._rooms_lock: threading.Lock = threading.Lock()
+        self._conn_ids: Iterator[int] = itertools.count(1)
+        # Sessions that logged in with a device id: (device, last message id delivered).
+        self.devices: Dict[socket.socket, Tuple[str, int]] = {}
+        self._devices_lock: threading.Lock = threading.Lock()
+        # Monotonic time of the last frame read from each connection.
+        self.last_seen: Dict[socket.socket, float] = {}
+        # One lock per connection: lane workers, fan-out and the reaper all send on it.
+        self._send_locks: Dict[socket.socket, threading.Lock] = {}
+        # Worker pools per lane, started by start(); without them requests run inline.
+        self.lanes: Dict[str, LaneExecutor] = {}
+        # Connections that negotiated frame compression at login.
+        self.compressed: Set[socket.socket] = set()
+        # Per handler thread: id of the request being processed and whether it was answered.
+        self._request: threading.local = threading.local()
+
+        self.rate_limiter: RateLimiter = RateLimiter(limits.rates)
+        self.admission: AdmissionController = AdmissionController(
+            limits.max_connections, limits.max_in_flight)
+        self.metrics.gauge("chat_requests_in_flight", lambda: self.admission.in_flight,
+                           "Requests being processed")
+        # Latest messages per conversation, answering most get_history requests.
+        self.recent: RecentMessages = RecentMessages(limits.recent_messages, limits.recent_budget)
+        self.metrics.gauge("chat_recent_messages_bytes", lambda: self.recent.size,
+                           "Approximate memory held by the recent-messages buffers")
+        self.profiler: Profiler = Profiler()
+        self.crypto: CryptoManager = CryptoManager(suite=CIPHER_SUITE)
         self.session_key: str = self.crypto.get_key_as_string()
-        print(f"[SECURITY] Session key loaded: {self.session_key[:10]}...")
+        logger.info("Session key loaded: %s...", self.session_key[:10])
 
     def start(self) -> None:
         """Starts the server listener."""
         try:
-            self.server_socket.bind((HOST, PORT))
+            self.server_socket.bind((self.host, self.port))
             self.server_socket.listen()
-            print(f"[SERVER] Started on {HOST}:{PORT}")
+            logger.info("Started on %s:%s", self.host, self.port)
+            self.start_lanes()
+            if self.metrics_port:
+                start_metrics_server(self.metrics, port=self.metrics_port,
+                                     routes={"/profile": self._profile_route})
+                logger.info("Metrics on http://127.0.0.1:%s/metrics", self.metrics_port)
+            if self.limits.heartbeat_interval:
+                threading.Thread(target=self._reap_loop, daemon=True).start()
+            if self.limits.archive_after_days or self.db.message_log:
+                threading.Thread(target=self._storage_loop, daemon=True).start()
+            if hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+                signal.signal(signal.SIGUSR1, lambda *_: self.start_profiling())
             while True:
                 conn, addr = self.server_socket.accept()
+                self.metrics.inc("chat_connections_total", doc="Accepted TCP connections")
                 threading.Thread(target=self.handle_client, args=(conn, addr)).start()
         except Exception as e:  # pylint: disable=broad-exception-caught
-            print(f"[CRITICAL ERROR] {e}")
+            logger.critical("Server stopped: %s", e, exc_info=True)
 
-    def handle_client(self, conn: socket.socket, _addr: Tuple[str, int]) -> None:
+    def start_lanes(self) -> None:
+        """Starts the worker pool of each request lane."""
+        for name, (workers, queue_size) in self.limits.lanes.items():
+            if name not in self.lanes:
+                self.lanes[name] = LaneExecutor(name, workers, queue_size, self._observe_lane_wait)
+
+    def start_profiling(self, duration: float = DEFAULT_DURATION) -> bool:
+        """
+        Starts a bounded profiling window (SIGUSR1 or GET /profile?seconds=N).
+
+        Returns:
+            bool: False if a window is already running.
+        """
+        started = self.profiler.start(duration)
+        if started:
+            logger.info("Profiling for %gs", duration)
+        return started
+
+    def _profile_route(self, params: Dict[str, str]) -> Tuple[int, str]:
+        """HTTP handler for /profile on the loopback metrics endpoint."""
+        try:
+            duration = float(params.get("seconds", DEFAULT_DURATION))
+        except ValueError:
+            return 400, "seconds must be a number\n"
+        if duration <= 0:
+            return 400, "seconds must be positive\n"
+        if not self.start_profiling(duration):
+            return 409, "profiling already running\n"
+        return 202, f"profiling for {duration:g}s\n"
+
+    def handle_client(self, conn: socket.socket, addr: Tuple[str, int]) -> None:
         """
         Handles the lifecycle of a single client connection.
         """
+        conn_id = next(self._conn_ids)
+        with log_context(conn=conn_id, peer=f"{addr[0]}:{addr[1]}"):
+            if not self.admission.open_connection():
+                self.metrics.inc("chat_connections_rejected_total", {"reason": "capacity"},
+                                 doc="Connections closed by frame size, budget or timeout guards")
+                logger.warning("Refusing connection: server full")
+                send_json(conn, {"action": "error", "reason": "overloaded",
+                                 "msg": "Server is full, try again later",
+                                 "retry_after": OVERLOAD_RETRY_AFTER})
+                conn.close()
+                return
+            try:
+                self._serve(conn, conn_id)
+            finally:
+                self.admission.close_connection()
+
+    def _serve(self, conn: socket.socket, conn_id: int) -> None:
+        """Reads and handles requests until the client disconnects."""
         current_user: Optional[str] = None
+        limits = self.limits
+        budget = ReadBudget(limits.read_budget, limits.budget_window)
+        # Requests queued on lanes; waited for before the connection is torn down.
+        pending: List["Future[Any]"] = []
+        self._send_locks[conn] = threading.Lock()
         try:
-            while True:
-                req = receive_json(conn)
+            for seq in itertools.count(1):
+                req = read_frame(
+                    conn, limits.max_frame_size,
+                    idle_timeout=limits.idle_timeout if current_user else limits.login_timeout,
+                    frame_timeout=limits.frame_timeout, budget=budget,
+                    max_inflated=limits.max_frame_size)
                 if not req:
                     break
+                self.last_seen[conn] = time.monotonic()
 
                 self._trim_request_inputs(req)
-
-                new_user = self._process_action(conn, req, current_user)
-
+                lane = self.lanes.get(LANE_OF.get(str(req.get("action")), "")) if current_user else None
+                if lane and current_user:
+                    pending = [f for f in pending if not f.done()]
+                    self._submit(lane, conn, req, current_user, f"{conn_id}.{seq}", pending)
+                    continue
+                new_user = self._handle_request(conn, req, current_user, f"{conn_id}.{seq}")
                 if new_user:
                     current_user = new_user
+                    bind_context(user=current_user)
 
+        except FrameError as e:
+            self.metrics.inc("chat_connections_rejected_total", {"reason": e.reason},
+                             doc="Connections closed by frame size, budget or timeout guards")
+            logger.warning("Closing connection: %s", e)
+            self._send(conn, {"action": "error", "reason": e.reason, "msg": str(e)})
         except Exception as e:  # pylint: disable=broad-exception-caught
-            print(f"[ERROR] {e}")
+            logger.error("Connection error: %s", e, exc_info=True)
         finally:
-            if current_user and current_user in self.clients:
-                del self.clients[current_user]
+            wait(pending, DRAIN_TIMEOUT)
+            if current_user:
+                # Save the cursor before going offline, so a quick reconnect of the
+                # same device reads it; later deliveries no longer advance it.
+                with self._devices_lock:
+                    device = self.devices.pop(conn, None)
+                if device:
+                    try:
+                        self.db.set_device_cursor(current_user, *device)
+                    except Exception as e:  # pylint: disable=broad-exception-caught
+                        logger.error("Could not save device cursor: %s", e)
+                self.clients.remove(current_user, conn)
+                if current_user not in self.clients:
+                    self.rate_limiter.forget(current_user)
+            self.compressed.discard(conn)
+            self.last_seen.pop(conn, None)
+            self._send_locks.pop(conn, None)
             conn.close()
 
+    def _submit(self, lane: LaneExecutor, conn: socket.socket,  # pylint: disable=too-many-arguments,too-many-positional-arguments
+                req: Dict[str, Any], user: str, seq_id: str,
+                pending: List["Future[Any]"]) -> None:
+        """
+        Queues a request on its lane, or answers it with an overloaded error if
+        the lane is full. Waits for membership changes to finish, since the
+        connection's next requests may run on another lane and depend on them.
+        """
+        task = functools.partial(self._run_in_lane, conn, req, user, seq_id)
+        try:
+            future = lane.submit(conversation_key(user, req), task)
+        except queue.Full:
+            self.metrics.inc("chat_requests_rejected_total",
+                             {"action": str(req.get("action")), "reason": "overloaded"},
+                             doc="Requests refused by rate limits or load shedding")
+            self._request.id, self._request.replied = req.get("id"), False
+            self._reply(conn, {"action": "error", "reason": "overloaded",
+                               "msg": f"Too many queued {lane.name} requests",
+                               "retry_after": OVERLOAD_RETRY_AFTER})
+            return
+        pending.append(future)
+        if req.get("action") in MEMBERSHIP_ACTIONS:
+            wait([future])
+
+    def _run_in_lane(self, conn: socket.socket, req: Dict[str, Any],
+                     user: str, seq_id: str) -> None:
+        """Lane worker entry point: handles one request, logging instead of raising errors."""
+        try:
+            self._handle_request(conn, req, user, seq_id)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logger.error("Request failed: %s", e, exc_info=True)
+
+    def _observe_lane_wait(self, lane: str, seconds: float) -> None:
+        """Records how long a request waited in its lane's queue."""
+        self.metrics.observe("chat_lane_wait_seconds", seconds, {"lane": lane},
+                             doc="Time requests spent queued before a lane worker took them")
+
+    def _handle_request(self, conn: socket.socket, req: Dict[str, Any],
+                        current_user: Optional[str], seq_id: str) -> Optional[str]:
+        """
+        Admits and processes one request, answering it with an error frame if
+        it is rate limited or shed. Returns the username if a login occurred.
+        """
+        action = req.get("action")
+        label = {"action": action if action in KNOWN_ACTIONS else "unknown"}
+        req_id = req.get("id")
+        self._request.id, self._request.replied = req_id, False
+        new_user = None
+        with log_context(user=current_user, action=action,
+                         request_id=req_id if req_id is not None else seq_id):
+            rejection = self._admit(current_user, label["action"])
+            if rejection:
+                self.metrics.inc("chat_requests_rejected_total",
+                                 {"action": label["action"], "reason": rejection["reason"]},
+                                 doc="Requests refused by rate limits or load shedding")
+                logger.info("Rejected request: %s", rejection["reason"])
+                self._reply(conn, rejection)
+                return None
+            try:
+                with self.metrics.timer("chat_action_duration_seconds", label,
+                                        "Time spent handling one request"):
+                    new_user = self._process_action(conn, req, current_user)
+            finally:
+                if label["action"] not in EXEMPT:
+                    self.admission.end()
+        self.metrics.inc("chat_actions_total", label, doc="Requests handled")
+        if req_id is not None and not self._request.replied:
+            self._reply(conn, {"action": "ack"})
+        return new_user
+
+    def _admit(self, user: Optional[str], action: str) -> Optional[Dict[str, Any]]:
+        """
+        Applies the user's rate limit for the action and reserves a processing
+        slot. Returns the error frame to send instead if the request is refused.
+        """
+        if action in EXEMPT:
+            return None
+        retry_after = self.rate_limiter.allow(user, action) if user else None
+        if retry_after is not None:
+            return {"action": "error", "reason": "rate_limited",
+                    "msg": f"Too many {action} requests", "retry_after": round(retry_after, 2)}
+        if not self.admission.begin(action):
+            return {"action": "error", "reason": "overloaded",
+                    "msg": "Server is busy, try again", "retry_after": OVERLOAD_RETRY_AFTER}
+        return None
+
+    def _reap_loop(self) -> None:
+        """Background thread: pings quiet sessions and reaps dead ones."""
+        interval = self.limits.heartbeat_interval or HEARTBEAT_INTERVAL
+        while True:
+            # Check several times per interval so pings go out close to on time.
+            time.sleep(interval / 3)
+            try:
+                self.reap_idle_sessions()
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                logger.error("Reaper error: %s", e, exc_info=True)
+
+    def _storage_loop(self) -> None:
+        """
+        Background thread: moves old messages to the monthly archives, or
+        compacts the message log when one is used.
+        """
+        while True:
+            try:
+                self.archive_old_messages()
+                if self.db.message_log:
+                    moved = self.db.message_log.compact()
+                    if moved:
+                        logger.info("Compacted %d logged messages", moved)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                logger.error("Storage maintenance error: %s", e, exc_info=True)
+            time.sleep(self.limits.archive_interval)
+
+    def archive_old_messages(self) -> int:
+        """
+        Moves messages older than archive_after_days out of the hot database.
+
+        Returns:
+            int: Number of messages archived.
+        """
+        if not self.limits.archive_after_days:
+            return 0
+        moved = self.db.archive_messages(self.limits.archive_after_days)
+        if moved:
+            self.metrics.inc("chat_messages_archived_total", value=moved,
+                             doc="Messages moved to the monthly archive files")
+            logger.info("Archived %d messages", moved)
+        return moved
+
+    def reap_idle_sessions(self, now: Optional[float] = None) -> int:
+        """
+        Pings logged-in sessions that have been silent for heartbeat_interval
+        and evicts those silent for heartbeat_timeout. Shutting an evicted
+        socket down wakes its handler thread, which then cleans up as on a
+        normal disconnect.
+
+        Returns:
+            int: Number of sessions evicted.
+        """
+        interval = self.limits.heartbeat_interval or HEARTBEAT_INTERVAL
+        now = time.monotonic() if now is None else now
+        reaped = 0
+        for user, sessions in self.clients.snapshot().items():
+            for conn in sessions:
+                seen = self.last_seen.get(conn)
+                if seen is None:
+                    continue
+                idle = now - seen
+                if idle >= self.limits.heartbeat_timeout:
+                    logger.info("Reaping session of %s, silent for %.0fs", user, idle)
+                    self.clients.remove(user, conn)
+                    try:
+                        conn.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+                    self.metrics.inc("chat_sessions_reaped_total",
+                                     doc="Sessions evicted for missing heartbeats")
+                    reaped += 1
+                elif idle >= interval:
+                    self._send(conn, {"action": "ping"})
+        return reaped
+
+    def _observe_frame(self, direction: str, size: int) -> None:
+        """Records the size of every frame sent or received."""
+        self.metrics.observe("chat_frame_bytes", size, {"direction": direction}, SIZE_BUCKETS,
+                             "Frame sizes including the length header")
+
+    def _reply(self, conn: socket.socket, payload: Dict[str, Any]) -> None:
+        """
+        Sends the response to the request being handled on this thread,
+        echoing its "id" so pipelining clients can match it.
+        """
+        req_id = getattr(self._request, "id", None)
+        if req_id is not None:
+            payload["id"] = req_id
+            self._request.replied = True
+        self._send(conn, payload)
+
+    def _send(self, conn: socket.socket, payload: Dict[str, Any]) -> None:
+        """Sends a frame, compressed if this connection negotiated it."""
+        lock = self._send_locks.get(conn)
+        if lock is None:
+            self._write(conn, payload)
+            return
+        with lock:
+            self._write(conn, payload)
+
+    def _write(self, conn: socket.socket, payload: Dict[str, Any]) -> None:
+        """Writes one frame to the socket."""
+        if conn in self.compressed:
+            send_json(conn, payload, compress=True)
+        else:
+            send_json(conn, payload)
+
     def _trim_request_inputs(self, req: Dict[str, Any]) -> None:
         """Trims whitespace from string fields in the request."""
         fields = ["username", "target", "sender", "group_name", "room_name", "tags", "to"]
@@ -79,21 +488,27 @@ class ChatServer:
         """
         action = req.get("action")
 
-        if action == "register":
+        if action == "ping":
+            # A "pong" needs no handling: reading it already refreshed last_seen.
+            self._reply(conn, {"action": "pong"})
+        elif action == "register":
             self._handle_register(conn, req)
         elif action == "login":
             return self._handle_login(conn, req)
         elif action == "get_data":
             if current_user:
-                self._refresh_client_data(current_user)
+                self._reply(conn, self._client_data(current_user))
         elif action == "get_history":
             if current_user:
                 self._handle_get_history(conn, current_user, req)
         elif action == "msg":
             if current_user:
                 self._handle_msg(conn, current_user, req)
+        elif action in ("get_public_key", "share_group_key", "get_group_key"):
+            if current_user:
+                self._handle_key_action(conn, current_user, req, action)
         elif current_user and isinstance(action, str):
-            self._handle_other_actions(current_user, req, action)
+            self._handle_other_actions(conn, current_user, req, action)
 
         return None
 
@@ -103,75 +518,149 @@ class ChatServer:
         password = req.get("password", "")
 
         if not username or not password:
-            send_json(conn, {"status": "error", "msg": "Username and password cannot be empty!"})
+            self._reply(conn, {"status": "error", "msg": "Username and password cannot be empty!"})
             return
 
         result = self.db.register_user(username, password)
         if result == "success":
-            send_json(conn, {"status": "success", "msg": "OK", "key": self.session_key})
+            if req.get("public_key"):
+                self._set_public_key(username, str(req["public_key"]))
+            self._reply(conn, {"status": "success", "msg": "OK", "key": self.session_key})
         elif result == "taken":
-            send_json(conn, {"status": "error", "msg": "Username taken!"})
+            self._reply(conn, {"status": "error", "msg": "Username taken!"})
         else:
-            send_json(conn, {"status": "error", "msg": "Error."})
+            self._reply(conn, {"status": "error", "msg": "Error."})
 
     def _handle_login(self, conn: socket.socket, req: Dict[str, Any]) -> Optional[str]:
         """Handles user login. Returns username if successful, else None."""
         user = req["username"]
         if self.db.check_login(user, req["password"]):
-            self.clients[user] = conn
-            send_json(conn, {"status": "success", "msg": "OK", "key": self.session_key})
+            if self._identity_conflict(user, req):
+                self._reply(conn, {"status": "error", "reason": "identity_mismatch",
+                                   "msg": IDENTITY_MISMATCH_MSG})
+                return None
+            self.clients.add(user, conn)
+            if req.get("public_key"):
+                self._set_public_key(user, str(req["public_key"]))
+            resp = {"status": "success", "msg": "OK", "key": self.session_key}
+            if COMPRESSION in req.get("compress", ()):
+                resp["compress"] = COMPRESSION
+            self._reply(conn, resp)
+            if "compress" in resp:
+                self.compressed.add(conn)
+            if req.get("device"):
+                self._start_device_session(conn, user, str(req["device"]))
             return str(user)
 
-        send_json(conn, {"status": "error", "msg": "Invalid credentials"})
+        self._reply(conn, {"status": "error", "msg": "Invalid credentials"})
         return None
 
     def _handle_get_history(self, conn: socket.socket,
                             current_user: str, req: Dict[str, Any]) -> None:
-        """Retrieves and sends chat history."""
+        """
+        Sends chat history: the newest `limit` messages (all if absent) with
+        ids below `before`. The recent-messages buffer answers when it can.
+        """
         target = req["target"]
-        history_list = self.db.get_chat_history(current_user, target)
-        send_json(conn, {
+        limit = req.get("limit")
+        limit = limit if isinstance(limit, int) and limit > 0 else None
+        before = req.get("before")
+        before = before if isinstance(before, int) else None
+
+        key = conversation_key(current_user, req)
+        history_list = self.recent.recent(key, limit, before)
+        self.metrics.inc("chat_history_cache_total",
+                         {"result": "miss" if history_list is None else "hit"},
+                         doc="get_history requests answered from memory or the database")
+        if history_list is None:
+            history_list = self.db.get_chat_history(current_user, target,
+                                                    limit=limit, before=before)
+            if before is None:
+                self.recent.fill(key, history_list,
+                                 complete=limit is None or len(history_list) < limit)
+        self._reply(conn, {
             "action": "history_response",
             "target": target,
             "messages": history_list
         })
 
-    def _handle_msg(self, _conn: socket.socket, current_user: str, req: Dict[str, Any]) -> None:
-        """Handles sending messages."""
+    def _start_device_session(self, conn: socket.socket, user: str, device: str) -> None:
+        """
+        Sends a device the direct and group messages it missed since its last
+        session, then tracks what it is delivered until it disconnects.
+        """
+        up_to = self.db.get_last_message_id()
+        cursor = self.db.get_device_cursor(user, device)
+        with self._devices_lock:
+            self.devices[conn] = (device, up_to)
+        if cursor is not None and cursor < up_to:
+            missed = self.db.get_messages_since(user, cursor, up_to)
+            if missed:
+                self._send(conn, {"action": "offline_messages", "messages": missed})
+
+    def _deliver(self, sessions: Sessions, payload: Dict[str, Any],
+                 msg_id: int = 0, skip: Optional[socket.socket] = None) -> int:
+        """
+        Sends a frame to every session of a user except `skip`, advancing the
+        device cursors of those sessions to `msg_id`.
+
+        Returns:
+            int: Number of sessions the frame was sent to.
+        """
+        sent = 0
+        for s in sessions:
+            if s is skip:
+                continue
+            self._send(s, payload)
+            sent += 1
+            if msg_id and s in self.devices:
+                with self._devices_lock:
+                    entry = self.devices.get(s)
+                    if entry and msg_id > entry[1]:
+                        self.devices[s] = (entry[0], msg_id)
+        return sent
+
+    def _handle_msg(self, conn: socket.socket, current_user: str, req: Dict[str, Any]) -> None:
+        """
+        Handles sending messages. Every device of the recipients gets the
+        message, and so do the sender's other devices.
+        """
         recipient = req["to"]
         text = req["text"]
 
-        self.db.store_message(current_user, recipient, text)
-
-        if recipient.startswith("#"):
-            for m in self.db.get_group_members(recipient):
-                if m in self.clients and m != current_user:
-                    send_json(self.clients[m], {
-                        "action": "msg",
-                        "sender": current_user,
-                        "to": recipient,
-                        "text": text
-                    })
-
-        elif recipient.startswith("&"):
-            for u, s in self.clients.items():
-                if u != current_user:
-                    send_json(s, {
-                        "action": "msg",
-                        "sender": current_user,
-                        "to": recipient,
-                        "text": text
-                    })
-
-        elif recipient in self.clients:
-            send_json(self.clients[recipient], {
-                "action": "msg",
-                "sender": current_user,
-                "to": current_user,
-                "text": text
-            })
+        msg_id = self.db.store_message(current_user, recipient, text)
+        if msg_id:
+            self.recent.append(conversation_key(current_user, req),
+                               {"id": msg_id, "sender": current_user, "to": recipient, "text": text})
+        frame = {"action": "msg", "sender": current_user, "to": recipient, "text": text}
+        clients = self.clients.snapshot()
+
+        sent = 0
+        if recipient.startswith("#") or recipient.startswith("&"):
+            if recipient.startswith("#"):
+                kind = "group"
+                members = self.db.get_group_members(recipient)
+            else:
+                kind = "room"
+                if current_user not in self._room_subscribers(recipient):
+                    # Posting to a room subscribes the sender so they see replies.
+                    self._join_room(recipient, current_user)
+                members = list(self._room_subscribers(recipient))
+            for m in members:
+                if m != current_user:
+                    sent += self._deliver(clients.get(m, ()), frame, msg_id)
+
+        else:
+            kind = "dm"
+            sent += self._deliver(clients.get(recipient, ()),
+                                  {**frame, "to": current_user}, msg_id)
 
-    def _handle_other_actions(self, current_user: str, req: Dict[str, Any], action: str) -> None:
+        sent += self._deliver(clients.get(current_user, ()), frame, msg_id, skip=conn)
+        self.metrics.observe("chat_message_fanout", sent, {"kind": kind}, FANOUT_BUCKETS,
+                             "Recipients each message was delivered to")
+
+    def _handle_other_actions(self, conn: socket.socket, current_user: str,
+                              req: Dict[str, Any], action: str) -> None:
         """Handles remaining authenticated actions to reduce main loop complexity."""
         if action == "send_friend_request":
             if self.db.send_friend_request(current_user, req["target"]) == "success":
@@ -186,35 +675,158 @@ class ChatServer:
         elif action == "create_group":
             if self.db.create_group(req["group_name"], current_user):
                 self._refresh_client_data(current_user)
+            else:
+                # The client only shares a fresh group key after a successful create.
+                self._reply(conn, {"action": "error", "reason": "group_exists",
+                                   "msg": "Group name already taken"})
 
         elif action == "join_group":
             if self.db.join_group(req["group_name"], current_user):
                 self._refresh_client_data(current_user)
+                self._request_group_key_for(req["group_name"], current_user)
 
         elif action == "create_public_room":
-            name = req["room_name"]
-            if not name.startswith("&"):
-                name = "&" + name
+            name = self._room_name(req["room_name"])
             if self.db.create_public_room(name, req.get("tags", ""), current_user):
+                with self._rooms_lock:
+                    self.room_subscribers[name] = {current_user}
                 self._refresh_client_data(current_user)
 
-    def _refresh_client_data(self, username: str) -> None:
-        """Compiles and sends all contact/room data to a specific user."""
-        if username in self.clients:
-            friends = self.db.get_friends_list(username)
-            groups = self.db.get_user_groups(username)
-            requests = self.db.get_pending_requests(username)
-            active = list(self.clients.keys())
-            pub = self.db.get_public_rooms()
-            send_json(self.clients[username], {
-                "action": "data_update",
-                "friends": friends,
-                "groups": groups,
-                "requests": requests,
-                "active_users": active,
-                "public_rooms": pub
+        elif action == "join_room":
+            self._join_room(self._room_name(req["room_name"]), current_user)
+
+        elif action == "leave_room":
+            name = self._room_name(req["room_name"])
+            self.db.leave_room(name, current_user)
+            with self._rooms_lock:
+                self.room_subscribers.get(name, set()).discard(current_user)
+
+    @staticmethod
+    def _room_name(name: str) -> str:
+        """Normalizes a public room name to its &name form."""
+        return name if name.startswith("&") else "&" + name
+
+    def _room_subscribers(self, room: str) -> Set[str]:
+        """Returns a snapshot of a room's subscribers, loading them on first use."""
+        with self._rooms_lock:
+            subs = self.room_subscribers.get(room)
+        if subs is None:
+            loaded = set(self.db.get_room_members(room))
+            with self._rooms_lock:
+                subs = self.room_subscribers.setdefault(room, loaded)
+        with self._rooms_lock:
+            return set(subs)
+
+    def _join_room(self, room: str, username: str) -> bool:
+        """Subscribes a user to an existing room (persisted and cached)."""
+        if not self.db.join_room(room, username):
+            return False
+        self._room_subscribers(room)
+        with self._rooms_lock:
+            self.room_subscribers[room].add(username)
+        return True
+
+    def _get_public_key(self, username: str) -> Optional[str]:
+        """Returns a user's public key from the in-memory cache, loading it on a miss."""
+        key = self.public_keys.get(username)
+        if key is None:
+            key = self.db.get_public_key(username)
+            if key:
+                self.public_keys[username] = key
+        return key
+
+    def _identity_conflict(self, username: str, req: Dict[str, Any]) -> bool:
+        """
+        True if a login offers a different identity key than the registered one
+        without asking to replace it. Peers encrypt for the registered key only,
+        so a device with its own key could not read them, and silently switching
+        keys would cut off the user's other devices instead.
+        """
+        offered = req.get("public_key")
+        registered = self._get_public_key(username)
+        return bool(offered and registered and offered != registered
+                    and not req.get("replace_key"))
+
+    def _set_public_key(self, username: str, public_key: str) -> None:
+        """Stores a user's public key if it changed."""
+        if self._get_public_key(username) != public_key:
+            self.db.set_public_key(username, public_key)
+            self.public_keys[username] = public_key
+
+    def _handle_key_action(self, conn: socket.socket, current_user: str,
+                           req: Dict[str, Any], action: str) -> None:
+        """Handles E2E key directory and group key distribution."""
+        if action == "get_public_key":
+            target = req["target"]
+            self._reply(conn, {
+                "action": "public_key",
+                "target": target,
+                "public_key": self._get_public_key(target) or ""
             })
 
+        elif action == "share_group_key":
+            group = req["group_name"]
+            members = set(self.db.get_group_members(group))
+            if current_user not in members:
+                return
+            for member, wrapped in dict(req.get("keys", {})).items():
+                if member in members:
+                    self.db.store_group_key(group, member, wrapped, current_user)
+                    self._deliver(self.clients.sessions(member),
+                                  self._group_key_frame(group, wrapped, current_user))
+
+        elif action == "get_group_key":
+            group = req["group_name"]
+            stored = self.db.get_group_key(group, current_user)
+            if stored:
+                self._reply(conn, self._group_key_frame(group, stored[0], stored[1]))
+            elif current_user in self.db.get_group_members(group):
+                self._request_group_key_for(group, current_user)
+
+    def _group_key_frame(self, group: str, wrapped: str, wrapped_by: str) -> Dict[str, Any]:
+        """Builds a wrapped group key frame including the wrapper's public key."""
+        return {
+            "action": "group_key",
+            "group_name": group,
+            "wrapped_key": wrapped,
+            "wrapped_by": wrapped_by,
+            "wrapped_by_key": self._get_public_key(wrapped_by) or ""
+        }
+
+    def _request_group_key_for(self, group: str, new_member: str) -> None:
+        """Asks online members holding the group key to wrap it for a new member."""
+        public_key = self._get_public_key(new_member)
+        if not public_key:
+            return
+        frame = {
+            "action": "group_key_needed",
+            "group_name": group,
+            "member": new_member,
+            "public_key": public_key
+        }
+        clients = self.clients.snapshot()
+        for m in self.db.get_group_members(group):
+            if m != new_member:
+                self._deliver(clients.get(m, ()), frame)
+
+    def _client_data(self, username: str) -> Dict[str, Any]:
+        """Compiles all contact/room data for a specific user."""
+        return {
+            "action": "data_update",
+            "friends": self.db.get_friends_list(username),
+            "groups": self.db.get_user_groups(username),
+            "requests": self.db.get_pending_requests(username),
+            "active_users": list(self.clients.snapshot()),
+            "public_rooms": self.db.get_public_rooms()
+        }
+
+    def _refresh_client_data(self, username: str) -> None:
+        """Sends all contact/room data to a specific user if they are online."""
+        sessions = self.clients.sessions(username)
+        if sessions:
+            self._deliver(sessions, self._client_data(username))
+
 
 if __name__ == "__main__":
-    ChatServer().start()
+    setup_logging()
+    ChatServer(metrics_port=METRICS_PORT).start()
@@ -0,0 +1,48 @@
+from unittest.mock import patch
+from src.server.admission import AdmissionController, RateLimiter
+
+
+def test_rate_limiter_buckets_per_user_and_action() -> None:
+    limiter = RateLimiter({"msg": (2, 10.0), "*": (1, 10.0)})
+    with patch('src.common.protocol.time.monotonic', return_value=100.0):
+        assert limiter.allow("a", "msg") is None
+        assert limiter.allow("a", "msg") is None
+        retry = limiter.allow("a", "msg")
+        assert retry is not None and 4.9 < retry <= 5.0
+
+        # Other users and other actions have their own buckets.
+        assert limiter.allow("b", "msg") is None
+        assert limiter.allow("a", "get_data") is None
+        assert limiter.allow("a", "create_group") is not None
+
+    with patch('src.common.protocol.time.monotonic', return_value=105.0):
+        assert limiter.allow("a", "msg") is None
+
+
+def test_rate_limiter_forget_and_unlimited_actions() -> None:
+    limiter = RateLimiter({"msg": (1, 10.0)})
+    assert limiter.allow("a", "get_data") is None
+    assert limiter.allow("a", "msg") is None
+    assert limiter.allow("a", "msg") is not None
+    limiter.forget("a")
+    assert limiter.allow("a", "msg") is None
+
+
+def test_low_priority_requests_are_shed_first() -> None:
+    adm = AdmissionController(max_connections=1, max_in_flight=4, shed_fraction=0.5)
+    assert adm.begin("get_history") and adm.begin("get_data")
+    assert adm.begin("get_history") is False
+    assert adm.begin("msg") and adm.begin("msg")
+    assert adm.begin("msg") is False
+
+    adm.end()
+    assert adm.begin("msg")
+    assert adm.in_flight == 4
+
+
+def test_connection_cap() -> None:
+    adm = AdmissionController(max_connections=1, max_in_flight=1)
+    assert adm.open_connection()
+    assert adm.open_connection() is False
+    adm.close_connection()
+    assert adm.open_connection()
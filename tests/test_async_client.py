@@ -0,0 +1,235 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+from typing import Any, Generator, Tuple
+from unittest.mock import patch
+import pytest
+from src.client.async_client import AsyncNetworkClient, RequestRejected
+from src.server import database
+from src.server.server_main import ChatServer
+from src.common import crypto_utils
+from src.common.crypto_utils import KeyChanged
+
+
+@pytest.fixture
+def live_server(tmp_path: Any) -> Generator[Tuple[str, int], None, None]:
+    """Runs a real ChatServer on an ephemeral port with its files under tmp_path."""
+    with patch.object(database, "DB_DIR", str(tmp_path)), \
+            patch.object(database, "DB_PATH", os.path.join(str(tmp_path), "data.db")), \
+            patch.object(crypto_utils, "KEY_FILE", os.path.join(str(tmp_path), "server.key")), \
+            patch.object(crypto_utils, "KEYRING_FILE", os.path.join(str(tmp_path), "server.keyring")), \
+            patch.object(crypto_utils, "IDENTITY_DIR", os.path.join(str(tmp_path), "keys")):
+        server = ChatServer(port=0)
+        threading.Thread(target=server.start, daemon=True).start()
+        deadline = time.monotonic() + 5
+        # The port is bound before listen(); connecting in between is refused.
+        while (not server.server_socket.getsockopt(socket.SOL_SOCKET, socket.SO_ACCEPTCONN)
+               and time.monotonic() < deadline):
+            time.sleep(0.01)
+        yield server.server_socket.getsockname()
+        server.server_socket.close()
+        # Let handler threads finish their disconnect work before the paths are restored.
+        deadline = time.monotonic() + 2
+        while server.last_seen and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+
+async def login(addr: Tuple[str, int], name: str) -> AsyncNetworkClient:
+    reg = AsyncNetworkClient(*addr)
+    assert await reg.connect(name, "pw", is_register=True) == (True, "OK")
+    client = AsyncNetworkClient(*addr)
+    assert await client.connect(name, "pw") == (True, "OK")
+    return client
+
+
+async def next_message(client: AsyncNetworkClient) -> Any:
+    return await asyncio.wait_for(client.messages().__anext__(), 5)
+
+
+def test_connect_failure(live_server: Tuple[str, int]) -> None:
+    async def run() -> None:
+        client = AsyncNetworkClient(*live_server)
+        assert await client.connect("nobody", "pw") == (False, "Invalid credentials")
+        assert not client.connected
+        with pytest.raises(ConnectionError):
+            await client.refresh_data()
+
+    asyncio.run(run())
+
+
+def test_dm_group_and_room_round_trip(live_server: Tuple[str, int]) -> None:
+    async def run() -> None:
+        alice = await login(live_server, "alice")
+        bob = await login(live_server, "bob")
+
+        data = await bob.refresh_data()
+        assert set(data["active_users"]) == {"alice", "bob"}
+
+        # Direct message: end-to-end encrypted, fetched keys on demand.
+        await alice.send_message("bob", "hi bob")
+        msg = await next_message(bob)
+        assert (msg["sender"], msg["text"]) == ("alice", "hi bob")
+        history = await bob.get_chat_history("alice")
+        assert [m["text"] for m in history] == ["hi bob"]
+        await alice.send_message("bob", "again")
+        await next_message(bob)
+        latest = await bob.get_chat_history("alice", limit=1)
+        assert [m["text"] for m in latest] == ["again"]
+        older = await bob.get_chat_history("alice", limit=1, before=latest[0]["id"])
+        assert [m["text"] for m in older] == ["hi bob"]
+        assert bob.e2e is not None and bob.e2e.has_peer("alice")
+
+        # Group: the creator wraps the key for the new member while online.
+        group = await alice.create_group("team")
+        await bob.join_group(group)
+        await bob.send_message(group, "hello team")
+        msg = await next_message(alice)
+        assert (msg["to"], msg["text"]) == ("#team", "hello team")
+
+        # Public room: server key.
+        room = await alice.create_public_room("lobby", "chat")
+        await bob.join_room(room)
+        await alice.send_message(room, "welcome")
+        msg = await next_message(bob)
+        assert (msg["to"], msg["text"]) == ("&lobby", "welcome")
+
+        # Several requests in flight on one connection.
+        histories = await asyncio.gather(*(bob.get_chat_history(t) for t in ("alice", group, room)))
+        assert [[m["text"] for m in h] for h in histories] == [
+            ["hi bob", "again"], ["hello team"], ["welcome"]]
+
+        await bob.close()
+        assert [m async for m in bob.messages()] == []
+        await alice.close()
+
+    asyncio.run(run())
+
+
+def test_device_catches_up_after_reconnect(live_server: Tuple[str, int]) -> None:
+    async def run() -> None:
+        alice = await login(live_server, "alice")
+        bob = await login(live_server, "bob")
+        await alice.send_message("bob", "first")
+        assert (await next_message(bob))["text"] == "first"
+        await bob.close()
+        while "bob" in (await alice.refresh_data())["active_users"]:
+            await asyncio.sleep(0.01)
+
+        await alice.send_message("bob", "while you were away")
+        bob = AsyncNetworkClient(*live_server)
+        assert await bob.connect("bob", "pw") == (True, "OK")
+        msg = await next_message(bob)
+        assert (msg["sender"], msg["text"]) == ("alice", "while you were away")
+
+        # A second device of alice sees what the first one sends.
+        alice_laptop = AsyncNetworkClient(*live_server)
+        assert await alice_laptop.connect("alice", "pw") == (True, "OK")
+        await alice.send_message("bob", "from desktop")
+        assert (await next_message(bob))["text"] == "from desktop"
+        echo = await next_message(alice_laptop)
+        assert (echo["sender"], echo["to"], echo["text"]) == ("alice", "bob", "from desktop")
+
+        for c in (alice, alice_laptop, bob):
+            await c.close()
+
+    asyncio.run(run())
+
+
+def test_new_device_needs_the_identity_key(live_server: Tuple[str, int],
+                                           tmp_path: Any) -> None:
+    async def run() -> None:
+        alice = await login(live_server, "alice")
+        bob = await login(live_server, "bob")
+        assert alice.e2e
+        with patch.object(crypto_utils, "IDENTITY_DIR", str(tmp_path / "phone")):
+            phone = AsyncNetworkClient(*live_server)
+            ok, msg = await phone.connect("alice", "pw")
+            assert not ok and "another device" in msg
+
+            crypto_utils.E2EManager.import_identity("alice", alice.e2e.export_identity())
+            phone = AsyncNetworkClient(*live_server)
+            assert await phone.connect("alice", "pw") == (True, "OK")
+        await bob.send_message("alice", "to every device")
+        assert (await next_message(phone))["text"] == "to every device"
+        assert (await next_message(alice))["text"] == "to every device"
+
+        for c in (alice, phone, bob):
+            await c.close()
+
+    asyncio.run(run())
+
+
+def test_slow_consumer_does_not_stall_replies(live_server: Tuple[str, int]) -> None:
+    async def run() -> None:
+        alice = await login(live_server, "alice")
+        reg = AsyncNetworkClient(*live_server)
+        assert await reg.connect("bob", "pw", is_register=True) == (True, "OK")
+        bob = AsyncNetworkClient(*live_server, queue_size=2)
+        assert await bob.connect("bob", "pw") == (True, "OK")
+
+        for i in range(10):
+            await alice.send_message("bob", f"m{i}")
+        # bob has not read messages() yet; its requests are still answered.
+        data = await asyncio.wait_for(bob.refresh_data(), 5)
+        assert data["action"] == "data_update"
+        assert [(await next_message(bob))["text"] for _ in range(10)] == [
+            f"m{i}" for i in range(10)]
+        await alice.close()
+        await bob.close()
+
+    asyncio.run(run())
+
+
+def test_heartbeats_keep_a_quiet_connection_alive(live_server: Tuple[str, int]) -> None:
+    async def run() -> None:
+        await (await login(live_server, "carol")).close()
+        client = AsyncNetworkClient(*live_server, heartbeat_interval=0.05, heartbeat_timeout=0.5)
+        assert await client.connect("carol", "pw") == (True, "OK")
+        before = client.last_received
+        await asyncio.sleep(0.8)
+        # Pongs kept arriving, so the client never hit its timeout.
+        assert client.connected and client.last_received > before
+        await client.close()
+
+    asyncio.run(run())
+
+
+def test_changed_peer_key_is_refused_until_trusted(live_server: Tuple[str, int],
+                                                  tmp_path: Any) -> None:
+    async def run() -> None:
+        alice = await login(live_server, "alice")
+        bob = await login(live_server, "bob")
+        await alice.send_message("bob", "pins bob's key")
+        assert (await next_message(bob))["text"] == "pins bob's key"
+        with patch.object(crypto_utils, "IDENTITY_DIR", str(tmp_path / "new-phone")):
+            phone = AsyncNetworkClient(*live_server)
+            assert await phone.connect("bob", "pw", replace_key=True) == (True, "OK")
+
+        # A later session of alice still knows the pinned key.
+        laptop = AsyncNetworkClient(*live_server)
+        assert await laptop.connect("alice", "pw") == (True, "OK")
+        with pytest.raises(KeyChanged):
+            await laptop.send_message("bob", "for the new key")
+        assert laptop.trust_peer_key("bob")
+        await laptop.send_message("bob", "for the new key")
+        assert (await next_message(phone))["text"] == "for the new key"
+
+        for c in (alice, bob, phone, laptop):
+            await c.close()
+
+    asyncio.run(run())
+
+
+def test_rate_limited_request_raises(live_server: Tuple[str, int]) -> None:
+    async def run() -> None:
+        client = await login(live_server, "dave")
+        with pytest.raises(RequestRejected) as info:
+            for _ in range(100):
+                await client.refresh_data()
+        assert info.value.reason == "rate_limited" and info.value.retry_after > 0
+        assert client.connected
+        await client.close()
+
+    asyncio.run(run())
@@ -1,8 +1,13 @@
 import os
 import base64
+from typing import Any
 from unittest.mock import patch, mock_open, MagicMock
+import pytest
 from cryptography.fernet import Fernet
-from src.common.crypto_utils import CryptoManager, KEY_FILE
+from src.common.crypto_utils import (
+    CryptoManager, KEY_FILE, KeyRing, AEADCipher, E2EManager, KeyChanged,
+    SUITE_AES_GCM, SUITE_CHACHA20
+)
 
 
 def test_init_with_provided_key() -> None:
@@ -68,3 +73,151 @@ def test_decrypt_empty() -> None:
 def test_decrypt_invalid() -> None:
     manager = CryptoManager()
     assert manager.decrypt_message("InvalidToken") == "[Decryption Error]"
+
+
+def test_aead_roundtrip_both_suites() -> None:
+    """AEAD key rings round-trip through a client-side CryptoManager."""
+    for suite in (SUITE_AES_GCM, SUITE_CHACHA20):
+        raw = KeyRing.generate(suite).to_bytes()
+        manager = CryptoManager(key=raw)
+        assert manager.aead is not None
+        token = manager.encrypt_message("здравей")
+        assert manager.decrypt_message(token) == "здравей"
+
+
+def test_aead_envelope_is_compact() -> None:
+    manager = CryptoManager(key=KeyRing.generate().to_bytes())
+    envelope = manager.aead.encrypt(b"x" * 100) if manager.aead else b""
+    assert len(envelope) == 100 + 6 + 12 + 16
+
+
+def test_aead_tampering_detected() -> None:
+    manager = CryptoManager(key=KeyRing.generate().to_bytes())
+    raw = bytearray(base64.b64decode(manager.encrypt_message("secret")))
+    raw[-1] ^= 1
+    assert manager.decrypt_message(base64.b64encode(bytes(raw)).decode()) == "[Decryption Error]"
+
+
+def test_key_rotation_keeps_old_keys() -> None:
+    ring = KeyRing.generate()
+    sender = AEADCipher(ring)
+    old = sender.encrypt(b"old")
+    assert ring.rotate() == 2
+    new = sender.encrypt(b"new")
+
+    receiver = AEADCipher(KeyRing.from_bytes(ring.to_bytes()))
+    assert receiver.decrypt(old) == b"old"
+    assert receiver.decrypt(new) == b"new"
+
+
+def test_aead_manager_reads_legacy_fernet_tokens() -> None:
+    legacy_key = Fernet.generate_key()
+    legacy_token = CryptoManager(key=legacy_key).encrypt_message("old history")
+    manager = CryptoManager(key=KeyRing.generate(legacy=legacy_key).to_bytes())
+    assert manager.decrypt_message(legacy_token) == "old history"
+
+
+def test_server_keyring_generated_and_rotated(tmp_path: Any) -> None:
+    keyring_file = str(tmp_path / "server.keyring")
+    with patch('src.common.crypto_utils.KEYRING_FILE', keyring_file), \
+            patch('src.common.crypto_utils.KEY_FILE', str(tmp_path / "server.key")):
+        manager = CryptoManager(suite=SUITE_AES_GCM)
+        token = manager.encrypt_message("hi")
+        assert manager.rotate_key() == 2
+
+        reloaded = CryptoManager(suite=SUITE_AES_GCM)
+        assert reloaded.aead is not None and reloaded.aead.keyring.current == 2
+        assert reloaded.decrypt_message(token) == "hi"
+
+
+def test_rotate_requires_aead() -> None:
+    with pytest.raises(ValueError):
+        CryptoManager(key=Fernet.generate_key()).rotate_key()
+
+
+def test_e2e_pairwise_keys_match() -> None:
+    alice, bob = E2EManager("alice"), E2EManager("bob")
+    alice.set_peer_key("bob", bob.public_key_string())
+    bob.set_peer_key("alice", alice.public_key_string())
+    token = alice.encrypt_for("bob", "hi")
+    assert token.startswith("e2e:")
+    assert bob.decrypt_from("alice", token) == "hi"
+    assert E2EManager("eve").decrypt_from("alice", token) == "[Decryption Error]"
+
+
+def test_e2e_session_key_is_cached() -> None:
+    alice, bob = E2EManager("alice"), E2EManager("bob")
+    alice.set_peer_key("bob", bob.public_key_string())
+    cipher = alice._pair_cipher("bob")
+    assert alice._pair_cipher("bob") is cipher
+
+    alice.replace_peer_key("bob", E2EManager("bob").public_key_string())
+    assert alice._pair_cipher("bob") is not cipher
+
+
+def test_e2e_peer_key_is_pinned(tmp_path: Any) -> None:
+    with patch('src.common.crypto_utils.IDENTITY_DIR', str(tmp_path)):
+        alice, bob = E2EManager.load("alice"), E2EManager("bob")
+        alice.set_peer_key("bob", bob.public_key_string())
+        new_key = E2EManager("bob").public_key_string()
+        with pytest.raises(KeyChanged) as exc:
+            alice.set_peer_key("bob", new_key)
+        assert exc.value.peer == "bob" and exc.value.public_key == new_key
+        assert alice.peer_keys["bob"] == bob.public_key_string()
+
+        # Pins survive a restart; the session keys do not.
+        reloaded = E2EManager.load("alice")
+        assert not reloaded.has_peer("bob") and reloaded.is_pinned("bob")
+        with pytest.raises(KeyChanged):
+            reloaded.set_peer_key("bob", new_key)
+        assert reloaded.peer_keys["bob"] == bob.public_key_string()
+        reloaded.replace_peer_key("bob", new_key)
+        assert E2EManager.load("alice").pinned_keys == {"bob": new_key}
+
+
+def test_e2e_group_key_wrapping() -> None:
+    alice, bob = E2EManager("alice"), E2EManager("bob")
+    alice.set_peer_key("bob", bob.public_key_string())
+    bob.set_peer_key("alice", alice.public_key_string())
+    alice.new_group_key("#g")
+    assert bob.unwrap_group_key("#g", alice.wrap_group_key("#g", "bob"), "alice")
+    assert bob.decrypt_for_group("#g", alice.encrypt_for_group("#g", "team")) == "team"
+    assert not bob.unwrap_group_key("#h", "e2e:garbage", "alice")
+
+
+def test_e2e_identity_persistence(tmp_path: Any) -> None:
+    with patch('src.common.crypto_utils.IDENTITY_DIR', str(tmp_path)):
+        first = E2EManager.load("alice")
+        first.save()
+        assert E2EManager.load("alice").public_key_string() == first.public_key_string()
+
+
+def test_e2e_identity_export_and_import(tmp_path: Any) -> None:
+    desktop = E2EManager("alice")
+    with patch('src.common.crypto_utils.IDENTITY_DIR', str(tmp_path)):
+        phone = E2EManager.import_identity("alice", desktop.export_identity())
+        assert phone.public_key_string() == desktop.public_key_string()
+        assert E2EManager.load("alice").public_key_string() == desktop.public_key_string()
+
+
+def test_bulk_roundtrip_aead_and_fernet() -> None:
+    for key in (KeyRing.generate().to_bytes(), Fernet.generate_key()):
+        manager = CryptoManager(key=key)
+        texts = ["a", "", "здравей" * 50, "x" * 5000]
+        tokens = manager.encrypt_many(texts)
+        assert tokens[1] == ""
+        assert manager.decrypt_many(tokens) == texts
+        assert manager.decrypt_message(str(tokens[2])) == texts[2]
+
+
+def test_bulk_marks_errors() -> None:
+    manager = CryptoManager(key=KeyRing.generate().to_bytes())
+    good = manager.encrypt_message("ok")
+    assert manager.decrypt_many([good, "garbage", "gAAAAbad"]) == ["ok", None, None]
+
+
+def test_bulk_parallel_preserves_order() -> None:
+    manager = CryptoManager(key=KeyRing.generate().to_bytes())
+    texts = [f"msg {i}" for i in range(100)]
+    tokens = manager.encrypt_many(texts, workers=4)
+    assert manager.decrypt_many(tokens, workers=3) == texts
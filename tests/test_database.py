@@ -1,8 +1,10 @@
 import pytest
 import os
+import sqlite3
 from unittest.mock import patch
-from typing import Generator, Any
+from typing import Generator, Any, List
 from src.server.database import Database
+from src.server.message_log import MessageLog
 
 
 @pytest.fixture
@@ -22,8 +24,9 @@ def test_create_tables(db: Database) -> None:
     conn = db.get_connection()
     cursor = conn.cursor()
 
-    tables = ["users", "friends", "friend_requests", "groups",
-              "group_members", "public_rooms", "messages"]
+    tables = ["users", "friends", "friend_requests", "groups", "group_members",
+              "public_rooms", "room_members", "group_keys", "conversations", "messages",
+              "device_cursors"]
 
     for table in tables:
         cursor.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{table}'")
@@ -87,7 +90,38 @@ def test_public_rooms(db: Database) -> None:
     assert ("Room1", "fun") in rooms
 
 
+def test_room_membership(db: Database) -> None:
+    db.create_public_room("&r", "", "creator")
+    assert db.get_room_members("&r") == ["creator"]
+
+    assert db.join_room("&r", "A") is True
+    assert db.join_room("&r", "A") is True
+    assert db.join_room("&missing", "A") is False
+    assert sorted(db.get_room_members("&r")) == ["A", "creator"]
+    assert db.get_user_rooms("A") == ["&r"]
+
+    db.leave_room("&r", "A")
+    assert db.get_room_members("&r") == ["creator"]
+
+
+def test_room_members_backfilled_for_existing_rooms(db: Database) -> None:
+    conn = db.get_connection()
+    with conn:
+        conn.execute("DROP TABLE room_members")
+        conn.execute("INSERT INTO public_rooms VALUES ('&old', 'tags', 'founder')")
+    conn.close()
+
+    db.create_tables()
+    assert db.get_room_members("&old") == ["founder"]
+
+
+def register(db: Database, *names: str) -> None:
+    for name in names:
+        db.register_user(name, "p")
+
+
 def test_messages_history(db: Database) -> None:
+    register(db, "A", "B")
     db.store_message("A", "B", "encrypted_blob")
     db.store_message("B", "A", "reply_blob")
 
@@ -102,3 +136,194 @@ def test_messages_history(db: Database) -> None:
     group_hist = db.get_chat_history("A", "#Group")
     assert len(group_hist) == 1
     assert group_hist[0]["to"] == "#Group"
+
+
+def test_history_pages(db: Database) -> None:
+    register(db, "A", "B", "C")
+    ids = [db.store_message("A", "B", f"m{i}") for i in range(5)]
+    db.store_message("A", "C", "other chat")
+
+    page = db.get_chat_history("B", "A", limit=2)
+    assert [m["text"] for m in page] == ["m3", "m4"]
+    assert [m["id"] for m in page] == ids[3:]
+    older = db.get_chat_history("B", "A", limit=2, before=page[0]["id"])
+    assert [m["text"] for m in older] == ["m1", "m2"]
+    assert [m["text"] for m in db.get_chat_history("A", "B", before=ids[1])] == ["m0"]
+
+    conn = db.get_connection()
+    plan = conn.execute("EXPLAIN QUERY PLAN SELECT id FROM messages WHERE conversation_id = 1 "
+                        "AND id < 5 ORDER BY id DESC LIMIT 2").fetchall()
+    conn.close()
+    assert "idx_messages_conversation" in str(plan)
+
+
+def test_messages_to_unknown_users_are_not_stored(db: Database) -> None:
+    register(db, "A")
+    assert db.store_message("A", "ghost", "x") == 0
+    assert db.store_message("ghost", "A", "x") == 0
+    assert db.get_chat_history("A", "ghost") == []
+    assert db.store_message("A", "#anything", "x") > 0
+
+
+def test_store_message_writes_conversation_once(db: Database) -> None:
+    register(db, "A", "B")
+    # An unknown sender leaves no conversation behind.
+    assert db.store_message("ghost", "#new", "x") == 0
+    assert db.store_message("A", "B", "first") > 0
+
+    statements: List[str] = []
+    connect = db.get_connection
+
+    def traced() -> sqlite3.Connection:
+        conn = connect()
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    with patch.object(db, "get_connection", traced):
+        assert db.store_message("B", "A", "second") > 0
+    inserts = [s for s in statements if s.startswith("INSERT")]
+    assert len(inserts) == 1 and inserts[0].startswith("INSERT INTO messages")
+
+    conn = db.get_connection()
+    names = conn.execute("SELECT name FROM conversations").fetchall()
+    conn.close()
+    assert names == [(None,)]
+
+
+def test_device_cursors_and_missed_messages(db: Database) -> None:
+    assert db.get_last_message_id() == 0
+    register(db, "A", "B", "C", "D")
+    db.create_group("#g", "A")
+    first = db.store_message("B", "A", "dm")
+    db.store_message("C", "D", "other dm")
+    db.store_message("A", "#g", "own group msg")
+    db.store_message("B", "&room", "room msg")
+    last = db.store_message("A", "C", "sent from another device")
+    assert db.get_last_message_id() == last
+
+    assert db.get_device_cursor("A", "laptop") is None
+    db.set_device_cursor("A", "laptop", first - 1)
+    assert db.get_device_cursor("A", "laptop") == first - 1
+
+    missed = db.get_messages_since("A", first - 1, last)
+    assert [m["text"] for m in missed] == ["dm", "own group msg", "sent from another device"]
+    assert db.get_messages_since("A", first, last - 1) == [
+        {"sender": "A", "to": "#g", "text": "own group msg"}]
+
+
+def test_public_keys(db: Database) -> None:
+    db.register_user("A", "p")
+    assert db.get_public_key("A") is None
+    db.set_public_key("A", "pk")
+    assert db.get_public_key("A") == "pk"
+    assert db.get_public_key("missing") is None
+
+
+def test_group_keys(db: Database) -> None:
+    assert db.get_group_key("#g", "A") is None
+    db.store_group_key("#g", "A", "wrapped1", "B")
+    db.store_group_key("#g", "A", "wrapped2", "C")
+    assert db.get_group_key("#g", "A") == ("wrapped2", "C")
+
+
+def test_migrates_username_keyed_messages(tmp_path: Any) -> None:
+    db_file = str(tmp_path / "old.sqlite")
+    conn = sqlite3.connect(db_file)
+    with conn:
+        conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                     "username TEXT UNIQUE NOT NULL, password_hash TEXT NOT NULL)")
+        conn.execute("CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                     "sender TEXT NOT NULL, receiver TEXT NOT NULL, content TEXT NOT NULL, "
+                     "timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)")
+        conn.executemany("INSERT INTO users (username, password_hash) VALUES (?, 'h')",
+                         [("A",), ("B",)])
+        conn.executemany("INSERT INTO messages (id, sender, receiver, content) VALUES (?, ?, ?, ?)",
+                         [(3, "A", "B", "hi"), (5, "B", "A", "hey"), (6, "A", "#g", "group"),
+                          (7, "ghost", "A", "lost"), (9, "B", "&r", "room")])
+    conn.close()
+
+    with patch('src.server.database.DB_PATH', db_file):
+        db = Database()
+        assert db.get_chat_history("B", "A") == [
+            {"id": 3, "sender": "A", "to": "B", "text": "hi"},
+            {"id": 5, "sender": "B", "to": "A", "text": "hey"}]
+        assert [m["id"] for m in db.get_chat_history("A", "#g")] == [6]
+        assert [m["id"] for m in db.get_chat_history("A", "&r")] == [9]
+        # Ids keep growing from the old sequence.
+        assert db.store_message("A", "B", "new") == 10
+
+        conn = db.get_connection()
+        left = conn.execute("SELECT id, sender FROM messages_v1").fetchall()
+        conn.close()
+        assert left == [(7, "ghost")]
+        # Opening the migrated database again changes nothing.
+        Database()
+        assert len(db.get_chat_history("A", "B")) == 3
+
+
+def test_archives_old_messages_by_month(db: Database, tmp_path: Any) -> None:
+    register(db, "A", "B")
+    db.create_group("#g", "A")
+    ids = [db.store_message("A", "B", f"m{i}") for i in range(5)]
+    group_msg = db.store_message("A", "#g", "old group msg")
+    conn = db.get_connection()
+    with conn:
+        conn.executemany("UPDATE messages SET timestamp = ? WHERE id = ?", [
+            ("2024-01-15 10:00:00", ids[0]), ("2024-01-20 10:00:00", ids[1]),
+            ("2024-02-10 10:00:00", ids[2]), ("2024-01-01 09:00:00", group_msg)])
+    conn.close()
+    # The group message is old but has a higher id than recent ones: archiving stops
+    # at the first recent id, so it stays in the hot database.
+    assert db.archive_messages(30) == 3
+    assert db.archive_messages(30) == 0
+    assert sorted(os.listdir(tmp_path / "archive")) == ["messages-2024-01.db",
+                                                        "messages-2024-02.db"]
+    assert db.get_last_message_id() == group_msg
+
+    # The latest page comes from the hot database alone.
+    with patch.object(db, "archive_path", side_effect=AssertionError("archive read")):
+        assert [m["text"] for m in db.get_chat_history("A", "B", limit=2)] == ["m3", "m4"]
+
+    assert [m["id"] for m in db.get_chat_history("B", "A")] == ids
+    page = db.get_chat_history("B", "A", limit=2, before=ids[3])
+    assert page == [{"id": ids[1], "sender": "A", "to": "B", "text": "m1"},
+                    {"id": ids[2], "sender": "A", "to": "B", "text": "m2"}]
+    assert [m["text"] for m in db.get_messages_since("B", 0, ids[2])] == ["m0", "m1", "m2"]
+
+    # A missing archive file is skipped rather than failing the request.
+    os.remove(tmp_path / "archive" / "messages-2024-02.db")
+    assert [m["text"] for m in db.get_chat_history("A", "B", limit=4)] == ["m0", "m1", "m3", "m4"]
+
+
+def test_archiving_everything_keeps_the_id_sequence(db: Database) -> None:
+    register(db, "A", "B")
+    last = db.store_message("A", "B", "old")
+    conn = db.get_connection()
+    with conn:
+        conn.execute("UPDATE messages SET timestamp = '2020-05-05 00:00:00'")
+    conn.close()
+    assert db.archive_messages(1) == 1
+    assert db.get_last_message_id() == last
+    assert db.store_message("B", "A", "new") == last + 1
+    assert [m["text"] for m in db.get_chat_history("A", "B")] == ["old", "new"]
+
+
+def test_message_log_engine(db: Database, tmp_path: Any) -> None:
+    register(db, "A", "B")
+    db.create_group("#g", "B")
+    first = db.store_message("A", "B", "in sqlite")
+
+    logged = Database(MessageLog(str(tmp_path / "log")))
+    assert logged.get_last_message_id() == first
+    assert logged.store_message("A", "ghost", "x") == 0
+    ids = [logged.store_message("A", "B", "m1"), logged.store_message("B", "#g", "m2")]
+    assert ids == [first + 1, first + 2]
+    assert logged.get_last_message_id() == first + 2
+
+    assert logged.get_chat_history("B", "A") == [{"id": ids[0], "sender": "A", "to": "B", "text": "m1"}]
+    assert [m["text"] for m in logged.get_messages_since("B", first, ids[1])] == ["m1", "m2"]
+    assert logged.archive_messages(0) == 0
+    # The SQLite messages table is left alone.
+    assert [m["text"] for m in db.get_chat_history("A", "B")] == ["in sqlite"]
+    assert logged.message_log is not None
+    logged.message_log.close()
@@ -0,0 +1,68 @@
+from unittest.mock import Mock
+from src.client.dispatcher import UIDispatcher
+
+
+def make_dispatcher() -> UIDispatcher:
+    return UIDispatcher(Mock(), Mock(), Mock(), Mock(), interval_ms=10)
+
+
+def test_start_schedules_tick() -> None:
+    d = make_dispatcher()
+    d.start()
+    d.start()
+    schedule = d._schedule
+    assert isinstance(schedule, Mock)
+    schedule.assert_called_once_with(10, d._tick)
+
+
+def test_messages_coalesced_per_conversation() -> None:
+    d = make_dispatcher()
+    d.post_message("u1", "[u1]: a\n")
+    d.post_message("#g", "[u2]: b\n")
+    d.post_message("u1", "[u1]: c\n")
+
+    d.drain()
+
+    on_lines = d._on_lines
+    assert isinstance(on_lines, Mock)
+    assert on_lines.call_count == 2
+    on_lines.assert_any_call("u1", "[u1]: a\n[u1]: c\n")
+    on_lines.assert_any_call("#g", "[u2]: b\n")
+
+
+def test_data_updates_collapse_to_latest() -> None:
+    d = make_dispatcher()
+    d.post_data(["old"], [], [], [], [])
+    d.post_data(["new"], [], [], [], [])
+
+    d.drain()
+
+    on_data = d._on_data
+    assert isinstance(on_data, Mock)
+    on_data.assert_called_once_with(["new"], [], [], [], [])
+
+
+def test_history_flushes_earlier_lines_first() -> None:
+    calls = []
+    d = UIDispatcher(Mock(), lambda c, t: calls.append(("lines", c)),
+                     Mock(), lambda t, m: calls.append(("history", t)))
+    d.post_message("u1", "x\n")
+    d.post_history("u1", [])
+    d.post_message("u1", "y\n")
+
+    d.drain()
+
+    assert calls == [("lines", "u1"), ("history", "u1"), ("lines", "u1")]
+
+
+def test_tick_rearms_until_stopped() -> None:
+    d = make_dispatcher()
+    d.running = True
+    d._tick()
+    schedule = d._schedule
+    assert isinstance(schedule, Mock)
+    assert schedule.call_count == 1
+
+    d.stop()
+    d._tick()
+    assert schedule.call_count == 1
@@ -1,7 +1,8 @@
 import pytest
 from unittest.mock import Mock, patch
-from typing import Any, Generator
+from typing import Any, Dict, Generator, List
 from src.client.gui import MessengerApp
+from src.client.network import HISTORY_PAGE_SIZE
 
 
 @pytest.fixture
@@ -100,13 +101,34 @@ def test_select_chat(app: Any) -> None:
     app.select_chat("user1")
     app.chat_header.configure.assert_called()
     app.chat_box.insert.assert_called_with("end", "history...")
-    app.client.get_chat_history.assert_called_with("user1")
+    app.client.get_chat_history.assert_called_with("user1", HISTORY_PAGE_SIZE)
+
+
+def test_older_history_pages_are_prepended(app: Any) -> None:
+    def page(first: int, last: int) -> List[Dict[str, Any]]:
+        return [{"id": i, "sender": "u1", "text": f"m{i}"} for i in range(first, last)]
+
+    app.select_chat("u1")
+    app.load_older_history()
+    app.client.get_chat_history.assert_called_once()
+
+    app.on_history_loaded("u1", page(100, 100 + HISTORY_PAGE_SIZE))
+    app.append_msg("u1", "[u1]: live\n")
+    app.load_older_history()
+    app.client.get_chat_history.assert_called_with("u1", HISTORY_PAGE_SIZE, 100)
+
+    app.on_history_loaded("u1", page(90, 100))
+    assert app.chat_history["u1"].startswith("[u1]: m90\n")
+    assert app.chat_history["u1"].endswith("[u1]: m149\n[u1]: live\n")
+    # A short page is the start of the conversation.
+    app.load_older_history()
+    assert app.client.get_chat_history.call_count == 2
 
 
 def test_incoming_message(app: Any) -> None:
     data = {"sender": "u1", "to": "me", "text": "hi"}
     app.client.username = "me"
-    app.on_message(data)
+    app.append_msg(*app.format_message(data))
     assert "u1" in app.chat_history
     assert "[u1]: hi" in app.chat_history["u1"]
 
@@ -117,12 +139,94 @@ def test_update_data_ui(app: Any) -> None:
     reqs = ["r1"]
     active = ["u2"]
     pub = [("room", "tag")]
-
-    mock_child = Mock()
-    app.my_chats_scroll.winfo_children.return_value = [mock_child]
     app.tag_search.get.return_value = ""
 
     app.update_data(friends, groups, reqs, active, pub)
 
-    mock_child.destroy.assert_called()
-    assert True
+    assert ("friend", "f1") in app.chat_rows.widgets
+    assert ("request", "r1") in app.chat_rows.widgets
+    assert ("user", "u2") in app.online_rows.widgets
+    assert ("room", "room") in app.public_rows.widgets
+
+
+def test_update_data_reuses_rows(app: Any) -> None:
+    app.update_data(["f1", "f2"], [], [], ["u1"], [])
+    f1 = app.chat_rows.widgets[("friend", "f1")]
+    f2 = app.chat_rows.widgets[("friend", "f2")]
+
+    app.update_data(["f1"], [], [], ["u1"], [])
+    assert app.chat_rows.widgets[("friend", "f1")] is f1
+    assert ("friend", "f2") not in app.chat_rows.widgets
+    f2.destroy.assert_not_called()
+
+
+def test_update_data_prefetches_new_chats(app: Any) -> None:
+    app.chat_history["f1"] = "cached\n"
+    app.update_data(["f1", "f2"], ["#g"], [], [], [])
+    app.client.prefetch_histories.assert_called_once_with(["#g", "f2"])
+
+    app.update_data(["f1", "f2"], ["#g"], [], [], [])
+    app.client.prefetch_histories.assert_called_once()
+
+
+def test_opening_room_joins_once(app: Any) -> None:
+    app.select_chat("&lobby")
+    app.select_chat("&lobby")
+    app.select_chat("friend")
+    app.client.join_room.assert_called_once_with("&lobby")
+
+
+def test_filter_public_rooms(app: Any) -> None:
+    app.set_public_rooms([("&a", "python"), ("&b", "music")])
+    app.tag_search.get.return_value = "PY"
+    app.filter_public_rooms()
+    assert list(app.public_rows.widgets) == [("room", "&a")]
+
+
+def test_filter_is_debounced(app: Any) -> None:
+    app.after = Mock(side_effect=["job1", "job2"])
+    app.after_cancel = Mock()
+    app.schedule_filter()
+    app.schedule_filter()
+    app.after_cancel.assert_called_once_with("job1")
+    assert app._filter_job == "job2"
+
+
+def test_filter_renders_incrementally(app: Any) -> None:
+    app.after = Mock()
+    app.set_public_rooms([(f"&r{i}", "tag") for i in range(120)])
+    assert len(app.public_rows.widgets) == 50
+
+    _, step = app.after.call_args[0]
+    step()
+    assert len(app.public_rows.widgets) == 100
+
+
+def test_network_messages_go_through_dispatcher(app: Any) -> None:
+    app.client.username = "me"
+    app.queue_message({"sender": "u1", "to": "me", "text": "hi"})
+    assert "u1" not in app.chat_history
+
+    app.dispatcher.drain()
+    assert app.chat_history["u1"] == "[u1]: hi\n"
+
+
+def test_refused_message_is_marked_not_sent(app: Any) -> None:
+    app.queue_error({"action": "msg", "to": "friend", "text": "x"},
+                    {"action": "error", "reason": "rate_limited", "msg": "Too many msg requests"})
+    app.dispatcher.drain()
+    assert app.chat_history["friend"] == "[not sent: Too many msg requests]\n"
+
+
+def test_send_asks_before_trusting_a_changed_key(app: Any) -> None:
+    app.current_chat_target = "friend"
+    app.msg_entry.get.return_value = "Hello"
+    app.client.untrusted_peers = {"friend": "new-key"}
+    with patch('src.client.gui.messagebox.askyesno', return_value=False):
+        app.send_msg()
+    app.client.send_message.assert_not_called()
+
+    with patch('src.client.gui.messagebox.askyesno', return_value=True):
+        app.send_msg()
+    app.client.trust_peer_key.assert_called_once_with("friend")
+    app.client.send_message.assert_called_with("friend", "Hello")
@@ -0,0 +1,60 @@
+import contextvars
+import functools
+import queue
+import threading
+import pytest
+from src.server.lanes import LaneExecutor, conversation_key
+
+
+def test_conversation_keys() -> None:
+    assert conversation_key("bob", {"action": "msg", "to": "alice"}) == ("alice", "bob")
+    assert conversation_key("alice", {"action": "get_history", "target": "bob"}) == ("alice", "bob")
+    assert conversation_key("bob", {"action": "handle_request", "sender": "alice"}) == ("alice", "bob")
+    assert conversation_key("bob", {"action": "msg", "to": "#team"}) == "#team"
+    assert conversation_key("bob", {"action": "share_group_key", "group_name": "#team"}) == "#team"
+    assert conversation_key("bob", {"action": "join_room", "room_name": "lobby"}) == "&lobby"
+    assert conversation_key("bob", {"action": "get_data"}) == "bob"
+
+
+def test_same_key_runs_in_order_and_keeps_context() -> None:
+    lane = LaneExecutor("test", workers=4, queue_size=100)
+    var: contextvars.ContextVar[str] = contextvars.ContextVar("var", default="")
+    var.set("request-context")
+    seen = []
+    futures = [lane.submit("conv", functools.partial(lambda i: seen.append((i, var.get())), i))
+               for i in range(50)]
+    for f in futures:
+        f.result(2)
+    lane.shutdown()
+    assert seen == [(i, "request-context") for i in range(50)]
+
+
+def test_slow_key_does_not_block_other_workers() -> None:
+    lane = LaneExecutor("test", workers=2, queue_size=10)
+    release = threading.Event()
+    # Small ints hash to themselves, so these land on different workers.
+    slow = lane.submit(0, lambda: release.wait(2))
+    fast = lane.submit(1, lambda: "done")
+    assert fast.result(1) == "done"
+    assert not slow.done()
+    release.set()
+    assert slow.result(2) is True
+    lane.shutdown()
+
+
+def test_full_queue_and_errors() -> None:
+    lane = LaneExecutor("test", workers=1, queue_size=1)
+    release = threading.Event()
+    queued = [lane.submit("k", lambda: release.wait(2))]
+    # The worker may not have taken the first task yet; fill until the queue rejects.
+    with pytest.raises(queue.Full):
+        for _ in range(3):
+            queued.append(lane.submit("k", lambda: None))
+    release.set()
+    for f in queued:
+        f.result(2)
+
+    failing = lane.submit("k", lambda: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        failing.result(2)
+    lane.shutdown()
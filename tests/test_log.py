@@ -0,0 +1,86 @@
+import io
+import json
+import logging
+import threading
+from typing import Generator, List, Dict, Any
+import pytest
+from src.common.log import (
+    get_logger, log_context, bind_context, setup_logging, shutdown_logging, RateLimitFilter
+)
+
+
+@pytest.fixture
+def stream() -> Generator[io.StringIO, None, None]:
+    out = io.StringIO()
+    setup_logging(stream=out, burst=3, window=60.0, sample_every=10)
+    yield out
+    shutdown_logging()
+
+
+def records(out: io.StringIO) -> List[Dict[str, Any]]:
+    shutdown_logging()  # stops the listener, flushing the queue
+    return [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+def test_json_records_carry_context(stream: io.StringIO) -> None:
+    log = get_logger("test")
+    with log_context(user="alice", action="msg", request_id="1.1"):
+        log.warning("failed for %s", "bob")
+    log.info("outside")
+
+    first, second = records(stream)
+    assert first["msg"] == "failed for bob"
+    assert first["level"] == "WARNING"
+    assert first["logger"] == "secure_messenger.test"
+    assert (first["user"], first["action"], first["request_id"]) == ("alice", "msg", "1.1")
+    assert "user" not in second
+
+
+def test_context_is_per_thread(stream: io.StringIO) -> None:
+    log = get_logger("test")
+
+    def worker() -> None:
+        bind_context(user="thread-user")
+        log.info("from worker")
+
+    with log_context(user="main-user"):
+        t = threading.Thread(target=worker)
+        t.start()
+        t.join()
+        log.info("from main")
+
+    users = {r["msg"]: r["user"] for r in records(stream)}
+    assert users == {"from worker": "thread-user", "from main": "main-user"}
+
+
+def test_exception_is_separate_field(stream: io.StringIO) -> None:
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        get_logger("test").error("handler crashed", exc_info=True)
+
+    (rec,) = records(stream)
+    assert rec["msg"] == "handler crashed"
+    assert "ValueError: boom" in rec["exc"]
+
+
+def test_repeated_messages_are_limited_and_sampled(stream: io.StringIO) -> None:
+    log = get_logger("test")
+    for i in range(23):
+        log.error("send failed: %s", i)
+    log.error("different message")
+
+    out = records(stream)
+    msgs = [r["msg"] for r in out]
+    # 3 in the burst, then every 10th occurrence after it (13th and 23rd).
+    assert msgs == ["send failed: 0", "send failed: 1", "send failed: 2",
+                    "send failed: 12", "send failed: 22", "different message"]
+    assert out[3]["suppressed"] == 9
+    assert out[4]["suppressed"] == 9
+
+
+def test_rate_limit_window_resets() -> None:
+    f = RateLimitFilter(burst=1, window=0.0, sample_every=0)
+    rec = logging.LogRecord("x", logging.ERROR, __file__, 1, "same", None, None)
+    assert f.filter(rec)
+    assert f.filter(rec)  # zero-length window: every record starts a new one
@@ -0,0 +1,124 @@
+import os
+from typing import Any
+from src.server.message_log import MessageLog, MANIFEST
+
+
+def texts(messages: Any) -> Any:
+    return [m["text"] for m in messages]
+
+
+def test_append_and_history_pages(tmp_path: Any) -> None:
+    log = MessageLog(str(tmp_path))
+    ids = [log.append("a", "b", "m0"), log.append("b", "a", "m1"), log.append("a", "c", "other"),
+           log.append("a", "#g", "group"), log.append("b", "a", "m2")]
+    assert ids == [1, 2, 3, 4, 5]
+
+    assert log.history("b", "a") == [
+        {"id": 1, "sender": "a", "to": "b", "text": "m0"},
+        {"id": 2, "sender": "b", "to": "a", "text": "m1"},
+        {"id": 5, "sender": "b", "to": "a", "text": "m2"}]
+    assert texts(log.history("a", "b", limit=2)) == ["m1", "m2"]
+    assert texts(log.history("a", "b", limit=2, before=5)) == ["m0", "m1"]
+    assert texts(log.history("x", "#g")) == ["group"]
+    assert log.history("a", "nobody") == []
+    log.close()
+
+
+def test_messages_since_matches_database_rules(tmp_path: Any) -> None:
+    log = MessageLog(str(tmp_path))
+    log.append("b", "a", "dm")
+    log.append("c", "d", "other dm")
+    log.append("c", "#g", "group msg")
+    log.append("b", "&room", "room msg")
+    log.append("a", "c", "sent from another device")
+    assert texts(log.messages_since("a", {"#g"}, 0, 5)) == [
+        "dm", "group msg", "sent from another device"]
+    assert texts(log.messages_since("a", set(), 1, 4)) == []
+    log.close()
+
+
+def test_reopen_recovers_index_and_ids(tmp_path: Any) -> None:
+    log = MessageLog(str(tmp_path), segment_size=64)
+    for i in range(10):
+        log.append("a", "b", f"m{i}")
+    log.close()
+    assert len([n for n in os.listdir(tmp_path) if n.endswith(".log")]) > 1
+
+    log = MessageLog(str(tmp_path), segment_size=64)
+    assert log.last_id == 10 and len(log) == 10
+    assert texts(log.history("a", "b", limit=3)) == ["m7", "m8", "m9"]
+    assert log.append("b", "a", "after restart") == 11
+    assert texts(log.history("a", "b", limit=1)) == ["after restart"]
+    log.close()
+
+
+def test_torn_tail_is_truncated(tmp_path: Any) -> None:
+    log = MessageLog(str(tmp_path))
+    log.append("a", "b", "kept")
+    log.append("a", "b", "torn")
+    log.close()
+    segment = os.path.join(tmp_path, sorted(n for n in os.listdir(tmp_path) if n != MANIFEST)[0])
+    size = os.path.getsize(segment)
+    os.truncate(segment, size - 3)
+
+    log = MessageLog(str(tmp_path))
+    assert texts(log.history("a", "b")) == ["kept"]
+    assert log.append("a", "b", "next") == 2
+    log.close()
+
+    # A flipped byte fails the checksum the same way.
+    with open(segment, "r+b") as f:
+        f.seek(os.path.getsize(segment) - 1)
+        f.write(b"X")
+    log = MessageLog(str(tmp_path))
+    assert texts(log.history("a", "b")) == ["kept"]
+    log.close()
+
+
+def test_compaction_clusters_conversations(tmp_path: Any) -> None:
+    log = MessageLog(str(tmp_path), segment_size=128)
+    for i in range(12):
+        log.append("a", "b" if i % 2 else "c", f"m{i}")
+    before = {k: log.history("a", k) for k in ("b", "c")}
+    sealed = sorted(n for n in os.listdir(tmp_path) if n.endswith(".log"))[:-1]
+
+    moved = log.compact()
+    assert moved > 0
+    assert log.compact() == 0
+    assert {k: log.history("a", k) for k in ("b", "c")} == before
+    assert not any(os.path.exists(os.path.join(tmp_path, n)) for n in sealed)
+    compacted = [n for n in os.listdir(tmp_path) if n.endswith(".compact")]
+    assert compacted
+
+    log.append("b", "a", "new")
+    log.close()
+    log = MessageLog(str(tmp_path), segment_size=128)
+    assert texts(log.history("a", "b")) == texts(before["b"]) + ["new"]
+    assert log.last_id == 13
+    log.close()
+
+
+def test_orphaned_segments_are_removed(tmp_path: Any) -> None:
+    log = MessageLog(str(tmp_path))
+    log.append("a", "b", "m")
+    log.close()
+    # A compaction that crashed before writing the manifest leaves its output behind.
+    with open(os.path.join(tmp_path, "00000099.compact"), "wb") as f:
+        f.write(b"partial")
+
+    with open(os.path.join(tmp_path, "MANIFEST.tmp"), "w", encoding="utf-8") as f:
+        f.write("{")
+    # Files the log did not write are not its to delete.
+    for other in ("notes.txt", "00000099.log.bak", "backup"):
+        with open(os.path.join(tmp_path, other), "w", encoding="utf-8") as f:
+            f.write("keep")
+
+    log = MessageLog(str(tmp_path))
+    assert not os.path.exists(os.path.join(tmp_path, "00000099.compact"))
+    assert not os.path.exists(os.path.join(tmp_path, "MANIFEST.tmp"))
+    for other in ("notes.txt", "00000099.log.bak", "backup"):
+        assert os.path.exists(os.path.join(tmp_path, other))
+    assert texts(log.history("a", "b")) == ["m"]
+    log.advance_to(41)
+    assert log.append("a", "b", "n") == 42
+    log.close()
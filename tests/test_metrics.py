@@ -0,0 +1,88 @@
+import urllib.request
+from unittest.mock import Mock
+from src.server.metrics import Metrics, TimedProxy, start_metrics_server
+
+
+def test_counter_and_labels() -> None:
+    m = Metrics()
+    m.inc("requests_total", {"action": "msg"}, doc="Requests")
+    m.inc("requests_total", {"action": "msg"})
+    m.inc("requests_total", {"action": 'we"ird'})
+    text = m.render()
+    assert "# HELP requests_total Requests" in text
+    assert "# TYPE requests_total counter" in text
+    assert 'requests_total{action="msg"} 2.0' in text
+    assert 'requests_total{action="we\\"ird"} 1.0' in text
+
+
+def test_histogram_buckets_are_cumulative() -> None:
+    m = Metrics()
+    for v in (1, 3, 3, 100):
+        m.observe("fanout", v, buckets=(1, 5, 10))
+    text = m.render()
+    assert 'fanout_bucket{le="1.0"} 1' in text
+    assert 'fanout_bucket{le="5.0"} 3' in text
+    assert 'fanout_bucket{le="10.0"} 3' in text
+    assert 'fanout_bucket{le="+Inf"} 4' in text
+    assert "fanout_sum 107.0" in text
+    assert "fanout_count 4" in text
+
+
+def test_gauge_read_at_render() -> None:
+    m = Metrics()
+    clients = {"a": 1}
+    m.gauge("connected", lambda: len(clients))
+    assert "connected 1.0" in m.render()
+    clients["b"] = 2
+    assert "connected 2.0" in m.render()
+
+
+def test_timer_records() -> None:
+    m = Metrics()
+    with m.timer("latency", {"action": "x"}):
+        pass
+    assert m.histograms[("latency", (("action", "x"),))].count == 1
+
+
+def test_timed_proxy() -> None:
+    m = Metrics()
+    target = Mock()
+    target.get_friends_list.return_value = ["a"]
+    target.name = "db"
+    proxy = TimedProxy(target, m, "db_seconds")
+
+    assert proxy.get_friends_list("u") == ["a"]
+    target.get_friends_list.assert_called_with("u")
+    assert m.histograms[("db_seconds", (("method", "get_friends_list"),))].count == 1
+
+
+def test_http_endpoint() -> None:
+    m = Metrics()
+    m.inc("hits_total")
+    httpd = start_metrics_server(m, port=0)
+    try:
+        port = httpd.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as resp:
+            assert "hits_total 1.0" in resp.read().decode()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def test_http_extra_route() -> None:
+    calls = []
+
+    def route(params: dict) -> tuple:
+        calls.append(params)
+        return 202, "ok\n"
+
+    httpd = start_metrics_server(Metrics(), port=0, routes={"/profile": route})
+    try:
+        port = httpd.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/profile?seconds=3") as resp:
+            assert resp.status == 202
+            assert resp.read() == b"ok\n"
+        assert calls == [{"seconds": "3"}]
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
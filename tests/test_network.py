@@ -1,8 +1,20 @@
+import socket
+import threading
+import time
 import pytest
-from unittest.mock import Mock, patch
-from typing import cast
+from unittest.mock import ANY, Mock, patch
+from typing import Any, Generator, cast
 from cryptography.fernet import Fernet
-from src.client.network import NetworkClient
+from src.client.network import NetworkClient, HISTORY_PAGE_SIZE
+from src.client.key_state import load_device_id
+from src.common.crypto_utils import E2EManager
+from src.common.protocol import receive_json
+
+
+@pytest.fixture(autouse=True)
+def identity_dir(tmp_path: Any) -> Generator[None, None, None]:
+    with patch('src.common.crypto_utils.IDENTITY_DIR', str(tmp_path)):
+        yield
 
 
 @pytest.fixture
@@ -10,6 +22,15 @@ def client() -> NetworkClient:
     return NetworkClient(Mock(), Mock(), Mock())
 
 
+def make_e2e_client(name: str) -> NetworkClient:
+    c = NetworkClient(Mock(), Mock(), Mock())
+    c.running = True
+    c.sock = Mock()
+    c.username = name
+    c.e2e = E2EManager(name)
+    return c
+
+
 def test_connect_success(client: NetworkClient) -> None:
     """Test connection and login flow."""
     valid_key = Fernet.generate_key().decode('utf-8')
@@ -18,12 +39,11 @@ def test_connect_success(client: NetworkClient) -> None:
         mock_sock = Mock()
         mock_sock_cls.return_value = mock_sock
 
-        response = {"status": "success", "msg": "OK", "key": valid_key}
+        response = {"status": "success", "msg": "OK", "key": valid_key, "id": 1}
 
-        with patch('src.client.network.receive_json', return_value=response):
+        with patch('src.client.network.receive_json', side_effect=[response, None]):
             with patch('src.client.network.send_json'):
-                with patch('threading.Thread'):
-                    success, msg = client.connect("user", "pass")
+                success, msg = client.connect("user", "pass")
 
         assert success is True
         assert client.crypto is not None
@@ -32,13 +52,30 @@ def test_connect_success(client: NetworkClient) -> None:
 
 def test_connect_fail(client: NetworkClient) -> None:
     with patch('socket.socket'):
-        response = {"status": "error", "msg": "Fail"}
-        with patch('src.client.network.receive_json', return_value=response):
+        response = {"status": "error", "msg": "Fail", "id": 1}
+        with patch('src.client.network.receive_json', side_effect=[response, None]):
             with patch('src.client.network.send_json'):
                 success, msg = client.connect("user", "pass")
 
         assert success is False
         assert msg == "Fail"
+        assert client.running is False
+
+
+def test_connect_ignores_unrelated_frames(client: NetworkClient) -> None:
+    """A push that arrives before the login reply is not mistaken for it."""
+    incoming = [{"action": "data_update", "friends": ["x"]},
+                {"status": "error", "msg": "Fail", "id": 1}, None]
+    with patch('socket.socket'), patch('src.client.network.send_json'), \
+            patch('src.client.network.receive_json', side_effect=incoming):
+        assert client.connect("user", "pass") == (False, "Fail")
+    cast(Mock, client.on_data).assert_called_once()
+
+
+def test_connect_connection_closed(client: NetworkClient) -> None:
+    with patch('socket.socket'), patch('src.client.network.send_json'), \
+            patch('src.client.network.receive_json', return_value=None):
+        assert client.connect("user", "pass") == (False, "Connection closed")
 
 
 def test_send_methods(client: NetworkClient) -> None:
@@ -50,15 +87,22 @@ def test_send_methods(client: NetworkClient) -> None:
 
     with patch('src.client.network.send_json') as mock_send:
         client.send_message("u2", "hi")
-        mock_send.assert_called_with(client.sock, {"action": "msg", "to": "u2", "text": "enc"})
+        mock_send.assert_called_with(client.sock, {"action": "msg", "to": "u2", "text": "enc", "id": ANY})
 
         client.create_group(" g1 ")
-        mock_send.assert_called_with(client.sock, {"action": "create_group", "group_name": "#g1"})
+        mock_send.assert_called_with(
+            client.sock, {"action": "create_group", "group_name": "#g1", "id": ANY})
 
         client.create_public_room(" pub ", "tag")
         mock_send.assert_called_with(
             client.sock, {"action": "create_public_room", "room_name": "&pub", "tags": "tag"})
 
+        client.join_room("pub")
+        mock_send.assert_called_with(client.sock, {"action": "join_room", "room_name": "&pub"})
+
+        client.leave_room("&pub")
+        mock_send.assert_called_with(client.sock, {"action": "leave_room", "room_name": "&pub"})
+
 
 def test_listen_loop(client: NetworkClient) -> None:
     """Test the receiving loop."""
@@ -66,6 +110,7 @@ def test_listen_loop(client: NetworkClient) -> None:
     client.sock = Mock()
     client.crypto = Mock()
     client.crypto.decrypt_message.return_value = "decrypted"
+    client.crypto.decrypt_many.return_value = ["decrypted"]
 
     incoming = [
         {"action": "msg", "sender": "u2", "text": "enc"},
@@ -79,4 +124,245 @@ def test_listen_loop(client: NetworkClient) -> None:
 
         cast(Mock, client.on_msg).assert_called()
         cast(Mock, client.on_data).assert_called()
-        cast(Mock, client.on_history).assert_called()
+        cast(Mock, client.on_history).assert_called_with("u2", [{"text": "decrypted"}])
+
+
+def test_connect_sends_and_saves_identity(client: NetworkClient) -> None:
+    response = {"status": "success", "msg": "OK", "key": Fernet.generate_key().decode(), "id": 1}
+    with patch('socket.socket'), \
+            patch('src.client.network.receive_json', side_effect=[response, None]), \
+            patch('src.client.network.send_json') as mock_send:
+        client.connect("alice", "pass")
+
+    login = mock_send.call_args_list[0][0][1]
+    assert login["id"] == 1
+    assert client.e2e is not None
+    assert login["public_key"] == client.e2e.public_key_string()
+    assert E2EManager.load("alice").public_key_string() == login["public_key"]
+    assert login["device"] and login["device"] == load_device_id("alice")
+
+
+def test_pipelined_requests_resolve_by_id(client: NetworkClient) -> None:
+    client.running = True
+    client.sock = Mock()
+    client.crypto = Mock()
+    client.crypto.decrypt_many.side_effect = lambda items: [f"plain-{t}" for t in items]
+
+    with patch('src.client.network.send_json') as mock_send:
+        futures = client.prefetch_histories(["a", "b", "c"])
+    ids = {call[0][1]["target"]: call[0][1]["id"] for call in mock_send.call_args_list}
+    assert len(set(ids.values())) == 3
+    assert all(call[0][1]["limit"] == HISTORY_PAGE_SIZE for call in mock_send.call_args_list)
+
+    # Responses arrive out of order.
+    for target in ("c", "a", "b"):
+        client._dispatch({"action": "history_response", "target": target, "id": ids[target],
+                          "messages": [{"sender": target, "to": "me", "text": target}]})
+
+    for target, fut in futures.items():
+        frame = fut.result(0)
+        assert frame["target"] == target
+        assert frame["messages"][0]["text"] == f"plain-{target}"
+    assert cast(Mock, client.on_history).call_count == 3
+
+
+def test_in_flight_requests_fail_on_disconnect(client: NetworkClient) -> None:
+    client.running = True
+    client.sock = Mock()
+    with patch('src.client.network.send_json'):
+        fut = client.request({"action": "get_public_key", "target": "bob"})
+    with patch('src.client.network.receive_json', return_value=None):
+        client.listen()
+    with pytest.raises(ConnectionError):
+        fut.result(0)
+
+
+def test_refused_request_resolves_and_reports_error(client: NetworkClient) -> None:
+    client.running = True
+    client.sock = Mock()
+    client.crypto = Mock()
+    client.crypto.encrypt_message.return_value = "enc"
+    client.on_error = Mock()
+    with patch('src.client.network.send_json') as mock_send:
+        client.send_message("&room", "hi")
+    sent = mock_send.call_args[0][1]
+    error = {"action": "error", "reason": "rate_limited", "msg": "Too many msg requests",
+             "retry_after": 1.5, "id": sent["id"]}
+    fut = client._in_flight[sent["id"]]
+
+    client._dispatch(error)
+
+    assert fut.result(0) == error
+    client.on_error.assert_called_once_with({"action": "msg", "to": "&room", "text": "enc"}, error)
+    client._dispatch({"action": "error", "reason": "overloaded"})
+    client.on_error.assert_called_with({}, {"action": "error", "reason": "overloaded"})
+
+
+def test_e2e_direct_message_flow() -> None:
+    """Sender queues until the peer key arrives; receiver holds until it can decrypt."""
+    alice, bob = make_e2e_client("alice"), make_e2e_client("bob")
+    assert alice.e2e and bob.e2e
+
+    with patch('src.client.network.send_json') as mock_send:
+        alice.send_message("bob", "hi bob")
+        mock_send.assert_called_with(alice.sock, {"action": "get_public_key", "target": "bob"})
+
+        alice._dispatch({"action": "public_key", "target": "bob",
+                         "public_key": bob.e2e.public_key_string()})
+        frame = mock_send.call_args[0][1]
+        assert frame["to"] == "bob" and frame["text"].startswith("e2e:")
+
+        bob._dispatch({"action": "msg", "sender": "alice", "to": "alice", "text": frame["text"]})
+        cast(Mock, bob.on_msg).assert_not_called()
+        bob._dispatch({"action": "public_key", "target": "alice",
+                       "public_key": alice.e2e.public_key_string()})
+
+    delivered = cast(Mock, bob.on_msg).call_args[0][0]
+    assert delivered["text"] == "hi bob"
+
+
+def test_peer_without_key_falls_back_to_server_key() -> None:
+    alice = make_e2e_client("alice")
+    alice.crypto = Mock()
+    alice.crypto.encrypt_message.return_value = "server_enc"
+    with patch('src.client.network.send_json') as mock_send:
+        alice.send_message("legacy", "hi")
+        alice._dispatch({"action": "public_key", "target": "legacy", "public_key": ""})
+        mock_send.assert_called_with(alice.sock, {"action": "msg", "to": "legacy", "text": "server_enc",
+                                                    "id": ANY})
+
+
+def test_pinned_peer_cannot_be_downgraded_or_replaced() -> None:
+    alice, bob = make_e2e_client("alice"), make_e2e_client("bob")
+    assert alice.e2e and bob.e2e
+    alice.crypto = Mock()
+    alice.on_error = Mock()
+    alice._dispatch({"action": "public_key", "target": "bob",
+                     "public_key": bob.e2e.public_key_string()})
+    bob.e2e.set_peer_key("alice", alice.e2e.public_key_string())
+
+    with patch('src.client.network.send_json') as mock_send:
+        # A new session: bob's key is only pinned, and the server claims he has none.
+        alice.e2e.peer_keys.clear()
+        alice._dispatch({"action": "msg", "sender": "bob", "to": "alice",
+                         "text": bob._e2e_encrypt("alice", "still readable")})
+        alice._dispatch({"action": "public_key", "target": "bob", "public_key": ""})
+        assert cast(Mock, alice.on_msg).call_args[0][0]["text"] == "still readable"
+        mock_send.reset_mock()
+        alice.send_message("bob", "secret")
+        mock_send.assert_not_called()
+        assert "bob" not in alice.no_e2e_peers
+        request, error = cast(Mock, alice.on_error).call_args[0]
+        assert request == {"action": "msg", "to": "bob"} and error["reason"] == "key_changed"
+
+        new_key = E2EManager("bob").public_key_string()
+        alice._dispatch({"action": "public_key", "target": "bob", "public_key": new_key})
+        assert alice.untrusted_peers == {"bob": new_key}
+        assert alice.e2e.peer_keys["bob"] == bob.e2e.public_key_string()
+        alice.e2e.new_group_key("#g")
+        alice._dispatch({"action": "group_key_needed", "group_name": "#g", "member": "bob",
+                         "public_key": new_key})
+        mock_send.assert_not_called()
+
+        assert alice.trust_peer_key("bob")
+        alice.send_message("bob", "hi")
+        assert mock_send.call_args[0][1]["text"].startswith("e2e:")
+    assert alice.e2e.peer_keys["bob"] == new_key
+
+
+def test_group_key_distribution() -> None:
+    alice, bob = make_e2e_client("alice"), make_e2e_client("bob")
+    assert alice.e2e and bob.e2e
+    with patch('src.client.network.send_json') as mock_send:
+        alice.create_group("team")
+        alice._dispatch({"action": "ack", "id": mock_send.call_args[0][1]["id"]})
+        alice._dispatch({"action": "group_key_needed", "group_name": "#team",
+                         "member": "bob", "public_key": bob.e2e.public_key_string()})
+        share = mock_send.call_args[0][1]
+        assert share["action"] == "share_group_key"
+
+        bob._dispatch({"action": "group_key", "group_name": "#team",
+                       "wrapped_key": share["keys"]["bob"], "wrapped_by": "alice",
+                       "wrapped_by_key": alice.e2e.public_key_string()})
+        alice.send_message("#team", "hello team")
+        text = mock_send.call_args[0][1]["text"]
+
+    bob._dispatch({"action": "msg", "sender": "alice", "to": "#team", "text": text})
+    assert cast(Mock, bob.on_msg).call_args[0][0]["text"] == "hello team"
+
+
+def test_refused_group_create_keeps_the_existing_key() -> None:
+    alice = make_e2e_client("alice")
+    assert alice.e2e
+    alice.e2e.new_group_key("#team")
+    existing = alice.e2e.group_keys["#team"]
+    with patch('src.client.network.send_json') as mock_send:
+        alice.create_group("team")
+        alice._dispatch({"action": "error", "reason": "group_exists",
+                         "id": mock_send.call_args[0][1]["id"]})
+    assert [c[0][1]["action"] for c in mock_send.call_args_list] == ["create_group"]
+    assert alice.e2e.group_keys["#team"] == existing
+
+
+def test_history_marks_failed_items(client: NetworkClient) -> None:
+    client.crypto = Mock()
+    client.crypto.decrypt_many.return_value = ["ok", None]
+    client._dispatch({"action": "history_response", "target": "#g",
+                      "messages": [{"text": "t1", "to": "#g"}, {"text": "t2", "to": "#g"}]})
+    client.crypto.decrypt_many.assert_called_once_with(["t1", "t2"])
+    msgs = cast(Mock, client.on_history).call_args[0][1]
+    assert [m["text"] for m in msgs] == ["ok", "[Decryption Error]"]
+
+
+def test_offline_messages_are_delivered_as_messages(client: NetworkClient) -> None:
+    client.crypto = Mock()
+    client.crypto.decrypt_many.return_value = ["a", "b"]
+    client._dispatch({"action": "offline_messages", "messages": [
+        {"sender": "u2", "to": "me", "text": "t1"}, {"sender": "u3", "to": "#g", "text": "t2"}]})
+    delivered = [c[0][0] for c in cast(Mock, client.on_msg).call_args_list]
+    assert [(m["sender"], m["text"]) for m in delivered] == [("u2", "a"), ("u3", "b")]
+
+
+def test_ping_is_answered(client: NetworkClient) -> None:
+    client.sock = Mock()
+    with patch('src.client.network.send_json') as mock_send:
+        client._dispatch({"action": "ping"})
+    mock_send.assert_called_once_with(client.sock, {"action": "pong"})
+
+
+def test_heartbeat_pings_then_drops_silent_server() -> None:
+    client = NetworkClient(Mock(), Mock(), Mock(), heartbeat_interval=0.03, heartbeat_timeout=0.2)
+    client.running = True
+    client.sock = Mock()
+    client.last_received = time.monotonic()
+
+    with patch('src.client.network.send_json') as mock_send:
+        beat = threading.Thread(target=client._heartbeat)
+        beat.start()
+        beat.join(2)
+
+    assert not beat.is_alive()
+    mock_send.assert_any_call(client.sock, {"action": "ping"})
+    client.sock.shutdown.assert_called_once()
+
+
+def test_sends_from_several_threads_do_not_interleave(client: NetworkClient) -> None:
+    """The GUI, listener and heartbeat threads share one socket."""
+    ours, theirs = socket.socketpair()
+    client.sock, client.running = ours, True
+    big = "x" * 300_000
+    received = []
+    reader = threading.Thread(
+        target=lambda: received.extend(receive_json(theirs) for _ in range(12)))
+    reader.start()
+    senders = [threading.Thread(target=lambda n=n: [client._send({"n": n, "text": big})
+                                                    for _ in range(3)])
+               for n in range(4)]
+    for t in senders:
+        t.start()
+    for t in senders + [reader]:
+        t.join(10)
+    ours.close()
+    theirs.close()
+    assert len(received) == 12
+    assert all(f and f["text"] == big for f in received)
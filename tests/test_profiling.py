@@ -0,0 +1,92 @@
+import os
+import threading
+import time
+from typing import Generator
+from unittest.mock import Mock, patch
+import pytest
+from src.server import profiling
+from src.server.profiling import Profiler
+from src.server.database import Database
+from src.server.server_main import ChatServer
+
+
+@pytest.fixture(autouse=True)
+def profile_dir(tmp_path: str) -> Generator[None, None, None]:
+    with patch.object(profiling, "PROFILE_DIR", str(tmp_path)):
+        yield
+
+
+def busy_worker(stop: threading.Event) -> None:
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_profile_window_writes_folded_stacks(tmp_path: str) -> None:
+    stop = threading.Event()
+    worker = threading.Thread(target=busy_worker, args=(stop,), name="handler-1")
+    worker.start()
+    try:
+        p = Profiler(interval=0.001)
+        assert p.start(0.1, trace_allocations=False)
+        assert not p.start(0.1)  # only one window at a time
+        p.wait(5)
+    finally:
+        stop.set()
+        worker.join()
+
+    assert not p.running
+    assert len(p.last_output) == 1
+    with open(p.last_output[0], encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    assert lines
+    _, count = lines[0].rsplit(" ", 1)
+    assert int(count) >= 1
+    assert any(line.startswith("handler-1;") and "busy_worker" in line for line in lines)
+
+
+def test_allocation_report_filters_hot_modules(tmp_path: str) -> None:
+    with patch('src.server.database.DB_PATH', os.path.join(str(tmp_path), "p.db")):
+        db = Database()
+        db.register_user("a", "p")
+        db.register_user("b", "p")
+        for i in range(50):
+            db.store_message("a", "b", f"m{i}")
+        run_history_window(db)
+
+
+def run_history_window(db: Database) -> None:
+
+    p = Profiler(interval=0.01)
+    p.start(0.2)
+    deadline = time.monotonic() + 0.15
+    history = []
+    while time.monotonic() < deadline:
+        history.append(db.get_chat_history("a", "b"))
+    p.wait(5)
+
+    assert len(p.last_output) == 2
+    with open(p.last_output[1], encoding="utf-8") as f:
+        report = f.read()
+    assert report.startswith("# top")
+    sites = report.splitlines()[1:]
+    assert sites and all("database.py" in s or "protocol.py" in s for s in sites)
+
+
+def test_duration_is_capped() -> None:
+    p = Profiler()
+    with patch.object(threading, "Thread") as thread:
+        p.start(10_000)
+    assert thread.call_args.kwargs["args"][0] == profiling.MAX_DURATION
+
+
+def test_server_profile_route() -> None:
+    with patch("src.server.server_main.Database"), patch("src.server.server_main.CryptoManager"):
+        server = ChatServer()
+    server.profiler = Mock()
+    server.profiler.start.return_value = True
+    assert server._profile_route({"seconds": "5"})[0] == 202
+    server.profiler.start.assert_called_with(5.0)
+    assert server._profile_route({"seconds": "x"})[0] == 400
+    assert server._profile_route({"seconds": "-1"})[0] == 400
+    server.profiler.start.return_value = False
+    assert server._profile_route({})[0] == 409
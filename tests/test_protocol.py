@@ -1,10 +1,16 @@
 import socket
 import struct
 import json
+import zlib
 from unittest.mock import Mock, MagicMock
 from typing import Any
 import pytest
-from src.common.protocol import send_json, receive_json
+from src.common import protocol
+from src.common.crypto_utils import E2EManager
+from src.common.protocol import (
+    send_json, receive_json, set_frame_observer, encode_frame, decode_frame, split_header,
+    read_frame, FrameError, ReadBudget, COMPRESS_THRESHOLD, FLAG_COMPRESSED
+)
 
 
 def test_send_json_success() -> None:
@@ -21,15 +27,14 @@ def test_send_json_success() -> None:
     mock_socket.sendall.assert_called_once_with(expected_call)
 
 
-def test_send_json_exception(capsys: Any) -> None:
-    """Test that exceptions during send are caught and printed."""
+def test_send_json_exception(caplog: Any) -> None:
+    """Test that exceptions during send are caught and logged."""
     mock_socket = Mock(spec=socket.socket)
     mock_socket.sendall.side_effect = Exception("Connection lost")
 
     send_json(mock_socket, {"a": 1})
 
-    captured = capsys.readouterr()
-    assert "Error sending: Connection lost" in captured.out
+    assert "Error sending: Connection lost" in caplog.text
 
 
 def test_receive_json_success() -> None:
@@ -81,3 +86,130 @@ def test_receive_json_exception() -> None:
     mock_socket = Mock(spec=socket.socket)
     mock_socket.recv.side_effect = Exception("Socket error")
     assert receive_json(mock_socket) is None
+
+
+def test_frame_observer() -> None:
+    """Frame sizes are reported for both directions when an observer is set."""
+    observer = Mock()
+    mock_socket = Mock(spec=socket.socket)
+    payload = json.dumps({"a": 1}).encode('utf-8')
+    mock_socket.recv.side_effect = [struct.pack('!I', len(payload)), payload]
+
+    set_frame_observer(observer)
+    try:
+        send_json(mock_socket, {"a": 1})
+        receive_json(mock_socket)
+    finally:
+        set_frame_observer(None)
+
+    observer.assert_any_call("out", 4 + len(payload))
+    observer.assert_any_call("in", 4 + len(payload))
+
+
+def history_frame(n: int) -> dict:
+    return {"action": "history_response", "target": "bob", "id": 7,
+            "messages": [{"sender": "alice" if i % 2 else "bob", "to": "bob",
+                          "text": f"e2e:AQIAAAAB{i:06d}"} for i in range(n)]}
+
+
+def test_compressed_round_trip() -> None:
+    """Large frames shrink and set the header flag; the receiver inflates them."""
+    data = history_frame(200)
+    raw = encode_frame(data)
+    packed = encode_frame(data, compress=True)
+    assert len(packed) < len(raw) / 3
+
+    length, compressed = split_header(packed[:4])
+    assert compressed and length == len(packed) - 4
+    assert not split_header(raw[:4])[1]
+
+    mock_socket = Mock(spec=socket.socket)
+    mock_socket.recv.side_effect = [packed[:4], packed[4:]]
+    assert receive_json(mock_socket) == data
+
+
+def test_dictionary_shrinks_encrypted_messages() -> None:
+    alice, bob = E2EManager("alice"), E2EManager("bob")
+    alice.set_peer_key("bob", bob.public_key_string())
+    frame = json.dumps({"action": "msg", "sender": "alice", "to": "bob",
+                        "text": alice.encrypt_for("bob", "see you at six")}).encode('utf-8')
+
+    def deflated(**kwargs: Any) -> int:
+        packer = zlib.compressobj(protocol.COMPRESS_LEVEL, **kwargs)
+        return len(packer.compress(frame) + packer.flush())
+
+    assert deflated(zdict=protocol.ZDICT) < min(deflated(), len(frame)) - 20
+
+
+def test_small_frames_stay_raw() -> None:
+    data = {"action": "ack", "id": 1}
+    assert len(encode_frame(data)) < COMPRESS_THRESHOLD
+    assert encode_frame(data, compress=True) == encode_frame(data)
+
+
+def test_decompression_bomb_rejected() -> None:
+    bomb = zlib.compressobj(9, zdict=protocol.ZDICT)
+    body = bomb.compress(b"[" + b"0," * (protocol.MAX_DECOMPRESSED_SIZE // 2) + b"0]") + bomb.flush()
+    with pytest.raises(ValueError):
+        decode_frame(body, compressed=True)
+    with pytest.raises(ValueError):
+        decode_frame(b"not zlib", compressed=True)
+
+    mock_socket = Mock(spec=socket.socket)
+    mock_socket.recv.side_effect = [struct.pack('!I', len(body) | FLAG_COMPRESSED), body]
+    assert receive_json(mock_socket) is None
+
+
+def test_read_frame_rejects_oversized_before_body() -> None:
+    a, b = socket.socketpair()
+    try:
+        a.sendall(struct.pack('!I', 10_000_000))  # header only, no body follows
+        with pytest.raises(FrameError) as err:
+            read_frame(b, max_size=1024, frame_timeout=1.0)
+        assert err.value.reason == "too_large"
+    finally:
+        a.close()
+        b.close()
+
+
+def test_read_frame_budget() -> None:
+    a, b = socket.socketpair()
+    try:
+        budget = ReadBudget(130, window=3600)
+        frame = encode_frame({"text": "x" * 40})
+        a.sendall(frame * 3)
+        assert read_frame(b, budget=budget) == {"text": "x" * 40}
+        assert read_frame(b, budget=budget) == {"text": "x" * 40}
+        with pytest.raises(FrameError) as err:
+            read_frame(b, budget=budget)
+        assert err.value.reason == "budget"
+    finally:
+        a.close()
+        b.close()
+
+
+def test_read_frame_idle_and_slow_timeouts() -> None:
+    a, b = socket.socketpair()
+    try:
+        with pytest.raises(FrameError) as err:
+            read_frame(b, idle_timeout=0.05)
+        assert err.value.reason == "idle"
+
+        frame = encode_frame({"text": "hello"})
+        a.sendall(frame[:-3])  # the rest never arrives
+        with pytest.raises(FrameError) as err:
+            read_frame(b, idle_timeout=1.0, frame_timeout=0.1)
+        assert err.value.reason == "slow"
+        # Deadlines never touch the socket timeout, which sends share.
+        assert b.gettimeout() is None
+    finally:
+        a.close()
+        b.close()
+
+
+def test_read_frame_split_header() -> None:
+    payload = json.dumps({"a": 1}).encode('utf-8')
+    header = struct.pack('!I', len(payload))
+    mock_socket = Mock(spec=socket.socket)
+    mock_socket.recv.side_effect = [header[:1], header[1:3], header[3:], payload]
+    assert read_frame(mock_socket) == {"a": 1}
@@ -0,0 +1,59 @@
+from typing import Any, Dict, List
+from src.server.recent import RecentMessages, message_size
+
+
+def msgs(*ids: int) -> List[Dict[str, Any]]:
+    return [{"id": i, "sender": "a", "to": "b", "text": f"m{i}"} for i in ids]
+
+
+def test_appended_messages_answer_latest_pages() -> None:
+    cache = RecentMessages(per_conversation=3)
+    assert cache.recent("ab", 2) is None
+    for m in msgs(1, 2, 3, 4):
+        cache.append("ab", m)
+
+    assert cache.recent("ab", 2) == msgs(3, 4)
+    assert cache.recent("ab", 3) == msgs(2, 3, 4)
+    assert cache.recent("ab", 2, before=4) == msgs(2, 3)
+    # Older than the ring holds, or the whole conversation: ask the database.
+    assert cache.recent("ab", 4) is None
+    assert cache.recent("ab", 2, before=3) is None
+    assert cache.recent("ab") is None
+
+
+def test_complete_conversation_is_served_entirely() -> None:
+    cache = RecentMessages(per_conversation=3)
+    cache.fill("ab", msgs(1, 2), complete=True)
+    cache.append("ab", msgs(5)[0])
+    assert cache.recent("ab") == msgs(1, 2, 5)
+    assert cache.recent("ab", 10) == msgs(1, 2, 5)
+    assert cache.recent("ab", 10, before=2) == msgs(1)
+
+    # Once the oldest message falls out, the ring no longer has everything.
+    cache.append("ab", msgs(6)[0])
+    assert cache.recent("ab") is None
+    assert cache.recent("ab", 3) == msgs(2, 5, 6)
+
+
+def test_fill_keeps_messages_appended_after_the_read() -> None:
+    cache = RecentMessages(per_conversation=10)
+    cache.append("ab", msgs(4)[0])
+    cache.fill("ab", msgs(1, 2, 3), complete=True)
+    # A message stored before the read and appended afterwards is not duplicated.
+    cache.append("ab", msgs(3)[0])
+    assert cache.recent("ab") == msgs(1, 2, 3, 4)
+    assert cache.size == sum(message_size(m) for m in msgs(1, 2, 3, 4))
+
+
+def test_budget_evicts_idle_conversations_first() -> None:
+    one = message_size(msgs(1)[0])
+    cache = RecentMessages(per_conversation=10, budget=3 * one)
+    cache.append("x", msgs(1)[0])
+    cache.append("y", msgs(2)[0])
+    cache.append("z", msgs(3)[0])
+    assert cache.recent("x", 1) == msgs(1)  # x is now the most recently used
+
+    cache.append("w", msgs(4)[0])
+    assert cache.recent("y", 1) is None
+    assert cache.recent("x", 1) == msgs(1)
+    assert len(cache) == 3 and cache.size == 3 * one
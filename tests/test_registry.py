@@ -0,0 +1,72 @@
+import threading
+from unittest.mock import Mock
+from src.server.registry import ClientRegistry
+
+
+def test_add_lookup_and_remove() -> None:
+    reg = ClientRegistry()
+    conn = Mock()
+    assert reg.add("u1", conn) == 1
+    assert reg.add("u1", conn) == 1
+    assert "u1" in reg and len(reg) == 1
+    assert reg.sessions("u1") == (conn,)
+    assert reg.sessions("u2") == ()
+
+    assert reg.remove("u1", conn) is True
+    assert "u1" not in reg
+    assert reg.remove("u1", conn) is False
+
+
+def test_snapshot_is_unaffected_by_later_writes() -> None:
+    reg = ClientRegistry({"u1": Mock()})
+    snap = reg.snapshot()
+    reg.add("u2", Mock())
+    reg.remove("u1", snap["u1"][0])
+    assert list(snap) == ["u1"]
+    assert list(reg.snapshot()) == ["u2"]
+
+
+def test_user_stays_online_until_last_device_disconnects() -> None:
+    reg = ClientRegistry()
+    desktop, laptop = Mock(), Mock()
+    reg.add("u1", desktop)
+    assert reg.add("u1", laptop) == 2
+    assert reg.sessions("u1") == (desktop, laptop)
+
+    assert reg.remove("u1", desktop) is True
+    assert reg.sessions("u1") == (laptop,)
+    assert reg.remove("u1", laptop) is True
+    assert "u1" not in reg
+
+
+def test_iteration_during_concurrent_writes() -> None:
+    reg = ClientRegistry()
+    stop = threading.Event()
+    errors = []
+
+    def churn(prefix: str) -> None:
+        conns = {f"{prefix}{i}": Mock() for i in range(50)}
+        while not stop.is_set():
+            for user, conn in conns.items():
+                reg.add(user, conn)
+            for user, conn in conns.items():
+                reg.remove(user, conn)
+
+    def broadcast() -> None:
+        try:
+            for _ in range(2000):
+                for _user, _conn in reg.snapshot().items():
+                    pass
+        except RuntimeError as e:
+            errors.append(e)
+
+    writers = [threading.Thread(target=churn, args=(p,)) for p in "ab"]
+    for t in writers:
+        t.start()
+    broadcast()
+    stop.set()
+    for t in writers:
+        t.join()
+
+    assert not errors
+    assert len(reg) == 0
@@ -0,0 +1,41 @@
+from src.client.room_index import RoomIndex, tokenize
+
+
+ROOMS = [
+    ("&py", "Python, coding"),
+    ("&music", "music jazz"),
+    ("&pyjazz", "python jazz"),
+    ("&long", "internationalization"),
+]
+
+
+def test_tokenize() -> None:
+    assert tokenize("Python, Coding  jazz") == ["python", "coding", "jazz"]
+
+
+def test_empty_query_returns_all() -> None:
+    index = RoomIndex(ROOMS)
+    assert index.search("") == ROOMS
+
+
+def test_prefix_match_case_insensitive() -> None:
+    index = RoomIndex(ROOMS)
+    assert index.search("PYT") == [ROOMS[0], ROOMS[2]]
+
+
+def test_all_terms_must_match() -> None:
+    index = RoomIndex(ROOMS)
+    assert index.search("py jazz") == [ROOMS[2]]
+    assert index.search("py rock") == []
+
+
+def test_terms_longer_than_indexed_prefix() -> None:
+    index = RoomIndex(ROOMS)
+    assert index.search("internationaliz") == [ROOMS[3]]
+    assert index.search("internationalx") == []
+
+
+def test_limit() -> None:
+    index = RoomIndex([(f"&r{i}", "tag") for i in range(50)])
+    result = index.search("tag", limit=5)
+    assert [n for n, _ in result] == ["&r0", "&r1", "&r2", "&r3", "&r4"]
@@ -1,7 +1,15 @@
+import socket
+import threading
+import time
+import struct
 import pytest
 from unittest.mock import Mock, patch, ANY
-from typing import Generator, cast
-from src.server.server_main import ChatServer
+from typing import Any, Generator, cast
+from src.server.server_main import ChatServer, ConnectionLimits
+from src.server.registry import ClientRegistry
+from src.server.admission import AdmissionController, RateLimiter
+from src.server.message_log import MessageLog
+from src.common.protocol import receive_json
 
 
 @pytest.fixture
@@ -28,11 +36,20 @@ def test_start_server(server: ChatServer) -> None:
         mock_sock.listen.assert_called()
 
 
+def test_start_server_custom_address(server: ChatServer) -> None:
+    mock_sock = Mock()
+    mock_sock.accept.side_effect = Exception("Stop loop")
+    server.server_socket = mock_sock
+    server.host, server.port = "0.0.0.0", 6000
+    server.start()
+    mock_sock.bind.assert_called_with(("0.0.0.0", 6000))
+
+
 def test_handle_client_register(server: ChatServer) -> None:
     mock_conn = Mock()
     req = {"action": "register", "username": " u1 ", "password": "p1"}
 
-    with patch('src.server.server_main.receive_json', side_effect=[req, None]):
+    with patch('src.server.server_main.read_frame', side_effect=[req, None]):
         with patch('src.server.server_main.send_json') as mock_send:
             
             cast(Mock, server.db.register_user).return_value = "success"
@@ -49,7 +66,7 @@ def test_handle_client_register_empty_fields(server: ChatServer) -> None:
     mock_conn = Mock()
     req = {"action": "register", "username": "", "password": "123"}
 
-    with patch('src.server.server_main.receive_json', side_effect=[req, None]):
+    with patch('src.server.server_main.read_frame', side_effect=[req, None]):
         with patch('src.server.server_main.send_json') as mock_send:
 
             server.handle_client(mock_conn, ("ip", 123))
@@ -67,7 +84,7 @@ def test_handle_client_login_success(server: ChatServer) -> None:
     mock_conn = Mock()
     req = {"action": "login", "username": "u1", "password": "p1"}
 
-    with patch('src.server.server_main.receive_json', side_effect=[req, None]):
+    with patch('src.server.server_main.read_frame', side_effect=[req, None]):
         with patch('src.server.server_main.send_json') as mock_send:
           
             cast(Mock, server.db.check_login).return_value = True
@@ -90,9 +107,9 @@ def test_handle_client_actions(server: ChatServer) -> None:
         None  
     ]
 
-    server.clients["u2"] = Mock()
+    server.clients.add("u2", Mock())
 
-    with patch('src.server.server_main.receive_json', side_effect=requests):
+    with patch('src.server.server_main.read_frame', side_effect=requests):
         with patch('src.server.server_main.send_json'):
             
             cast(Mock, server.db.check_login).return_value = True
@@ -100,21 +117,494 @@ def test_handle_client_actions(server: ChatServer) -> None:
             server.handle_client(mock_conn, ("ip", 123))
 
             cast(Mock, server.db.store_message).assert_called_with("u1", "u2", "enc_txt")
-            cast(Mock, server.db.get_chat_history).assert_called_with("u1", "u2")
+            cast(Mock, server.db.get_chat_history).assert_called_with("u1", "u2", limit=None, before=None)
             cast(Mock, server.db.create_group).assert_called_with("g1", "u1")
 
 
+def test_refused_group_create_gets_an_error_reply(server: ChatServer) -> None:
+    cast(Mock, server.db.check_login).return_value = True
+    cast(Mock, server.db.create_group).side_effect = [True, False]
+    requests = [
+        {"action": "login", "username": "u1", "password": "p"},
+        {"action": "create_group", "group_name": "#new", "id": 1},
+        {"action": "create_group", "group_name": "#taken", "id": 2},
+        None
+    ]
+    with patch('src.server.server_main.read_frame', side_effect=requests), \
+            patch('src.server.server_main.send_json') as mock_send:
+        server.handle_client(Mock(), ("ip", 1))
+
+    replies = {c[0][1].get("id"): c[0][1] for c in mock_send.call_args_list}
+    assert replies[1] == {"action": "ack", "id": 1}
+    assert replies[2]["action"] == "error" and replies[2]["reason"] == "group_exists"
+
+
+def test_login_with_another_identity_key_is_refused(server: ChatServer) -> None:
+    """A device with its own key would miss messages encrypted for the registered one."""
+    cast(Mock, server.db.check_login).return_value = True
+    server.public_keys = {"u1": "pk_desktop"}
+    login = {"action": "login", "username": "u1", "password": "p"}
+
+    with patch('src.server.server_main.send_json') as mock_send:
+        assert server._handle_login(Mock(), {**login, "public_key": "pk_phone"}) is None
+        reply = mock_send.call_args[0][1]
+        assert (reply["status"], reply["reason"]) == ("error", "identity_mismatch")
+        assert "u1" not in server.clients
+
+        assert server._handle_login(Mock(), {**login, "public_key": "pk_desktop"}) == "u1"
+        cast(Mock, server.db.set_public_key).assert_not_called()
+
+        # Replacing the key is an explicit choice.
+        assert server._handle_login(
+            Mock(), {**login, "public_key": "pk_phone", "replace_key": True}) == "u1"
+        cast(Mock, server.db.set_public_key).assert_called_once_with("u1", "pk_phone")
+
+
+def test_second_device_stays_online_when_first_disconnects(server: ChatServer) -> None:
+    """A user logged in on two devices stays online when one of them disconnects."""
+    old_conn, new_conn = Mock(), Mock()
+    cast(Mock, server.db.check_login).return_value = True
+    login = {"action": "login", "username": "u1", "password": "p1"}
+
+    def frames() -> Any:
+        yield dict(login)
+        # The same user logs in from a second device, then the first one closes.
+        server._process_action(new_conn, dict(login), None)
+        yield None
+
+    reader = frames()
+    with patch('src.server.server_main.read_frame', side_effect=lambda *a, **k: next(reader)), \
+            patch('src.server.server_main.send_json'):
+        server.handle_client(old_conn, ("ip", 1))
+
+    assert server.clients.sessions("u1") == (new_conn,)
+
+
+def test_messages_reach_every_device(server: ChatServer) -> None:
+    """DMs go to all of the recipient's devices and to the sender's other devices."""
+    desktop, laptop, phone, bob = Mock(), Mock(), Mock(), Mock()
+    server.clients = ClientRegistry({"u2": bob})
+    server.clients.add("u1", desktop)
+    server.clients.add("u1", laptop)
+    server.clients.add("u2", phone)
+    cast(Mock, server.db.store_message).return_value = 7
+    cast(Mock, server.db.get_group_members).return_value = ["u1", "u2"]
+
+    with patch('src.server.server_main.send_json') as mock_send:
+        server._handle_msg(desktop, "u1", {"to": "u2", "text": "hi"})
+        frames = {c[0][0]: c[0][1] for c in mock_send.call_args_list}
+        assert set(frames) == {bob, phone, laptop}
+        assert frames[bob]["to"] == "u1"
+        assert frames[laptop] == {"action": "msg", "sender": "u1", "to": "u2", "text": "hi"}
+
+        mock_send.reset_mock()
+        server._handle_msg(phone, "u2", {"to": "#g", "text": "yo"})
+        assert {c[0][0] for c in mock_send.call_args_list} == {desktop, laptop, bob}
+
+
+def test_device_gets_missed_messages_and_saves_cursor(server: ChatServer) -> None:
+    conn = Mock()
+    missed = [{"sender": "u2", "to": "u1", "text": "while away"}]
+    db = cast(Mock, server.db)
+    db.check_login.return_value = True
+    db.get_last_message_id.return_value = 40
+    db.get_device_cursor.return_value = 35
+    db.get_messages_since.return_value = missed
+    db.store_message.return_value = 41
+    requests = [
+        {"action": "login", "username": "u1", "password": "p", "device": "laptop"},
+        None
+    ]
+
+    def frames() -> Any:
+        yield requests[0]
+        # A message arrives while the device is connected.
+        server.clients.add("u2", Mock())
+        server._handle_msg(Mock(), "u2", {"to": "u1", "text": "live"})
+        yield None
+
+    reader = frames()
+    with patch('src.server.server_main.read_frame', side_effect=lambda *a, **k: next(reader)), \
+            patch('src.server.server_main.send_json') as mock_send:
+        server.handle_client(conn, ("ip", 1))
+
+    db.get_messages_since.assert_called_once_with("u1", 35, 40)
+    mock_send.assert_any_call(conn, {"action": "offline_messages", "messages": missed})
+    db.set_device_cursor.assert_called_once_with("u1", "laptop", 41)
+    assert conn not in server.devices
+
+
+def test_request_ids_are_echoed(server: ChatServer) -> None:
+    """Replies carry the request id; requests without a reply get an ack."""
+    mock_conn = Mock()
+    requests = [
+        {"action": "login", "username": "u1", "password": "p1", "id": 1},
+        {"action": "get_history", "target": "u2", "id": 2},
+        {"action": "get_history", "target": "u3", "id": 3},
+        {"action": "msg", "to": "u2", "text": "x", "id": 4},
+        {"action": "get_history", "target": "u2"},
+        None
+    ]
+    cast(Mock, server.db.check_login).return_value = True
+    cast(Mock, server.db.get_chat_history).return_value = []
+
+    with patch('src.server.server_main.read_frame', side_effect=requests), \
+            patch('src.server.server_main.send_json') as mock_send:
+        server.handle_client(mock_conn, ("ip", 123))
+
+    frames = [c[0][1] for c in mock_send.call_args_list if c[0][0] is mock_conn]
+    assert [f.get("id") for f in frames] == [1, 2, 3, 4, None]
+    assert frames[1]["target"] == "u2" and frames[2]["target"] == "u3"
+    assert frames[3] == {"action": "ack", "id": 4}
+
+
+def test_compression_negotiated_at_login(server: ChatServer) -> None:
+    conn = Mock()
+    requests = [
+        {"action": "login", "username": "u1", "password": "p1", "compress": ["zlib"]},
+        {"action": "get_history", "target": "u2"},
+        None
+    ]
+    cast(Mock, server.db.check_login).return_value = True
+    cast(Mock, server.db.get_chat_history).return_value = []
+
+    with patch('src.server.server_main.read_frame', side_effect=requests), \
+            patch('src.server.server_main.send_json') as mock_send:
+        server.handle_client(conn, ("ip", 123))
+
+    login, history = mock_send.call_args_list
+    assert login[0][1]["compress"] == "zlib" and "compress" not in login[1]
+    assert history[0][1]["action"] == "history_response" and history[1] == {"compress": True}
+    assert conn not in server.compressed
+
+
 def test_handle_msg_routing_public(server: ChatServer) -> None:
-    """Test routing to public room (&room)."""
-    conn1 = Mock()
-    conn2 = Mock()
-    server.clients = {"u1": conn1, "u2": conn2}
+    """Room messages go only to online subscribers."""
+    conn1, conn2, conn3 = Mock(), Mock(), Mock()
+    server.clients = ClientRegistry({"u1": conn1, "u2": conn2, "u3": conn3})
+    cast(Mock, server.db.get_room_members).return_value = ["u1", "u2"]
 
     req = {"action": "msg", "to": "&room", "text": "hi"}
 
     with patch('src.server.server_main.send_json') as mock_send:
         server._handle_msg(conn1, "u1", req)
 
-        args, _ = mock_send.call_args
-        assert args[0] == conn2
-        assert args[1]["to"] == "&room"
+        assert [c[0][0] for c in mock_send.call_args_list] == [conn2]
+        assert mock_send.call_args[0][1]["to"] == "&room"
+    cast(Mock, server.db.join_room).assert_not_called()
+
+
+def test_room_join_leave_and_post_subscribes(server: ChatServer) -> None:
+    conns = {u: Mock() for u in ("u1", "u2", "u3")}
+    server.clients = ClientRegistry(dict(conns))
+    cast(Mock, server.db.get_room_members).return_value = []
+    cast(Mock, server.db.create_public_room).return_value = True
+    cast(Mock, server.db.join_room).return_value = True
+
+    with patch('src.server.server_main.send_json') as mock_send:
+        server._handle_other_actions(Mock(), "u1", {"room_name": "lobby", "tags": ""}, "create_public_room")
+        server._handle_other_actions(Mock(), "u2", {"room_name": "&lobby"}, "join_room")
+        # u3 is not subscribed but posts: it gets subscribed, the others receive.
+        mock_send.reset_mock()
+        server._handle_msg(conns["u3"], "u3", {"to": "&lobby", "text": "hey"})
+        assert {c[0][0] for c in mock_send.call_args_list} == {conns["u1"], conns["u2"]}
+
+        server._handle_other_actions(Mock(), "u2", {"room_name": "lobby"}, "leave_room")
+        mock_send.reset_mock()
+        server._handle_msg(conns["u1"], "u1", {"to": "&lobby", "text": "bye"})
+        assert [c[0][0] for c in mock_send.call_args_list] == [conns["u3"]]
+
+    cast(Mock, server.db.join_room).assert_any_call("&lobby", "u3")
+    cast(Mock, server.db.leave_room).assert_called_once_with("&lobby", "u2")
+    assert server.room_subscribers["&lobby"] == {"u1", "u3"}
+
+
+def test_public_key_cache(server: ChatServer) -> None:
+    conn = Mock()
+    cast(Mock, server.db.get_public_key).return_value = "pk_u2"
+    with patch('src.server.server_main.send_json') as mock_send:
+        server._process_action(conn, {"action": "get_public_key", "target": "u2"}, "u1")
+        server._process_action(conn, {"action": "get_public_key", "target": "u2"}, "u1")
+
+    mock_send.assert_called_with(conn, {"action": "public_key", "target": "u2", "public_key": "pk_u2"})
+    cast(Mock, server.db.get_public_key).assert_called_once_with("u2")
+
+
+def test_share_group_key_only_for_members(server: ChatServer) -> None:
+    member_conn = Mock()
+    server.clients = ClientRegistry({"u2": member_conn})
+    server.public_keys = {"u1": "pk_u1"}
+    cast(Mock, server.db.get_group_members).return_value = ["u1", "u2"]
+    req = {"action": "share_group_key", "group_name": "#g", "keys": {"u2": "w2", "x": "wx"}}
+
+    with patch('src.server.server_main.send_json') as mock_send:
+        server._process_action(Mock(), req, "u1")
+
+    cast(Mock, server.db.store_group_key).assert_called_once_with("#g", "u2", "w2", "u1")
+    mock_send.assert_called_once_with(member_conn, {
+        "action": "group_key", "group_name": "#g", "wrapped_key": "w2",
+        "wrapped_by": "u1", "wrapped_by_key": "pk_u1"
+    })
+
+
+def test_join_group_requests_key_from_online_members(server: ChatServer) -> None:
+    member_conn = Mock()
+    server.clients = ClientRegistry({"u1": member_conn, "u2": Mock()})
+    server.public_keys = {"u2": "pk_u2"}
+    cast(Mock, server.db.join_group).return_value = True
+    cast(Mock, server.db.get_group_members).return_value = ["u1", "u2"]
+
+    with patch('src.server.server_main.send_json') as mock_send:
+        server._process_action(Mock(), {"action": "join_group", "group_name": "#g"}, "u2")
+
+    mock_send.assert_any_call(member_conn, {
+        "action": "group_key_needed", "group_name": "#g", "member": "u2", "public_key": "pk_u2"
+    })
+
+
+def test_metrics_for_actions_and_fanout(server: ChatServer) -> None:
+    mock_conn = Mock()
+    server.clients = ClientRegistry({"u2": Mock(), "u3": Mock()})
+    requests = [
+        {"action": "login", "username": "u1", "password": "p1"},
+        {"action": "msg", "to": "&room", "text": "hi"},
+        {"action": "bogus"},
+        None
+    ]
+    with patch('src.server.server_main.read_frame', side_effect=requests):
+        with patch('src.server.server_main.send_json'):
+            cast(Mock, server.db.check_login).return_value = True
+            cast(Mock, server.db.get_room_members).return_value = ["u1", "u2", "u3"]
+            server.handle_client(mock_conn, ("ip", 123))
+
+    text = server.metrics.render()
+    assert 'chat_actions_total{action="msg"} 1.0' in text
+    assert 'chat_actions_total{action="unknown"} 1.0' in text
+    assert 'chat_message_fanout_sum{kind="room"} 2.0' in text
+
+
+def test_oversized_frame_closes_connection(server: ChatServer) -> None:
+    """A client announcing a huge frame gets an error and is disconnected without a read."""
+    server.limits = ConnectionLimits(max_frame_size=1024)
+    client, conn = socket.socketpair()
+    try:
+        client.sendall(struct.pack('!I', 4 * 1024 ** 3 - 1))
+        server.handle_client(conn, ("ip", 123))
+        reply = receive_json(client)
+        assert reply is not None
+        assert (reply["action"], reply["reason"]) == ("error", "too_large")
+        assert receive_json(client) is None  # closed by the server
+        assert 'chat_connections_rejected_total{reason="too_large"} 1.0' in server.metrics.render()
+    finally:
+        client.close()
+
+
+def test_login_timeout(server: ChatServer) -> None:
+    server.limits = ConnectionLimits(login_timeout=0.05)
+    client, conn = socket.socketpair()
+    try:
+        server.handle_client(conn, ("ip", 123))
+        reply = receive_json(client)
+        assert reply is not None and reply["reason"] == "idle"
+    finally:
+        client.close()
+
+
+def test_ping_is_answered_with_pong(server: ChatServer) -> None:
+    conn = Mock()
+    with patch('src.server.server_main.read_frame',
+               side_effect=[{"action": "ping", "id": 5}, {"action": "pong"}, None]), \
+            patch('src.server.server_main.send_json') as mock_send:
+        server.handle_client(conn, ("ip", 1))
+
+    assert [c[0][1] for c in mock_send.call_args_list] == [{"action": "pong", "id": 5}]
+    assert conn not in server.last_seen
+
+
+def test_reaper_pings_quiet_and_evicts_dead_sessions(server: ChatServer) -> None:
+    server.limits = ConnectionLimits(heartbeat_interval=30, heartbeat_timeout=90)
+    quiet, dead, busy = Mock(), Mock(), Mock()
+    server.clients = ClientRegistry({"quiet": quiet, "dead": dead, "busy": busy})
+    server.last_seen = {quiet: 1000 - 40, dead: 1000 - 100, busy: 1000 - 1}
+
+    with patch('src.server.server_main.send_json') as mock_send:
+        assert server.reap_idle_sessions(now=1000) == 1
+
+    mock_send.assert_called_once_with(quiet, {"action": "ping"})
+    dead.shutdown.assert_called_once_with(socket.SHUT_RDWR)
+    assert "dead" not in server.clients and "quiet" in server.clients
+    assert 'chat_sessions_reaped_total 1.0' in server.metrics.render()
+
+
+def test_requests_over_the_rate_limit_get_error_frames(server: ChatServer) -> None:
+    server.rate_limiter = RateLimiter({"get_history": (1, 60.0)})
+    cast(Mock, server.db.check_login).return_value = True
+    cast(Mock, server.db.get_chat_history).return_value = []
+    requests = [
+        {"action": "login", "username": "u1", "password": "p"},
+        {"action": "get_history", "target": "u2", "id": 1},
+        {"action": "get_history", "target": "u2", "id": 2},
+        {"action": "ping", "id": 3},
+        None
+    ]
+    with patch('src.server.server_main.read_frame', side_effect=requests), \
+            patch('src.server.server_main.send_json') as mock_send:
+        server.handle_client(Mock(), ("ip", 1))
+
+    replies = {c[0][1].get("id"): c[0][1] for c in mock_send.call_args_list}
+    assert replies[1]["action"] == "history_response"
+    assert replies[2]["action"] == "error" and replies[2]["reason"] == "rate_limited"
+    assert replies[2]["retry_after"] > 0
+    assert replies[3] == {"action": "pong", "id": 3}
+    cast(Mock, server.db.get_chat_history).assert_called_once()
+    assert server.admission.in_flight == 0 and server.admission.connections == 0
+    assert ('chat_requests_rejected_total{action="get_history",reason="rate_limited"} 1.0'
+            in server.metrics.render())
+
+
+def test_busy_server_sheds_reads_before_messages(server: ChatServer) -> None:
+    server.admission = AdmissionController(max_connections=10, max_in_flight=2)
+    server.admission.in_flight = 1
+    conn = Mock()
+    with patch('src.server.server_main.send_json') as mock_send:
+        server._handle_request(conn, {"action": "get_data", "id": 1}, "u1", "1.1")
+        server._handle_request(conn, {"action": "msg", "to": "u2", "text": "x", "id": 2}, "u1", "1.2")
+
+    replies = [c[0][1] for c in mock_send.call_args_list]
+    assert replies[0]["reason"] == "overloaded" and replies[0]["id"] == 1
+    assert replies[1] == {"action": "ack", "id": 2}
+    cast(Mock, server.db.store_message).assert_called_once()
+    assert server.admission.in_flight == 1
+
+
+def test_connections_over_capacity_are_refused(server: ChatServer) -> None:
+    server.admission = AdmissionController(max_connections=0, max_in_flight=1)
+    conn = Mock()
+    with patch('src.server.server_main.read_frame') as mock_read, \
+            patch('src.server.server_main.send_json') as mock_send:
+        server.handle_client(conn, ("ip", 1))
+
+    mock_read.assert_not_called()
+    assert mock_send.call_args[0][1]["reason"] == "overloaded"
+    conn.close.assert_called_once()
+
+
+def test_slow_history_does_not_delay_messages(server: ChatServer) -> None:
+    server.start_lanes()
+    order = []
+    released = threading.Event()
+
+    def slow_history(*_args: Any, **_kwargs: Any) -> Any:
+        released.wait(2)
+        order.append("history")
+        return []
+
+    def store(*_args: Any) -> int:
+        order.append("msg")
+        released.set()
+        return 1
+
+    db = cast(Mock, server.db)
+    db.check_login.return_value = True
+    db.get_chat_history.side_effect = slow_history
+    db.store_message.side_effect = store
+    requests = [
+        {"action": "login", "username": "u1", "password": "p"},
+        {"action": "get_history", "target": "u2", "id": 1},
+        {"action": "msg", "to": "u2", "text": "x", "id": 2},
+        None
+    ]
+    conn = Mock()
+    with patch('src.server.server_main.read_frame', side_effect=requests), \
+            patch('src.server.server_main.send_json') as mock_send:
+        server.handle_client(conn, ("ip", 1))
+    for lane in server.lanes.values():
+        lane.shutdown()
+
+    assert order == ["msg", "history"]
+    replies = [c[0][1] for c in mock_send.call_args_list]
+    assert {"action": "ack", "id": 2} in replies
+    assert any(r.get("action") == "history_response" and r.get("id") == 1 for r in replies)
+    assert conn not in server._send_locks
+
+
+def test_message_after_group_create_waits_for_the_create(server: ChatServer) -> None:
+    """create_group runs on the social lane and msg on the realtime lane."""
+    server.start_lanes()
+    order = []
+
+    def slow_create(*_args: Any) -> bool:
+        time.sleep(0.2)
+        order.append("create")
+        return True
+
+    def store(*_args: Any) -> int:
+        order.append("msg")
+        return 1
+
+    db = cast(Mock, server.db)
+    db.check_login.return_value = True
+    db.create_group.side_effect = slow_create
+    db.store_message.side_effect = store
+    db.get_group_members.return_value = ["u1"]
+    requests = [
+        {"action": "login", "username": "u1", "password": "p"},
+        {"action": "create_group", "group_name": "#g", "id": 1},
+        {"action": "msg", "to": "#g", "text": "x", "id": 2},
+        None
+    ]
+    with patch('src.server.server_main.read_frame', side_effect=requests), \
+            patch('src.server.server_main.send_json'):
+        server.handle_client(Mock(), ("ip", 1))
+    for lane in server.lanes.values():
+        lane.shutdown()
+
+    assert order == ["create", "msg"]
+
+
+def test_recent_history_is_served_from_memory(server: ChatServer) -> None:
+    db = cast(Mock, server.db)
+    db.check_login.return_value = True
+    db.store_message.side_effect = [1, 2, 3]
+    stored = [{"id": i, "sender": "u1", "to": "u2", "text": f"m{i}"} for i in (1, 2, 3)]
+    db.get_chat_history.return_value = stored
+    requests = [
+        {"action": "login", "username": "u1", "password": "p"},
+        *({"action": "msg", "to": "u2", "text": f"m{i}"} for i in (1, 2, 3)),
+        {"action": "get_history", "target": "u2", "limit": 2, "id": 1},
+        {"action": "get_history", "target": "u2", "limit": 5, "id": 2},
+        {"action": "get_history", "target": "u2", "id": 3},
+        {"action": "get_history", "target": "u2", "limit": 2, "before": 2, "id": 4},
+        None
+    ]
+    with patch('src.server.server_main.read_frame', side_effect=requests), \
+            patch('src.server.server_main.send_json') as mock_send:
+        server.handle_client(Mock(), ("ip", 1))
+
+    pages = {r["id"]: r["messages"] for r in (c[0][1] for c in mock_send.call_args_list)
+             if r.get("action") == "history_response"}
+    assert pages == {1: stored[1:], 2: stored, 3: stored, 4: stored[:1]}
+    # Only the page reaching past what was sent since startup went to the database.
+    db.get_chat_history.assert_called_once_with("u1", "u2", limit=5, before=None)
+    assert 'chat_history_cache_total{result="hit"} 3.0' in server.metrics.render()
+
+
+def test_archives_old_messages(server: ChatServer) -> None:
+    db = cast(Mock, server.db)
+    db.archive_messages.return_value = 12
+    assert server.archive_old_messages() == 12
+    db.archive_messages.assert_called_once_with(90.0)
+    assert "chat_messages_archived_total 12.0" in server.metrics.render()
+
+    server.limits = ConnectionLimits(archive_after_days=None)
+    assert server.archive_old_messages() == 0
+    db.archive_messages.assert_called_once()
+
+
+def test_message_log_dir_selects_the_log_engine(tmp_path: Any) -> None:
+    with patch('src.server.server_main.Database') as mock_db, \
+            patch('src.server.server_main.CryptoManager'):
+        ChatServer(message_log_dir=str(tmp_path))
+    log = mock_db.call_args[0][0]
+    assert isinstance(log, MessageLog) and log.directory == str(tmp_path)
+    log.close()
@@ -0,0 +1,70 @@
+from unittest.mock import Mock
+from typing import Any, Dict
+from src.client.widget_list import KeyedWidgetList, RowKind
+
+
+def make_list(max_pool_size: int = 10) -> KeyedWidgetList:
+    kind = RowKind(lambda parent: Mock(), lambda w, data: w.configure(text=data), {"fill": "x"})
+    return KeyedWidgetList(Mock(), {"row": kind}, max_pool_size=max_pool_size)
+
+
+def test_creates_rows_in_order() -> None:
+    rows = make_list()
+    rows.reconcile([("row", "a", "A"), ("row", "b", "B")])
+    assert rows.order == [("row", "a"), ("row", "b")]
+    rows.widgets[("row", "a")].configure.assert_called_with(text="A")
+    rows.widgets[("row", "b")].pack.assert_called_with(fill="x")
+
+
+def test_unchanged_rows_untouched() -> None:
+    rows = make_list()
+    rows.reconcile([("row", "a", "A")])
+    w = rows.widgets[("row", "a")]
+    w.reset_mock()
+
+    rows.reconcile([("row", "a", "A"), ("row", "b", "B")])
+    w.configure.assert_not_called()
+    w.pack.assert_not_called()
+    w.pack_forget.assert_not_called()
+
+
+def test_changed_data_updates_in_place() -> None:
+    rows = make_list()
+    rows.reconcile([("row", "a", "A")])
+    w = rows.widgets[("row", "a")]
+    rows.reconcile([("row", "a", "A2")])
+    assert rows.widgets[("row", "a")] is w
+    w.configure.assert_called_with(text="A2")
+
+
+def test_removed_rows_are_pooled_and_recycled() -> None:
+    rows = make_list()
+    rows.reconcile([("row", "a", "A"), ("row", "b", "B")])
+    b = rows.widgets[("row", "b")]
+
+    rows.reconcile([("row", "a", "A")])
+    b.pack_forget.assert_called()
+    b.destroy.assert_not_called()
+    assert rows.pools["row"] == [b]
+
+    rows.reconcile([("row", "a", "A"), ("row", "c", "C")])
+    assert rows.widgets[("row", "c")] is b
+    b.configure.assert_called_with(text="C")
+
+
+def test_pool_overflow_destroys() -> None:
+    rows = make_list(max_pool_size=0)
+    rows.reconcile([("row", "a", "A")])
+    a = rows.widgets[("row", "a")]
+    rows.reconcile([])
+    a.destroy.assert_called()
+
+
+def test_reorder_repacks() -> None:
+    rows = make_list()
+    rows.reconcile([("row", "a", "A"), ("row", "b", "B")])
+    widgets: Dict[str, Any] = {k[1]: w for k, w in rows.widgets.items()}
+    rows.reconcile([("row", "b", "B"), ("row", "a", "A")])
+    assert rows.order == [("row", "b"), ("row", "a")]
+    widgets["a"].pack_forget.assert_called()
+    assert widgets["a"].pack.call_count == 2